@@ -0,0 +1,270 @@
+"""
+Transport benchmarks run against an in-process broker, so they need no network setup:
+
+- send: Sender.send (one blocking round trip per message) and Sender.send_async
+  (pipelined) messages per second
+- receive: delivery throughput of a PersistentReceiver (through ReceiverThread)
+- round_trip: Agent specification -> receipt -> first result -> EOF latency percentiles
+
+Results are written as JSON. With --baseline, throughputs and latencies are compared
+against an earlier run and the script exits non-zero when one regressed by more than
+--tolerance.
+
+    python benchmarks/bench_transport.py --output results.json
+    python benchmarks/bench_transport.py --quick --baseline results.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import platform
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+import proton
+from local_broker import LocalBroker
+from measurement_plane.agent import Agent
+from measurement_plane.base_capability import BaseCapability
+from measurement_plane.protocols.amqp.send import Sender
+from measurement_plane.protocols.amqp.receive import ReceiverThread
+from measurement_plane.measurement_plane_client.MP_client import MeasurementPlaneClient, Measurement
+
+BENCH_ENDPOINT = '/benchmark/agent'
+TARGET_BYTES = 64 * 1024 * 1024  # bytes sent per payload, bounds the message count of large payloads
+ROUND_TRIP_START_DELAY = 0.05  # lets the client attach the results topic before the first run fires
+ROUND_TRIP_TIMEOUT = 30
+DEFAULT_TOLERANCE = 0.2
+
+def make_payloads() -> dict:
+    return {
+        "small_dict": {"value": 1.5, "label": "channel-1", "ok": True},
+        "list_1k": {"samples": [float(i) for i in range(1000)]},
+        "ndarray_1MB": {"samples": np.random.rand(128 * 1024)},
+        "ndarray_8MB": {"samples": np.random.rand(1024 * 1024)},
+    }
+
+def payload_size(payload) -> int:
+    samples = payload.get("samples")
+    if isinstance(samples, np.ndarray):
+        return samples.nbytes
+    return len(json.dumps(payload))
+
+def message_count(payload, max_messages) -> int:
+    return max(10, min(max_messages, TARGET_BYTES // max(payload_size(payload), 1)))
+
+def percentiles(values) -> dict:
+    ordered = sorted(values)
+    def at(q):
+        return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "min": ordered[0], "max": ordered[-1], "count": len(ordered)}
+
+def is_binary(payload) -> bool:
+    return isinstance(payload.get("samples"), np.ndarray)
+
+def bench_send(broker, name, payload, max_messages) -> list:
+    sender = Sender()
+    topic = f"topic://bench/send/{name}"
+    binary = is_binary(payload)
+    sender.send(broker.url, topic, payload, binary=binary)  # opens the connection and link
+    results = []
+
+    count = max(5, message_count(payload, max_messages) // 10)
+    start = time.perf_counter()
+    for _ in range(count):
+        sender.send(broker.url, topic, payload, binary=binary)
+    elapsed = time.perf_counter() - start
+    results.append({"benchmark": "send", "mode": "blocking", "payload": name, "messages": count,
+                    "msg_per_s": count / elapsed, "mb_per_s": count * payload_size(payload) / elapsed / 1e6})
+
+    count = message_count(payload, max_messages)
+    start = time.perf_counter()
+    futures = [sender.send_async(broker.url, topic, payload, binary=binary) for _ in range(count)]
+    for future in futures:
+        future.result(ROUND_TRIP_TIMEOUT)
+    elapsed = time.perf_counter() - start
+    results.append({"benchmark": "send", "mode": "pipelined", "payload": name, "messages": count,
+                    "msg_per_s": count / elapsed, "mb_per_s": count * payload_size(payload) / elapsed / 1e6})
+    return results
+
+def bench_receive(broker, name, payload, max_messages) -> dict:
+    count = message_count(payload, max_messages)
+    address = f"bench/receive/{name}/{uuid.uuid4().hex}"
+    received = 0
+    done = threading.Event()
+
+    def on_message(event):
+        nonlocal received
+        received += 1
+        if received == count:
+            done.set()
+
+    receiver = ReceiverThread(broker.url, f"topic://{address}", on_message)
+    receiver.start()
+    if not broker.wait_for_consumer(f"topic://{address}"):
+        raise RuntimeError("Receiver did not attach")
+    sender = Sender()
+    start = time.perf_counter()
+    futures = [sender.send_async(broker.url, f"topic://{address}", payload, binary=is_binary(payload)) for _ in range(count)]
+    completed = done.wait(ROUND_TRIP_TIMEOUT)
+    elapsed = time.perf_counter() - start
+    for future in futures:
+        future.result(ROUND_TRIP_TIMEOUT)
+    receiver.container.stop()
+    return {"benchmark": "receive", "payload": name, "messages": received, "complete": completed,
+            "msg_per_s": received / elapsed, "mb_per_s": received * payload_size(payload) / elapsed / 1e6}
+
+class BenchmarkCapability(BaseCapability):
+    def __init__(self, payloads):
+        super().__init__(name="benchmark")
+        self.label = "Benchmark"
+        self.type = "measure"
+        self.parameters_schema = {"type": "object", "properties": {"payload": {"type": "string"}, "run": {"type": "string"}}}
+        self.result_schema = {"type": "object"}
+        self.payloads = payloads
+
+    def execute_task(self, parameters):
+        return self.payloads[parameters["payload"]]
+
+class TimedMeasurement(Measurement):
+    def __init__(self, capability, client):
+        super().__init__(capability, client)
+        self.first_result = None
+        self.finished = threading.Event()
+
+    def deliver_results(self, results):
+        if self.first_result is None:
+            self.first_result = time.perf_counter()
+        super().deliver_results(results)
+
+    def stop(self):
+        super().stop()
+        self.finished.set()
+
+def bench_round_trip(client, capability, name, iterations) -> dict:
+    receipt, first_result, eof = [], [], []
+    lost = 0
+    for _ in range(iterations):
+        measurement = TimedMeasurement(capability, client)
+        start_at = datetime.now() + timedelta(seconds=ROUND_TRIP_START_DELAY)
+        fired = time.perf_counter() + ROUND_TRIP_START_DELAY
+        measurement.configure(schedule=start_at.isoformat(), parameters={"payload": name, "run": uuid.uuid4().hex},
+                              result_callback=lambda results: None)
+        sent = time.perf_counter()
+        client.send_measurement(measurement)
+        if not measurement.receipt_received.is_set():
+            lost += 1
+            continue
+        receipt.append(time.perf_counter() - sent)
+        if not measurement.finished.wait(ROUND_TRIP_TIMEOUT) or measurement.first_result is None:
+            lost += 1
+            continue
+        # Result latencies count from the scheduled start, not from the send
+        first_result.append(measurement.first_result - fired)
+        eof.append(time.perf_counter() - fired)
+    result = {"benchmark": "round_trip", "payload": name, "iterations": iterations, "lost": lost}
+    for stage, values in (("receipt_s", receipt), ("first_result_s", first_result), ("eof_s", eof)):
+        if values:
+            result[stage] = percentiles(values)
+    return result
+
+def run(args) -> dict:
+    payloads = make_payloads()
+    if args.payloads:
+        payloads = {name: payloads[name] for name in args.payloads}
+    broker = LocalBroker().start()
+    results = []
+
+    for name, payload in payloads.items():
+        logging.info(f"send {name}")
+        results.extend(bench_send(broker, name, payload, args.messages))
+        logging.info(f"receive {name}")
+        results.append(bench_receive(broker, name, payload, args.messages))
+
+    client = MeasurementPlaneClient(broker.url)
+    agent = Agent(broker.url, BENCH_ENDPOINT, binary_results=args.binary_results)
+    agent.register_capability(BenchmarkCapability(payloads))
+    agent.start()
+    deadline = time.time() + 15
+    while not client.get_capabilities() and time.time() < deadline:
+        time.sleep(0.05)
+    capability = next(iter(client.get_capabilities().values()))
+    for name in payloads:
+        logging.info(f"round trip {name}")
+        results.append(bench_round_trip(client, capability, name, args.iterations))
+    agent.stop()
+
+    return {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "proton": proton.VERSION if hasattr(proton, "VERSION") else None,
+        "platform": platform.platform(),
+        "binary_results": args.binary_results,
+        "results": results,
+    }
+
+def result_key(result) -> tuple:
+    return (result["benchmark"], result.get("mode"), result["payload"])
+
+def compare(report, baseline, tolerance) -> list:
+    """
+    Returns a description of every metric that got worse than baseline by more than tolerance.
+    """
+    previous = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        if "msg_per_s" in result and result["msg_per_s"] < old["msg_per_s"] * (1 - tolerance):
+            regressions.append(f"{result_key(result)} msg/s {old['msg_per_s']:.1f} -> {result['msg_per_s']:.1f}")
+        for stage in ("receipt_s", "first_result_s", "eof_s"):
+            if stage in result and stage in old and result[stage]["p50"] > old[stage]["p50"] * (1 + tolerance):
+                regressions.append(f"{result_key(result)} {stage} p50 {old[stage]['p50'] * 1e3:.2f}ms -> {result[stage]['p50'] * 1e3:.2f}ms")
+    return regressions
+
+def print_report(report):
+    for result in report["results"]:
+        label = " ".join(str(part) for part in result_key(result) if part)
+        if "msg_per_s" in result:
+            print(f"{label:40s} {result['msg_per_s']:10.1f} msg/s {result['mb_per_s']:10.2f} MB/s")
+        for stage in ("receipt_s", "first_result_s", "eof_s"):
+            if stage in result:
+                stats = result[stage]
+                print(f"{label + ' ' + stage:40s} p50 {stats['p50'] * 1e3:8.2f}ms p90 {stats['p90'] * 1e3:8.2f}ms p99 {stats['p99'] * 1e3:8.2f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the AMQP transport against an in-process broker.")
+    parser.add_argument("--output", type=str, default=None, help="File to write the JSON results to")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed relative regression (default: 0.2)")
+    parser.add_argument("--payloads", nargs="*", help="Payloads to run (default: all)")
+    parser.add_argument("--messages", type=int, default=5000, help="Maximum messages per throughput run")
+    parser.add_argument("--iterations", type=int, default=50, help="Round trips per payload")
+    parser.add_argument("--binary-results", action="store_true", help="Have the agent send results as binary frames")
+    parser.add_argument("--quick", action="store_true", help="Fewer messages and round trips, for a smoke run")
+    args = parser.parse_args()
+    if args.quick:
+        args.messages = min(args.messages, 500)
+        args.iterations = min(args.iterations, 10)
+    logging.basicConfig(level=logging.WARNING)
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    # Reactor threads of the client and agent are not daemons
+    sys.stdout.flush()
+    os._exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Minimal in-process AMQP 1.0 broker for the benchmarks. Every message published to an
+address is fanned out to the receivers attached to it at that moment; nothing is stored
+for later consumers, like a topic without durable subscriptions.
+"""
+import socket
+import threading
+import collections
+from proton.handlers import MessagingHandler
+from proton.reactor import Container
+
+class Address:
+    def __init__(self):
+        self.consumers = {}  # sender link -> messages waiting for credit
+
+    def publish(self, message):
+        for link, backlog in self.consumers.items():
+            backlog.append(message)
+            self.drain(link)
+
+    def drain(self, link):
+        backlog = self.consumers.get(link)
+        while backlog and link.credit > 0:
+            link.send(backlog.popleft())
+
+class LocalBrokerHandler(MessagingHandler):
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.addresses = {}
+        self.listening = threading.Event()
+        self.consumers_changed = threading.Condition()
+
+    def on_start(self, event):
+        self.acceptor = event.container.listen(self.url)
+        self.listening.set()
+
+    def address(self, name) -> Address:
+        return self.addresses.setdefault(name, Address())
+
+    def on_link_opening(self, event):
+        link = event.link
+        if link.is_sender:
+            name = link.remote_source.address
+            link.source.address = name
+            with self.consumers_changed:
+                self.address(name).consumers[link] = collections.deque()
+                self.consumers_changed.notify_all()
+        elif link.remote_target.address:
+            link.target.address = link.remote_target.address
+
+    def on_sendable(self, event):
+        self.address(event.link.source.address).drain(event.link)
+
+    def on_message(self, event):
+        self.address(event.link.target.address).publish(event.message)
+
+    def remove_link(self, link):
+        if link.is_sender and link.source.address in self.addresses:
+            with self.consumers_changed:
+                self.addresses[link.source.address].consumers.pop(link, None)
+
+    def on_link_closing(self, event):
+        self.remove_link(event.link)
+
+    def on_connection_closing(self, event):
+        self.remove_connection(event.connection)
+
+    def on_disconnected(self, event):
+        self.remove_connection(event.connection)
+
+    def remove_connection(self, connection):
+        link = connection.link_head(0)
+        while link:
+            self.remove_link(link)
+            link = link.next(0)
+
+class LocalBroker:
+    def __init__(self, host = "localhost", port = None):
+        self.host = host
+        self.port = port or free_port(host)
+        self.url = f"{self.host}:{self.port}"
+        self.handler = LocalBrokerHandler(self.url)
+        self.container = Container(self.handler)
+        self.thread = threading.Thread(target=self.container.run, daemon=True)
+
+    def start(self, timeout = 5):
+        self.thread.start()
+        if not self.handler.listening.wait(timeout):
+            raise RuntimeError(f"Local broker did not start on {self.url}")
+        return self
+
+    def wait_for_consumer(self, address, timeout = 5) -> bool:
+        with self.handler.consumers_changed:
+            return self.handler.consumers_changed.wait_for(
+                lambda: address in self.handler.addresses and self.handler.addresses[address].consumers, timeout)
+
+    def stop(self):
+        self.container.stop()
+
+def free_port(host = "localhost") -> int:
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
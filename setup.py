@@ -12,6 +12,10 @@ setup(
         "jsonschema>=4.0.0",           # For JSON validation
         "numpy>=1.21.0",               # For numerical processing
     ],
+    extras_require={
+        "lz4": ["lz4"],                # Faster result compression codecs
+        "zstd": ["zstandard"],
+    },
     entry_points={
         'console_scripts': [
             'start-agent=measurement_plane.start_agent:start_agent',
@@ -1,22 +1,88 @@
+import os
+import asyncio
 import logging
 import json
 import time
+import queue
+import random
 import threading
 from datetime import datetime
-from threading import Thread, Event
+from threading import Event
 from measurement_plane.utils.decorators import registered_capabilities
-from measurement_plane.base_capability import BaseCapability
-from measurement_plane.protocols.amqp.receive import ReceiverThread
-from measurement_plane.protocols.amqp.send import Sender
-from measurement_plane.messaging.message_format import Topics, MessageFields, Ids, TaskSchedule
+from measurement_plane.utils.batching import ResultBatcher
+from measurement_plane.utils.scheduler import Scheduler, SCHEDULER_WORKERS
+from measurement_plane.utils.process_pool import CapabilityProcessPool, ProcessTask
+from measurement_plane.utils.stream_buffer import StreamBuffer
+from measurement_plane.utils import metrics, tracing
+from measurement_plane.utils.tracing import TraceContext
+from measurement_plane.utils.validation import ValidatorCache
+from measurement_plane.utils.serial_executor import KeyedSerialExecutor, DISPATCH_WORKERS
+from measurement_plane.utils.result_cache import ResultCache
+from measurement_plane.utils.profiler import ProfileSession, SAMPLE_MODE, PROFILE_DURATION, SAMPLE_INTERVAL, REPORT_TOP
+from jsonschema import exceptions as jsonschema_exceptions
+from measurement_plane.base_capability import BaseCapability, ResultBatch
+from measurement_plane.protocols.amqp.receive import ReceiverHub
+from measurement_plane.protocols.amqp.send import Sender, PersistentSender, log_send_error
+from measurement_plane.protocols.amqp.encoding import JSON_CONTENT_TYPE, decode_control_message
+from measurement_plane.messaging.message import ResultEnvelope
+from proton import Message
+from measurement_plane.messaging.message_format import Topics, MessageFields, Ids, IdentifiedMessage, TaskSchedule
+
+RESULT_BATCH_SIZE = 100
+RESULT_LINGER = 0.05  # seconds a result may wait for its batch to fill
+STREAM_POLL_INTERVAL = 0.5  # seconds between interrupt checks while a stream is idle
+ADVERTISE_INTERVAL = 10
+ADVERTISE_JITTER = 0.2  # fraction of the interval added or removed at random
+
+SPECIFICATIONS_RECEIVED = metrics.counter('mp_agent_messages_total', 'Messages handled by agents', type='specification')
+INTERRUPTS_RECEIVED = metrics.counter('mp_agent_messages_total', 'Messages handled by agents', type='interrupt')
+ADVERTISEMENT_REQUESTS_RECEIVED = metrics.counter('mp_agent_messages_total', 'Messages handled by agents', type='advertisement_request')
+UNKNOWN_RECEIVED = metrics.counter('mp_agent_messages_total', 'Messages handled by agents', type='unknown')
+MEASUREMENTS_STARTED = metrics.counter('mp_measurements_started_total', 'Specifications scheduled by agents')
+RESULTS_VALIDATED = metrics.counter('mp_results_validated_total', 'Sampled result values checked against their result schema')
+RESULT_VALIDATION_FAILURES = metrics.counter('mp_result_validation_failures_total', 'Sampled result values that did not match their result schema')
+
 class Agent:
-    def __init__(self, broker : str, endpoint : str):
+    def __init__(self, broker : str, endpoint : str, result_batch_size : int = RESULT_BATCH_SIZE, result_linger : float = RESULT_LINGER, binary_results : bool = False, receiver_hub : ReceiverHub = None, max_workers : int = SCHEDULER_WORKERS, max_processes : int = None, compression : str = None, result_validation_rate : float = 0.0, dispatch_workers : int = DISPATCH_WORKERS, profile_directory : str = None, outbox_directory : str = None):
         self.broker = broker
         self.endpoint = endpoint
+        self.receiver_hub = receiver_hub or ReceiverHub(broker)
         self.capabilities = []
+        self.capability_index = {}  # capability_id -> capability
+        self.result_caches = {}  # capability_id -> ResultCache, for capabilities with a result_cache_ttl
+        self.specifications_receiver = None
         self.running = False
-        self.sender = Sender()
+        # Results sent while the broker is unreachable beyond what the outbox holds in memory are spilled here
+        self.sender = Sender(PersistentSender(spill_directory=outbox_directory, name=endpoint)) if outbox_directory else Sender()
         self.running_measurements = {}
+        self.measurements_lock = threading.RLock()
+        self.scheduler = Scheduler(max_workers)
+        # Messages are handled off the reactor thread, in order per measurement_id
+        self.dispatcher = KeyedSerialExecutor(dispatch_workers)
+        self.process_pool = CapabilityProcessPool(max_processes)
+        self.result_batch_size = result_batch_size
+        self.result_linger = result_linger
+        self.result_batchers = {}
+        self.result_batchers_lock = threading.Lock()
+        self.result_envelopes = {}  # measurement_id -> ResultEnvelope
+        self.traces = {}  # measurement_id -> TraceContext, for specifications that carry one
+        # Send results as binary frames so ndarrays travel as raw buffers instead of JSON lists
+        self.binary_results = binary_results
+        # Codec for large results and advertisements, e.g. 'zlib'; None sends them uncompressed
+        self.compression = compression
+        self.advertisement_requested = Event()
+        # Fraction of result values checked against the capability's result_schema, 0 disables the check
+        self.result_validation_rate = result_validation_rate
+        self.result_validators = ValidatorCache(numpy_types=True)
+        # Open profiling window, None while profiling is off
+        self.profile_session = None
+        # Profile reports are also written here as JSON files when set
+        self.profile_directory = profile_directory
+        # Weakly owned, and unregistered by stop()
+        self.gauges = [
+            metrics.gauge('mp_running_measurements', 'Measurements running on the agent', lambda agent: len(agent.running_measurements), owner=self, endpoint=endpoint),
+            metrics.gauge('mp_stream_queue_depth', 'Items waiting in the stream buffers of the agent', Agent.stream_queue_depth, owner=self, endpoint=endpoint),
+        ]
 
     def load_capabilities(self):
         """
@@ -29,27 +95,51 @@ class Agent:
     def register_capability(self, capability:BaseCapability):
         self.capabilities.append(capability)
         capability.set_agent(self)  # Provide capability a reference to the agent
+        self.capability_index[capability.capability_id] = capability
+        if capability.result_cache_ttl:
+            self.result_caches[capability.capability_id] = ResultCache(capability.result_cache_ttl, capability.result_cache_size, capability.name)
+
+    def unregister_capability(self, capability:BaseCapability):
+        self.capabilities.remove(capability)
+        self.capability_index.pop(capability.capability_id, None)
+        self.result_caches.pop(capability.capability_id, None)
 
     def advertise_capabilities(self):
+        """
+        Sends all capabilities in one advertisement, then only a heartbeat carrying the
+        advertisement hash until the capabilities change or a client asks for them again.
+        """
         topic = Topics.CAPABILITIES_TOPIC
+        advertised_hash = None
         while self.running:
-            for capability in self.capabilities:
-                message = capability.construct_capability()
-                self.sender.send(self.broker, topic, message)
-                #logging.info(f"agent sent capability :{message}")
-            time.sleep(10)  # Advertise every 10 seconds
+            requested = self.advertisement_requested.is_set()
+            self.advertisement_requested.clear()
+            capability_msgs = [capability.construct_capability() for capability in list(self.capabilities)]
+            advertisement_hash = Ids.calculate_advertisement_hash(capability_msgs)
+            if requested or advertisement_hash != advertised_hash:
+                message = {
+                    MessageFields.ENDPOINT: self.endpoint,
+                    MessageFields.ADVERTISEMENT: capability_msgs,
+                    MessageFields.ADVERTISEMENT_HASH: advertisement_hash
+                }
+                advertised_hash = advertisement_hash
+            else:
+                message = {MessageFields.ENDPOINT: self.endpoint, MessageFields.HEARTBEAT: advertisement_hash}
+            self.sender.send(self.broker, topic, message, compression=self.compression)
+            # Jitter keeps agents started together from advertising in lockstep
+            self.advertisement_requested.wait(ADVERTISE_INTERVAL * random.uniform(1 - ADVERTISE_JITTER, 1 + ADVERTISE_JITTER))
 
     def start(self):
         self.load_capabilities()
         if self.capabilities:
             self.running = True
+            self.scheduler.start()
             advertise_thread = threading.Thread(target=self.advertise_capabilities)
             advertise_thread.start()
 
             topic = Topics.get_specifications_topic(self.endpoint)
             logging.info("Agent will start lesstning for events")
-            receiver_thread = ReceiverThread(self.broker, topic, on_message_callback=self.handle_messages)
-            receiver_thread.start()
+            self.specifications_receiver = self.receiver_hub.attach(topic, on_message_callback=self.handle_messages)
             
             self.running = True
             return self.running
@@ -59,137 +149,494 @@ class Agent:
         
     def stop(self):
         self.running = False
+        self.advertisement_requested.set()  # wakes the advertise thread so it exits
+        self.scheduler.stop()
+        self.dispatcher.shutdown()
+        if self.profile_session is not None:
+            self.profile_session.stop()
+        self.process_pool.shutdown()
+        if self.specifications_receiver:
+            self.specifications_receiver.stop()
+            self.specifications_receiver = None
+        for gauge in self.gauges:
+            metrics.unregister(gauge)
         
     def handle_messages(self, event):
-        specification_msg =json.loads(event.message.body)
-        capability_id = Ids.calculate_capability_id(specification_msg)
-        capability = None
-        for cap in self.capabilities:
-            if capability_id == Ids.calculate_capability_id(cap.construct_capability()):
-                capability = cap
-                break
+        """
+        Runs on the reactor thread: decodes the message once and hands it to the dispatcher,
+        so handling one measurement never holds up the intake of the others.
+        """
+        received_at = time.time()
+        # The ids are computed once here and travel with the specification to every run and result
+        try:
+            specification_msg = IdentifiedMessage(decode_control_message(event.message))
+        except Exception as e:
+            logging.error(f"Discarding undecodable message: {e}")
+            return
+        if MessageFields.ADVERTISEMENT_REQUEST in specification_msg:
+            ADVERTISEMENT_REQUESTS_RECEIVED.inc()
+            self.advertisement_requested.set()
+            return
+        if MessageFields.PROFILE in specification_msg:
+            self.handle_profile_request(specification_msg[MessageFields.PROFILE])
+            return
+        try:
+            key = specification_msg.ids.measurement_id
+        except KeyError:
+            key = None  # incomplete message, process_message reports it
+        reply_to = event.message.reply_to
+        self.dispatcher.submit(key, lambda: self.process_message(specification_msg, reply_to, received_at))
+
+    def process_message(self, specification_msg : IdentifiedMessage, reply_to : str, received_at : float):
+        """
+        Handles a specification or interrupt on a dispatcher thread, after the earlier
+        messages of the same measurement.
+        """
+        ids = specification_msg.ids
+        capability = self.capability_index.get(ids.capability_id)
 
         if capability:
             logging.info("Recived msg: {}".format(specification_msg))
             if MessageFields.SPECIFICATION in specification_msg:
-                self.send_receipt(event)
-                measurement_id = Ids.calculate_measurement_id(specification_msg)
-                operation_id = Ids.calculate_operation_id(specification_msg)
-                if measurement_id not in self.running_measurements:
-                    self.running_measurements[measurement_id] = {
-                            'operation_ids': [],
-                            'measurement_process': (None, None)
-                        }
-                    self.running_measurements[measurement_id]['operation_ids'].append(operation_id)
-                    interrupt_event = Event()
-                    thread = Thread(target=self.process_specification, args=(specification_msg, interrupt_event, capability))
-                    self.running_measurements[measurement_id]['measurement_process'] = (thread, interrupt_event)
-                    thread.start()
-
-                if operation_id not in self.running_measurements[measurement_id]['operation_ids']:
-                    self.running_measurements[measurement_id]['operation_ids'].append(operation_id)
+                SPECIFICATIONS_RECEIVED.inc()
+                trace = TraceContext.from_message(specification_msg.get(MessageFields.TRACE))
+                if trace is not None:
+                    trace.mark(tracing.AGENT_RECEIVED, received_at)
+                self.send_receipt(specification_msg, reply_to, trace)
+                measurement_id = ids.measurement_id
+                operation_id = ids.operation_id
+                with self.measurements_lock:
+                    measurement = self.running_measurements.get(measurement_id)
+                    if measurement is None:
+                        if trace is not None:
+                            self.traces[measurement_id] = trace
+                        interrupt_event = Event()
+                        self.running_measurements[measurement_id] = {
+                                'operation_ids': [operation_id],
+                                'measurement_process': (None, interrupt_event),
+                                'specification': specification_msg
+                            }
+                        self.process_specification(specification_msg, interrupt_event, capability)
+                    elif operation_id not in measurement['operation_ids']:
+                        measurement['operation_ids'].append(operation_id)
 
             elif MessageFields.INTERRUPT in specification_msg:
-                self.send_receipt(event)
-                measurement_id = Ids.calculate_measurement_id(specification_msg)
-                operation_id = Ids.calculate_operation_id(specification_msg)
-                if measurement_id in self.running_measurements:
-                    if operation_id in self.running_measurements[measurement_id]['operation_ids']:
-                        self.running_measurements[measurement_id]['operation_ids'].remove(operation_id)
+                INTERRUPTS_RECEIVED.inc()
+                self.send_receipt(specification_msg, reply_to)
+                measurement_id = ids.measurement_id
+                operation_id = ids.operation_id
+                with self.measurements_lock:
+                    measurement = self.running_measurements.get(measurement_id)
+                    if measurement is None:
+                        logging.warning(f"Specification not found.")
+                        return
+                    if operation_id in measurement['operation_ids']:
+                        measurement['operation_ids'].remove(operation_id)
                     else:
                         logging.warning(f"Specification not found.")
-                    if len(self.running_measurements[measurement_id]['operation_ids']) == 0:
-                        thread, interrupt_event = self.running_measurements[measurement_id]['measurement_process']
+                    if len(measurement['operation_ids']) == 0:
+                        task, interrupt_event = measurement['measurement_process']
+                        running_specification = measurement['specification']
                         interrupt_event.set()
-                        thread.join()
                         logging.info(f"Interrupt signal sent for specification")
-                        
-                else:
-                    logging.warning(f"Specification not found.")
+                    else:
+                        return
+                # A run still waiting for its fire time is cancelled right away; a running one sees the event
+                if task is not None and task.cancel():
+                    self.finish_specification(running_specification, capability, None)
                 
             else:
+                UNKNOWN_RECEIVED.inc()
                 logging.warning("Unknown message type.")
         else:
+            UNKNOWN_RECEIVED.inc()
             logging.info("received unknown capability")
         
 
-    def send_receipt(self, event):
-        receipt_msg=json.loads(event.message.body)
+    def handle_profile_request(self, request : dict):
+        """
+        Opens (or with stop, closes) a profiling window as asked by a control message:
+        {"profile": {"mode", "duration", "interval", "top", "capabilityName", "replyTo", "stop"}},
+        every key optional. Without capabilityName the whole agent is profiled.
+        """
+        if request.get("stop"):
+            session = self.profile_session
+            if session is not None:
+                session.stop()
+            return
+        capability = None
+        capability_name = request.get(MessageFields.CAPABILITY_NAME)
+        if capability_name is not None:
+            capability = next((capability for capability in self.capabilities if capability.name == capability_name), None)
+            if capability is None:
+                logging.warning(f"Profile requested for unknown capability {capability_name}")
+                return
+        try:
+            self.start_profile(request.get("mode", SAMPLE_MODE), float(request.get("duration", PROFILE_DURATION)),
+                               float(request.get("interval", SAMPLE_INTERVAL)), capability, int(request.get("top", REPORT_TOP)),
+                               request.get(MessageFields.REPLY_TO))
+        except (TypeError, ValueError) as e:
+            logging.error(f"Invalid profile request: {e}")
+
+    def start_profile(self, mode : str = SAMPLE_MODE, duration : float = PROFILE_DURATION, interval : float = SAMPLE_INTERVAL,
+                      capability : BaseCapability = None, top : int = REPORT_TOP, reply_to : str = None) -> ProfileSession:
+        """
+        Profiles capability, or the whole agent, for duration seconds. The report is
+        published to reply_to, by default the agent's profiles topic.
+        """
+        if self.profile_session is not None:
+            logging.warning("A profiling window is already open")
+            return self.profile_session
+
+        def on_report(report):
+            if self.profile_session is session:
+                self.profile_session = None
+            self.publish_profile(report, reply_to)
+
+        session = ProfileSession(mode, duration, interval, capability, top, on_report)
+        self.profile_session = session
+        return session.start()
+
+    def publish_profile(self, report : dict, reply_to : str = None):
+        report[MessageFields.ENDPOINT] = self.endpoint
+        if self.profile_directory:
+            os.makedirs(self.profile_directory, exist_ok=True)
+            path = os.path.join(self.profile_directory, f"profile-{report['started']:.0f}-{report['mode']}.json")
+            with open(path, "w") as report_file:
+                json.dump(report, report_file, indent=2)
+            logging.info(f"Profile report written to {path}")
+
+        message = {MessageFields.ENDPOINT: self.endpoint, MessageFields.PROFILE_REPORT: report}
+        topic = reply_to or Topics.get_profiles_topic(self.endpoint)
+        future = self.sender.send_async(self.broker, topic, message)
+        future.add_done_callback(lambda future: log_send_error(topic, future))
+
+    def send_receipt(self, specification_msg : dict, reply_to : str, trace : TraceContext = None):
+        """
+        Answers on reply_to without waiting for the broker, from a copy of the decoded message.
+        """
+        receipt_msg = dict(specification_msg)
         if MessageFields.SPECIFICATION in receipt_msg:
-            receipt_msg[MessageFields.RECEIPT] = receipt_msg[MessageFields.SPECIFICATION]
-            del receipt_msg[MessageFields.SPECIFICATION]
+            receipt_msg[MessageFields.RECEIPT] = receipt_msg.pop(MessageFields.SPECIFICATION)
         elif MessageFields.INTERRUPT in receipt_msg:
             receipt_msg[MessageFields.RECEIPT] = receipt_msg[MessageFields.INTERRUPT]
         else:
             logging.warning("Recipt not supported for msg: {}".format(receipt_msg))
         receipt_msg[MessageFields.TIMESTAMP] = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4]
-        topic_reply_to =  event.message.reply_to
-        self.broker
-        self.sender.send(self.broker, topic = topic_reply_to, messages= receipt_msg)
+        if trace is not None:
+            receipt_msg[MessageFields.TRACE] = trace.to_message()
+
+        future = self.sender.send_async(self.broker, topic = reply_to, messages= receipt_msg)
+        future.add_done_callback(lambda future: log_send_error(reply_to, future))
 
     def process_specification(self, specification_msg : dict, interrupt_event : Event, capability : BaseCapability):
-        schedule = specification_msg[MessageFields.SCHEDULE]
-        task_schedule = TaskSchedule(schedule)
+        """
+        Schedules the first run of a specification at its start time.
+        """
+        MEASUREMENTS_STARTED.inc()
+        self.mark_stage(specification_msg, tracing.SCHEDULED)
+        task_schedule = TaskSchedule(specification_msg[MessageFields.SCHEDULE])
+        self.schedule_run(specification_msg, interrupt_event, capability, task_schedule, 0)
+
+    def schedule_run(self, specification_msg : dict, interrupt_event : Event, capability : BaseCapability, task_schedule : TaskSchedule, run_index : int):
+        # Runs are anchored to the start time, so execution time never accumulates as drift
+        fire_at = task_schedule.start
+        if run_index:
+            fire_at = task_schedule.start + run_index * task_schedule.periodicity
+        self.mark_stage(specification_msg, tracing.RUN_DUE, fire_at.timestamp())
+        measurement_id = Ids.of(specification_msg).measurement_id
+        run = lambda: self.profiled(capability, lambda: self.run_specification(specification_msg, interrupt_event, capability, task_schedule, run_index))
+        if task_schedule.stream == "active":
+            # A stream would hold a scheduler worker for its whole life
+            task = self.scheduler.schedule_at(fire_at, lambda: self.run_detached(measurement_id, run))
+        else:
+            task = self.scheduler.schedule_at(fire_at, run)
+        with self.measurements_lock:
+            if measurement_id in self.running_measurements:
+                self.running_measurements[measurement_id]['measurement_process'] = (task, interrupt_event)
+        # An interrupt may have arrived while the previous run was executing
+        if interrupt_event.is_set() and task.cancel():
+            self.finish_specification(specification_msg, capability, task_schedule)
+
+    def run_detached(self, measurement_id : str, run):
+        """
+        Runs a long-lived run on a thread of its own, leaving the scheduler workers to short runs.
+        """
+        def target():
+            try:
+                run()
+            except Exception as e:
+                logging.exception(f"Run of measurement {measurement_id} failed: {e}")
+        threading.Thread(target=target, name=f"measurement-{measurement_id}", daemon=True).start()
+
+    def profiled(self, capability : BaseCapability, run):
+        # A single attribute check while no cProfile window is open
+        session = self.profile_session
+        if session is None or not session.profiles_calls(capability):
+            return run()
+        return session.call(run)
+
+    def run_specification(self, specification_msg : dict, interrupt_event : Event, capability : BaseCapability, task_schedule : TaskSchedule, run_index : int):
         parameters = specification_msg[MessageFields.PARAMETERS]
-        # Wait until the start time, or until interrupted or stopped
-        while datetime.now() < task_schedule.start:
-            if interrupt_event.is_set():
-                logging.info("Interrupt event set before start time, stopping process.")
-                return
-            if not self.running:
-                logging.info("self.running is False before start time, stopping process.")
-                return
-            # Sleep for a short duration to avoid busy-waiting
-            time.sleep(0.1)
-        #SCHEDULE RUNNING TIME CRON
-        # Execute the task and check stop conditions
-        while self.running:
-            if interrupt_event.is_set():
-                logging.info("Interrupt event set, stopping process.")
-                break
+        if interrupt_event.is_set():
+            logging.info("Interrupt event set, stopping process.")
+            return self.finish_specification(specification_msg, capability, task_schedule)
+        if not self.running:
+            logging.info("self.running is False, stopping process.")
+            return self.finish_specification(specification_msg, capability, task_schedule)
+        if task_schedule.stop and datetime.now() > task_schedule.stop:
+            logging.info("Current time is past stop time, stopping process.")
+            return self.finish_specification(specification_msg, capability, task_schedule)
 
-            if task_schedule.stop:
-                if datetime.now() > task_schedule.stop:
-                    logging.info("Current time is past stop time, stopping process.")
-                    break
-            
-            if task_schedule.stream == "active":
-                results_queue = capability.stream(parameters=parameters)
-                task_schedule.stream = "running"
+        self.mark_stage(specification_msg, tracing.RUN_STARTED)
+        if task_schedule.stream == "active":
+            self.run_stream(specification_msg, interrupt_event, capability, task_schedule)
+            return self.finish_specification(specification_msg, capability, task_schedule)
+        if capability.run_in_process:
+            return self.submit_process_run(specification_msg, interrupt_event, capability, task_schedule, run_index)
+
+        results = self.execute_task(capability, parameters, interrupt_event)
+        self.complete_run(specification_msg, interrupt_event, capability, task_schedule, run_index, results)
+
+    def complete_run(self, specification_msg : dict, interrupt_event : Event, capability : BaseCapability, task_schedule : TaskSchedule, run_index : int, results):
+        """
+        Publishes the results of a run, then schedules the next one or finishes the specification.
+        """
+        self.mark_stage(specification_msg, tracing.EXECUTED)
+        if results:
+            self.send_result(specification_msg, results)
+
+        if not task_schedule.periodicity or interrupt_event.is_set():
+            return self.finish_specification(specification_msg, capability, task_schedule)
+        # Skip the slots a long execution overran instead of firing them back to back
+        elapsed = datetime.now() - task_schedule.start
+        next_index = max(run_index + 1, int(elapsed / task_schedule.periodicity) + 1)
+        if task_schedule.stop and task_schedule.start + next_index * task_schedule.periodicity > task_schedule.stop:
+            logging.info("Next run is past stop time, stopping process.")
+            return self.finish_specification(specification_msg, capability, task_schedule)
+        self.schedule_run(specification_msg, interrupt_event, capability, task_schedule, next_index)
+
+    def stream_active(self, interrupt_event : Event, task_schedule : TaskSchedule) -> bool:
+        if not self.running or interrupt_event.is_set():
+            return False
+        if task_schedule.stop and datetime.now() > task_schedule.stop:
+            logging.info("Current time is past stop time, stopping process.")
+            return False
+        return True
+
+    def publish_stream_item(self, specification_msg : dict, results):
+        if isinstance(results, ResultBatch):
+            self.send_results(specification_msg, results)
+        elif results is not None:
+            self.send_result(specification_msg, results)
+
+    def run_stream(self, specification_msg : dict, interrupt_event : Event, capability : BaseCapability, task_schedule : TaskSchedule):
+        """
+        Publishes what capability.stream() produces. It may return a queue ended by the
+        EOF_results marker, or a sync or async iterator ended by exhaustion.
+        """
+        results_source = capability.stream(parameters=specification_msg[MessageFields.PARAMETERS])
+        if hasattr(results_source, '__anext__'):
+            task_schedule.stream = None  # generators are closed here, there is no stop_stream to call
+            return asyncio.run(self.drain_async_stream(specification_msg, interrupt_event, task_schedule, results_source))
+        if not isinstance(results_source, queue.Queue):
+            task_schedule.stream = None
+            return self.drain_stream_iterator(specification_msg, interrupt_event, task_schedule, iter(results_source))
+
+        task_schedule.stream = "running"
+        measurement_id = Ids.of(specification_msg).measurement_id
+        with self.measurements_lock:
+            if measurement_id in self.running_measurements:
+                self.running_measurements[measurement_id]['stream_buffer'] = results_source
+        while self.stream_active(interrupt_event, task_schedule):
+            try:
+                results = results_source.get(timeout=STREAM_POLL_INTERVAL)
+            except queue.Empty:
                 continue
-            
-            if task_schedule.stream == "running":
-                results = results_queue.get()
-                if results == MessageFields.EOF_RESULTS:
-                    break
-                if results: self.send_result(specification_msg, results)
+            if isinstance(results, str) and results == MessageFields.EOF_RESULTS:
+                break
+            if isinstance(results, (list, dict, str)) and not results:
                 continue
+            self.publish_stream_item(specification_msg, results)
 
-            results = capability.execute_task(parameters=parameters)
-            if results:
-                self.send_result(specification_msg, results)
+    def drain_stream_iterator(self, specification_msg : dict, interrupt_event : Event, task_schedule : TaskSchedule, results_iterator):
+        try:
+            for results in results_iterator:
+                if not self.stream_active(interrupt_event, task_schedule):
+                    break
+                self.publish_stream_item(specification_msg, results)
+        finally:
+            # Closing the generator runs its cleanup (finally blocks, context managers)
+            if hasattr(results_iterator, 'close'):
+                results_iterator.close()
 
-            if not task_schedule.periodicity:
-                break
-            else:
-                time.sleep(task_schedule.periodicity.total_seconds())
-                
-        if task_schedule.stream:
+    async def drain_async_stream(self, specification_msg : dict, interrupt_event : Event, task_schedule : TaskSchedule, results_iterator):
+        async def drain():
+            try:
+                async for results in results_iterator:
+                    if not self.stream_active(interrupt_event, task_schedule):
+                        break
+                    self.publish_stream_item(specification_msg, results)
+            finally:
+                if hasattr(results_iterator, 'aclose'):
+                    await results_iterator.aclose()
+
+        drain_task = asyncio.ensure_future(drain())
+        # An interrupt cancels the generator even while it is awaiting its next item
+        while not drain_task.done():
+            await asyncio.wait([drain_task], timeout=STREAM_POLL_INTERVAL)
+            if not drain_task.done() and not self.stream_active(interrupt_event, task_schedule):
+                drain_task.cancel()
+        try:
+            await drain_task
+        except asyncio.CancelledError:
+            pass
+
+    def execute_task(self, capability : BaseCapability, parameters : dict, interrupt_event : Event):
+        cache = self.result_caches.get(capability.capability_id)
+        if cache is not None:
+            return cache.get_or_compute(parameters, lambda: capability.execute_task(parameters=parameters), interrupt_event)
+        return capability.execute_task(parameters=parameters)
+
+    def submit_process_run(self, specification_msg : dict, interrupt_event : Event, capability : BaseCapability, task_schedule : TaskSchedule, run_index : int):
+        """
+        Hands a run to the process pool without waiting for it: the run completes from the
+        future's done-callback, and an interrupt cancels it like a run waiting for its fire time.
+        """
+        parameters = specification_msg[MessageFields.PARAMETERS]
+        cache = self.result_caches.get(capability.capability_id)
+        if cache is not None:
+            future = cache.get_or_submit(parameters, lambda: self.process_pool.run(capability, parameters))
+        else:
+            future = self.process_pool.run(capability, parameters)
+
+        def completed(future):
+            # On the pool's callback thread, which must not wait on the broker
+            self.scheduler.schedule(0, lambda: self.complete_run(specification_msg, interrupt_event, capability, task_schedule, run_index, future.result()))
+
+        task = ProcessTask(future, completed, discard=cache is None)  # a cached future may be shared with other runs
+        measurement_id = Ids.of(specification_msg).measurement_id
+        with self.measurements_lock:
+            if measurement_id in self.running_measurements:
+                self.running_measurements[measurement_id]['measurement_process'] = (task, interrupt_event)
+        if (interrupt_event.is_set() or not self.running) and task.cancel():
+            logging.info("Interrupt event set, discarding process task.")
+            self.finish_specification(specification_msg, capability, task_schedule)
+
+    def finish_specification(self, specification_msg : dict, capability : BaseCapability, task_schedule : TaskSchedule):
+        if task_schedule and task_schedule.stream:
             task_schedule.stream = None
             capability.stop_stream()
-        measurement_id = Ids.calculate_measurement_id(specification_msg)
-        del self.running_measurements[measurement_id]
-        self.send_result(specification_msg, MessageFields.EOF_RESULTS)
-            
+        measurement_id = Ids.of(specification_msg).measurement_id
+        with self.measurements_lock:
+            self.running_measurements.pop(measurement_id, None)
+        # Pending results must reach the client before the EOF marker
+        self.flush_results(measurement_id)
+        self.publish_results(specification_msg, [MessageFields.EOF_RESULTS])
+        self.result_envelopes.pop(measurement_id, None)
+        self.traces.pop(measurement_id, None)
+
+    def mark_stage(self, specification_msg, stage : str, at : float = None):
+        trace = self.traces.get(Ids.of(specification_msg).measurement_id)
+        if trace is not None:
+            trace.mark(stage, at)
+
+    def stream_stats(self) -> dict:
+        """
+        Depth and drop counters of the bounded stream buffers of running measurements.
+        """
+        with self.measurements_lock:
+            return {measurement_id: measurement['stream_buffer'].stats()
+                    for measurement_id, measurement in self.running_measurements.items()
+                    if isinstance(measurement.get('stream_buffer'), StreamBuffer)}
+
+    def result_cache_stats(self) -> dict:
+        """
+        Entries, hits, misses and coalesced requests of each capability's result cache.
+        """
+        return {self.capability_index[capability_id].name: cache.stats() for capability_id, cache in self.result_caches.items()
+                if capability_id in self.capability_index}
+
+    def stream_queue_depth(self) -> int:
+        return sum(stats["depth"] for stats in self.stream_stats().values())
+
+    def check_result(self, specification_msg, value):
+        """
+        Validates a sampled fraction of result values against the result_schema of their
+        capability. Mismatches are logged and counted; the value is published either way.
+        """
+        if random.random() >= self.result_validation_rate:
+            return
+        capability_id = Ids.of(specification_msg).capability_id
+        capability = self.capability_index.get(capability_id)
+        if capability is None or not capability.result_schema:
+            return
+        RESULTS_VALIDATED.inc()
+        try:
+            self.result_validators.validate(capability_id, capability.result_schema, value)
+        except jsonschema_exceptions.ValidationError as e:
+            RESULT_VALIDATION_FAILURES.inc()
+            logging.warning(f"Result of capability {capability.name} does not match its result schema: {e.message}")
+        except jsonschema_exceptions.SchemaError as e:
+            logging.error(f"Invalid result schema of capability {capability.name}: {e.message}")
+
     def send_result(self, specification_msg, results):
-        result_msg = specification_msg.copy()
-        measurement_id = Ids.calculate_measurement_id(result_msg)
-        result_msg[MessageFields.RESULT] = result_msg[MessageFields.SPECIFICATION]
-        result_msg[MessageFields.TIMESTAMP] = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4]
-        del result_msg[MessageFields.SPECIFICATION]
-        resultValues= []
-        resultValues.append(results)
-        result_msg[MessageFields.RESULT_VALUES] = resultValues
-        result_topic = Topics.get_results_topic(str(measurement_id))
-        self.sender.send(self.broker, topic = result_topic, messages= result_msg)
+        if self.result_validation_rate:
+            self.check_result(specification_msg, results)
+        if self.result_batch_size <= 1:
+            self.publish_results(specification_msg, [results])
+            return
+        self.get_result_batcher(specification_msg).add(results)
+
+    def send_results(self, specification_msg, results : list):
+        """
+        Publishes several result values at once, e.g. a ResultBatch yielded by a stream.
+        """
+        if self.result_validation_rate:
+            for value in results:
+                self.check_result(specification_msg, value)
+        if self.result_batch_size <= 1:
+            self.publish_results(specification_msg, list(results))
+            return
+        self.get_result_batcher(specification_msg).extend(results)
+
+    def get_result_batcher(self, specification_msg) -> ResultBatcher:
+        measurement_id = Ids.of(specification_msg).measurement_id
+        with self.result_batchers_lock:
+            batcher = self.result_batchers.get(measurement_id)
+            if batcher is None:
+                batcher = ResultBatcher(lambda batch: self.publish_results(specification_msg, batch),
+                                        self.result_batch_size, self.result_linger, self.scheduler)
+                self.result_batchers[measurement_id] = batcher
+        return batcher
+
+    def flush_results(self, measurement_id):
+        with self.result_batchers_lock:
+            batcher = self.result_batchers.pop(measurement_id, None)
+        if batcher:
+            batcher.flush()
+
+    def publish_results(self, specification_msg, result_values : list):
+        measurement_id = Ids.of(specification_msg).measurement_id
+        envelope = self.result_envelopes.get(measurement_id)
+        if envelope is None:
+            envelope = self.result_envelopes.setdefault(measurement_id, ResultEnvelope(specification_msg, measurement_id))
+        trace = self.traces.get(measurement_id)
+        if trace is not None:
+            trace.mark(tracing.PUBLISHED)
+            trace = trace.to_message()
+        message = None
+        if not self.binary_results and envelope.json_values:
+            try:
+                body = envelope.encode(result_values, trace)
+            except TypeError:
+                envelope.json_values = False  # let the sender pick the encoding for ndarrays and bytes
+            else:
+                message = Message(body=body, content_type=JSON_CONTENT_TYPE)
+        if message is None:
+            message = envelope.message(result_values, trace)
+        # Blocks while the broker is connected, so a slow broker pushes back into the stream
+        # buffer; while it is unreachable results wait in the sender's outbox instead
+        self.sender.send(self.broker, topic = envelope.topic, messages = message, binary = self.binary_results,
+                         compression = self.compression)
         
@@ -1,11 +1,27 @@
 from measurement_plane.messaging.message import CapabilityMessage
-from measurement_plane.messaging.message_format import MessageFields
+from measurement_plane.messaging.message_format import MessageFields, Ids
+from measurement_plane.utils.stream_buffer import StreamBuffer, OverflowPolicy, STREAM_BUFFER_SIZE
+from measurement_plane.utils.result_cache import RESULT_CACHE_SIZE
 import queue
 
+class ResultBatch(list):
+    """
+    Several result values yielded by a stream at once, published as one batch.
+    """
+
 class BaseCapability:
     """
     Capability Base Class
     """
+    # Set to True (or use @capability(process=True)) to run execute_task in the agent's process pool
+    run_in_process = False
+    # Bound and overflow policy of the buffer returned by create_stream_buffer
+    stream_buffer_size = STREAM_BUFFER_SIZE
+    stream_overflow_policy = OverflowPolicy.BLOCK
+    # Seconds a result of execute_task is reused for identical parameters (or use
+    # @capability(cache_ttl=...)); None runs every request
+    result_cache_ttl = None
+    result_cache_size = RESULT_CACHE_SIZE
 
     def __init__(self, name:str):
         self.name = name
@@ -17,10 +33,22 @@ class BaseCapability:
         self.nonce = None
         self.metadata = None
         self.type = None
+        self.capability_id = None
 
     def set_agent(self, agent):
         self.agent = agent
         self.endpoint = agent.endpoint
+        Ids.capabilities_registered = True  # the id is fixed from here on, Ids.set_digest refuses to change it
+        self.capability_id = Ids.calculate_capability_id({
+            MessageFields.ENDPOINT: self.endpoint,
+            MessageFields.CAPABILITY_NAME: self.name
+        })
+
+    def __getstate__(self):
+        # The agent holds threads and connections; process pool workers get the capability without it
+        state = self.__dict__.copy()
+        state['agent'] = None
+        return state
 
     def construct_capability(self):
         capability = CapabilityMessage()
@@ -43,7 +71,17 @@ class BaseCapability:
     def execute_task(self, parameters):
         raise NotImplementedError("This method should be overridden by subclasses")
     
+    def create_stream_buffer(self, merge_callback = None) -> StreamBuffer:
+        """
+        Bounded queue for stream() to return, sized by stream_buffer_size and stream_overflow_policy.
+        """
+        return StreamBuffer(self.stream_buffer_size, self.stream_overflow_policy, merge_callback)
+
     def stream(self, parameters)-> queue.Queue:
+        """
+        Return a queue ended by MessageFields.EOF_RESULTS, or a (sync or async) generator
+        yielding results or ResultBatch lists; the agent pulls from it and closes it on interrupt.
+        """
         raise NotImplementedError("This method should be overridden by subclasses")
     
     def stop_stream(self)-> queue.Queue:
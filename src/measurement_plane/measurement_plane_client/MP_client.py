@@ -1,31 +1,61 @@
 import random
 import string
-import json, pickle
+import queue
 import logging
 from datetime import datetime
-from threading import Thread, Event
-from jsonschema import validate, exceptions as jsonschema_exceptions
-from measurement_plane.protocols.amqp.receive import ReceiverThread
+from threading import Event, Lock
+from jsonschema import exceptions as jsonschema_exceptions
+from measurement_plane.protocols.amqp.receive import ReceiverHub
 from measurement_plane.protocols.amqp.send import Sender
+from measurement_plane.protocols.amqp.encoding import decode_message, decode_control_message
 from measurement_plane.messaging.message import Message
 from measurement_plane.measurement_plane_client.utils.broker import Broker
+from measurement_plane.measurement_plane_client.utils.spool import ResultSpool
+from measurement_plane.utils import tracing
+from measurement_plane.utils.tracing import MeasurementTrace, TraceRecorder
+from measurement_plane.utils.validation import ValidatorCache
+from measurement_plane.utils.profiler import SAMPLE_MODE, PROFILE_DURATION
 import time
-from measurement_plane.messaging.message_format import MessageFields
+from measurement_plane.messaging.message_format import MessageFields, Ids, Topics
+
+RECEIPT_TIMEOUT = 5
+
+_END_OF_RESULTS = object()
+
+def only_eof(values) -> bool:
+    return len(values) == 1 and isinstance(values[0], str) and values[0] == MessageFields.EOF_RESULTS
+
 class MeasurementPlaneClient:
-    def __init__(self, broker_url) -> None:
+    def __init__(self, broker_url, spool_directory: str = None, tracing: bool = False) -> None:
         self.broker_url = broker_url
+        # With tracing, specifications carry a trace context and the latency breakdown of
+        # every finished measurement is kept in traces
+        self.tracing = tracing
+        self.traces = TraceRecorder()
+        # Compiled parameter validators, dropped when their capability expires or is withdrawn
+        self.validators = ValidatorCache()
+        # With a spool, received results are appended to local log files and handed to
+        # result callbacks by a consumer thread, so slow callbacks never stall the receiver
+        self.spool = ResultSpool(spool_directory) if spool_directory else None
         self.sender = Sender()
-        self.broker = Broker(self.broker_url)
+        # Receipts, results and capabilities all share one connection and reactor thread
+        self.receiver_hub = ReceiverHub(self.broker_url)
+        self.receiver_hub.start()
+        self.broker = Broker(self.broker_url, receiver_hub=self.receiver_hub, validators=self.validators)
         self.broker.start()
 
 
+    def close(self):
+        """
+        Stops the capability registry and the receivers, and closes the spool.
+        """
+        self.broker.stop()
+        self.receiver_hub.stop()
+        if self.spool is not None:
+            self.spool.close()
+
     def get_capabilities(self, capability_types: list = None) -> dict:
-        capabilities = self.broker.capability_manager.capabilities
-        if capability_types:
-            keys_to_delete = [cp_id for cp_id in capabilities if capabilities[cp_id][MessageFields.CAPABILITY] not in capability_types]
-            for cp_id in keys_to_delete:
-                del capabilities[cp_id]
-        return capabilities
+        return self.broker.capability_manager.get_capabilities(capability_types or None)
 
     def combine_to_string(self, attributes: list) -> str:
         return ''.join(str(att).replace(" ", "").replace("\n", "") for att in attributes)
@@ -36,19 +66,61 @@ class MeasurementPlaneClient:
     def create_measurement(self, capability: dict) -> 'Measurement':
         return Measurement(capability, self)
 
-    def send_measurement(self, measurement: 'Measurement'):
-        if measurement.valid:
-            spec_endpoint = measurement.specification_message["endpoint"]
-            specification_topic = f'topic://{spec_endpoint}/specifications'
-            reply_to_topic = 'topic://' + ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+    def dispatch_measurement(self, measurement: 'Measurement'):
+        """
+        Attaches the receipt link and sends the specification once the link is open,
+        without blocking the caller.
+        """
+        spec_endpoint = measurement.specification_message["endpoint"]
+        specification_topic = f'topic://{spec_endpoint}/specifications'
+        reply_to_topic = 'topic://' + ''.join(random.choices(string.ascii_letters + string.digits, k=10))
 
-            measurement.receipt_receiver = ReceiverThread(broker_url=self.broker_url, topic = reply_to_topic, on_message_callback=measurement.receipt_receiver_on_message_callback)
-            measurement.receipt_receiver.start()
+        def log_send_error(future):
+            if future.exception():
+                logging.error(f"Error sending specification: {future.exception()}")
 
-            self.sender.send(self.broker_url, specification_topic, measurement.specification_message, reply_to_topic)
+        trace = measurement.trace
+        if trace is not None:
+            trace.mark(tracing.DISPATCHED)
 
-            measurement.receipt_receiver.thread.join(timeout=5)
-            measurement.receipt_receiver.stop()
+        # The results link is attached before the specification leaves, so results of a
+        # measurement starting right away are not published before anyone listens
+        pending_links = [1]
+
+        def link_attached(subscription):
+            pending_links[0] -= 1  # attach callbacks all run on the hub thread
+            if pending_links[0] == 0:
+                send_specification()
+
+        def receipt_link_attached(subscription):
+            # Set here too: the receipt callback may run on the hub thread before attach() has returned below
+            measurement.receipt_receiver = subscription
+            link_attached(subscription)
+
+        def send_specification():
+            if trace is not None:
+                trace.mark(tracing.SPECIFICATION_SENT)
+                measurement.specification_message[MessageFields.TRACE] = trace.context.to_message()
+            future = self.sender.send_async(self.broker_url, specification_topic, measurement.specification_message, reply_to_topic)
+            future.add_done_callback(log_send_error)
+
+        measurement.receipt_received.clear()
+        if measurement.expects_results() and measurement.results_receiver is None:
+            pending_links[0] += 1
+            measurement.attach_results(Ids.calculate_measurement_id(measurement.specification_message), on_attached_callback=link_attached)
+        measurement.receipt_receiver = self.receiver_hub.attach(reply_to_topic, on_message_callback=measurement.receipt_receiver_on_message_callback,
+                                                                on_attached_callback=receipt_link_attached)
+
+    def send_measurement(self, measurement: 'Measurement'):
+        if measurement.valid:
+            self.dispatch_measurement(measurement)
+            # Called from a hub callback the reactor is busy with us, so waiting for the receipt would deadlock
+            if not self.receiver_hub.in_reactor_thread():
+                if not measurement.receipt_received.wait(timeout=RECEIPT_TIMEOUT):
+                    logging.warning("No receipt received for measurement")
+                    measurement.receipt_receiver.stop()
+                    if measurement.results_receiver is not None:
+                        measurement.results_receiver.stop()
             logging.info("Measurement sent")
         else:
             logging.error("Measurement not valid for sending")
@@ -57,13 +129,76 @@ class MeasurementPlaneClient:
     def interrupt_measurement(self, measurement: 'Measurement'):
         measurement.interrupt()
 
+    def profile_agent(self, endpoint: str, duration: float = PROFILE_DURATION, mode: str = SAMPLE_MODE, capability_name: str = None,
+                      timeout: float = RECEIPT_TIMEOUT, **options) -> dict:
+        """
+        Asks the agent at endpoint to profile itself, or only capability_name, for duration
+        seconds and returns its report, or None if none arrives within duration + timeout.
+        options (interval, top) are passed on in the request.
+        """
+        if self.receiver_hub.in_reactor_thread():
+            logging.error("profile_agent cannot wait for the report from a receiver callback")
+            return None
+        reply_to_topic = 'topic://' + ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+        request = dict(options, mode=mode, duration=duration)
+        request[MessageFields.REPLY_TO] = reply_to_topic
+        if capability_name is not None:
+            request[MessageFields.CAPABILITY_NAME] = capability_name
+        report = {}
+        received = Event()
+
+        def on_report(event):
+            message = decode_control_message(event.message)
+            if MessageFields.PROFILE_REPORT in message:
+                report.update(message[MessageFields.PROFILE_REPORT])
+                received.set()
+
+        def log_send_error(future):
+            if future.exception():
+                logging.error(f"Error sending profile request: {future.exception()}")
+
+        def send_request(subscription):
+            future = self.sender.send_async(self.broker_url, Topics.get_specifications_topic(endpoint),
+                                            {MessageFields.ENDPOINT: endpoint, MessageFields.PROFILE: request})
+            future.add_done_callback(log_send_error)
+
+        subscription = self.receiver_hub.attach(reply_to_topic, on_message_callback=on_report, on_attached_callback=send_request)
+        try:
+            if not received.wait(duration + timeout):
+                logging.warning(f"No profile report received from {endpoint}")
+                return None
+        finally:
+            subscription.stop()
+        return report
+
+    def scatter(self, schedule: str, parameters: dict, capability_name: str = None, capability_types: list = None, endpoints: list = None,
+                result_callback = None, timeout: float = RECEIPT_TIMEOUT) -> 'FanOut':
+        """
+        Sends one specification to every capability matching the selector (name, types
+        and endpoints, all optional) at once and waits up to timeout seconds in total
+        for their receipts. Results of all endpoints are read from the returned FanOut.
+        """
+        capabilities = self.broker.capability_manager.get_capabilities(capability_types or None, name=capability_name)
+        if endpoints is not None:
+            endpoints = set(endpoints)
+            capabilities = {capability_id: capability for capability_id, capability in capabilities.items()
+                            if capability[MessageFields.ENDPOINT] in endpoints}
+        fan_out = FanOut(self, list(capabilities.values()), schedule, parameters, result_callback)
+        fan_out.dispatch(timeout)
+        return fan_out
+
 class Measurement:
     def __init__(self, capability: dict, measurement_plane_client: MeasurementPlaneClient):
         self.measurement_plane_client = measurement_plane_client
         self.broker_url = self.measurement_plane_client.broker_url
         self.capability = capability
+        self.capability_id = None
         self.results_receiver = None
         self.receipt_receiver = None
+        self.measurement_id = None
+        self.spool_consumer = None
+        self.trace = None
+        self.receipt_received = Event()
         self.results = []
         self.config = {}
         self.specification_message = capability.copy()
@@ -84,20 +219,30 @@ class Measurement:
                 "result_callback": result_callback,
                 "completion_callback": completion_callback
             }
+            if self.measurement_plane_client.tracing:
+                self.trace = MeasurementTrace()
+                self.trace.capability_name = self.specification_message.get(MessageFields.CAPABILITY_NAME)
+                self.trace.endpoint = self.specification_message.get(MessageFields.ENDPOINT)
+                self.trace.mark(tracing.CONFIGURED)
             self.valid = True
         else:
             self.valid= False
 
     def receipt_receiver_on_message_callback(self, event):
-        receipt_msg = json.loads(event.message.body)
+        receipt_msg = decode_control_message(event.message)
         if MessageFields.RECEIPT in receipt_msg:
-            event.container.stop()
+            self.receipt_receiver.stop()
             if  MessageFields.INTERRUPT in receipt_msg:
                 logging.info("Measurement interrupted.")
             else:
                 if receipt_msg[MessageFields.RECEIPT] == 'store':
                     pass
-                elif self.results_receiver is None:
+                elif not self.receipt_received.is_set():
+                    measurement_id = Ids.calculate_measurement_id(receipt_msg)
+                    if self.trace is not None:
+                        self.trace.mark(tracing.RECEIPT_RECEIVED)
+                        self.trace.measurement_id = measurement_id
+                        self.trace.merge(receipt_msg.get(MessageFields.TRACE))
                     if self.config['redirect_to_storage']:
                         store_capabilities = self.measurement_plane_client.get_capabilities(["store"])
                         store_capability = None
@@ -106,7 +251,6 @@ class Measurement:
                         if store_capability:
                             storage_measurement = self.measurement_plane_client.create_measurement(store_capability)
                             label = self.specification_message[MessageFields.ENDPOINT]
-                            measurement_id = Message.calculate_measurement_id(message = receipt_msg)
                             topic = f'topic://{measurement_id}/results'
                             command = "start"
                             parameters = {
@@ -122,68 +266,211 @@ class Measurement:
                                 parameters=parameters,
                                 result_callback=None,  # Callback function for new results
                             )
-                            self.measurement_plane_client.send_measurement(storage_measurement)                    
-                    measurement_id = Message.calculate_measurement_id(message = receipt_msg)
-                    topic = f'topic://{measurement_id}/results'
-                    #topic = f'topic:///test/results'
-                    self.results_receiver = ReceiverThread(broker_url=self.broker_url, topic = topic, on_message_callback=self.result_receiver_on_message_callback)
-                    self.results_receiver.start()
+                            self.measurement_plane_client.dispatch_measurement(storage_measurement)
+                    self.attach_results(measurement_id)
+            self.receipt_received.set()
 
-    def result_receiver_on_message_callback(self, event):
-        message_body = event.message.body
+    def expects_results(self) -> bool:
+        # Interruptions carry no specification and storage measurements publish nothing
+        specification = self.specification_message.get(MessageFields.SPECIFICATION)
+        return specification is not None and specification != 'store'
 
-        # Convert memoryview to bytes if necessary
-        if isinstance(message_body, memoryview):
-            message_body = message_body.tobytes()
+    def attach_results(self, measurement_id: str, on_attached_callback = None):
+        if self.results_receiver is not None:
+            return
+        self.measurement_id = measurement_id
+        topic = f'topic://{measurement_id}/results'
+        spool = self.measurement_plane_client.spool
+        if spool is not None:
+            self.spool_consumer = spool.consume(measurement_id, self.deliver_results)
+        self.results_receiver = self.measurement_plane_client.receiver_hub.attach(topic, on_message_callback=self.result_receiver_on_message_callback,
+                                                                                  on_attached_callback=on_attached_callback)
 
-        # Try to decode as JSON or fall back to pickle
-        result_msg = None
-        if isinstance(message_body, bytes):
-            # If it's bytes, assume it's pickled binary data
-            try:
-                result_msg = pickle.loads(message_body)
-                logging.info("Successfully received and deserialized the message using pickle.")
-            except pickle.UnpicklingError as e:
-                logging.error(f"Failed to deserialize message with pickle: {e}")
-                result_msg = None
-        else:
-            try:
-                result_msg = json.loads(message_body)
-                logging.info("Successfully received and decoded the message using JSON.")
-            except (UnicodeDecodeError, json.JSONDecodeError, TypeError) as e:
-                logging.error(f"Failed to decode message as JSON: {e}")
-                result_msg = None
+    def result_receiver_on_message_callback(self, event):
+        received_at = time.time() if self.trace is not None else None
+        # Decode according to the content type: JSON, binary frame or legacy pickle
+        try:
+            result_msg = decode_message(event.message)
+        except Exception as e:
+            logging.error(f"Failed to decode result message: {e}")
+            result_msg = None
 
         # Proceed if decoding was successful
         if result_msg and 'result' in result_msg:
-            results = result_msg['resultValues']
-            if 'EOF_results' in results:
-                print("EOF received will stop")
-                self.stop()
-                return
+            values = result_msg['resultValues']
+            # The EOF marker always travels alone; it finishes the trace instead of adding a result to it
+            traced = self.trace is not None and not only_eof(values)
+            decoded_at = time.time() if traced else None
+            if self.spool_consumer is not None:
+                if self.spool_consumer.running:  # a stopped consumer has released the log
+                    self.measurement_plane_client.spool.append(self.measurement_id, values)
+            else:
+                self.deliver_results(values)
+            if traced:
+                self.trace.add_result(result_msg.get(MessageFields.TRACE), received_at, decoded_at, time.time())
+
+    def deliver_results(self, results):
+        # A message may carry a whole batch of values, possibly closed by the EOF marker
+        eof = any(isinstance(value, str) and value == MessageFields.EOF_RESULTS for value in results)
+        if eof:
+            results = [value for value in results if not (isinstance(value, str) and value == MessageFields.EOF_RESULTS)]
+        if results:
             self.config['result_callback'](results)
-            
-    def interrupt(self):
+        if eof:
+            if self.trace is not None:
+                self.trace.mark(tracing.EOF_RECEIVED)
+                self.measurement_plane_client.traces.add(self.trace)
+            print("EOF received will stop")
+            self.stop()
+        
+    def trace_record(self) -> dict:
+        """
+        Latency breakdown of the measurement so far, None when tracing is off.
+        """
+        return self.trace.record() if self.trace is not None else None
+
+    def create_interruption(self) -> 'Measurement':
         interrupt_msg = self.specification_message
         interrupt_msg[MessageFields.CAPABILITY] = interrupt_msg[MessageFields.SPECIFICATION]
-        interruption = Measurement(interrupt_msg, self.measurement_plane_client)
+        interruption = self.measurement_plane_client.create_measurement(interrupt_msg)
         interruption.valid = True
         interrupt_msg = interruption.specification_message
         interrupt_msg[MessageFields.INTERRUPT] = interrupt_msg[MessageFields.SPECIFICATION]
         del interrupt_msg[MessageFields.SPECIFICATION]
         interruption.message = interrupt_msg
-        self.measurement_plane_client.send_measurement(interruption)
+        return interruption
+
+    def interrupt(self):
+        self.measurement_plane_client.send_measurement(self.create_interruption())
         self.stop()
         
     def stop(self):
         print("will close the receiver")
-        self.results_receiver.stop()
-            
+        if self.spool_consumer is not None:
+            self.spool_consumer.stop()
+        if self.results_receiver is not None:
+            self.results_receiver.stop()
+
 
     def validate_parameters(self, parameters: dict) -> bool:
+        if self.capability_id is None:
+            self.capability_id = Ids.calculate_capability_id(self.capability)
         try:
-            validate(instance=parameters, schema=self.capability[MessageFields.PARAMETERS_SCHEMA])
+            self.measurement_plane_client.validators.validate(self.capability_id, self.capability[MessageFields.PARAMETERS_SCHEMA], parameters)
             return True
         except jsonschema_exceptions.ValidationError as err:
             logging.error(f"Validation error: {err.message}")
             return False
+
+class FanOutMeasurement(Measurement):
+    """
+    Measurement sent as part of a FanOut, which it notifies when it ends.
+    """
+    def __init__(self, capability: dict, measurement_plane_client: MeasurementPlaneClient, fan_out: 'FanOut'):
+        super().__init__(capability, measurement_plane_client)
+        self.fan_out = fan_out
+        self.endpoint = capability[MessageFields.ENDPOINT]
+        self.abandoned = False  # no receipt before the deadline, a late one is ignored
+        self.finished = False
+
+    def receipt_receiver_on_message_callback(self, event):
+        with self.fan_out.lock:
+            if not self.abandoned:
+                super().receipt_receiver_on_message_callback(event)
+
+    def stop(self):
+        if self.results_receiver:
+            super().stop()
+        self.fan_out.measurement_finished(self)
+
+class FanOut:
+    """
+    One specification sent to many capabilities. Their results are merged into a single
+    stream of (endpoint, values) pairs, read with results() or passed to result_callback.
+    """
+    def __init__(self, client: MeasurementPlaneClient, capabilities: list, schedule: str, parameters: dict, result_callback = None):
+        self.client = client
+        self.result_callback = result_callback
+        self.result_queue = queue.Queue()
+        self.lock = Lock()
+        self.measurements = []
+        self.invalid = []  # endpoints whose parameter schema rejected the parameters
+        for capability in capabilities:
+            measurement = FanOutMeasurement(capability, client, self)
+            measurement.configure(schedule=schedule, parameters=parameters,
+                                  result_callback=lambda results, endpoint=measurement.endpoint: self.on_results(endpoint, results))
+            if measurement.valid:
+                self.measurements.append(measurement)
+            else:
+                self.invalid.append(measurement.endpoint)
+        self.running = len(self.measurements)
+        if not self.running:
+            self.result_queue.put(_END_OF_RESULTS)
+
+    def dispatch(self, timeout: float = RECEIPT_TIMEOUT):
+        """
+        Sends every specification without waiting in between, then waits for the receipts
+        until one shared deadline. Measurements without a receipt by then are abandoned.
+        """
+        deadline = time.monotonic() + timeout
+        for measurement in self.measurements:
+            self.client.dispatch_measurement(measurement)
+        # Called from a hub callback the reactor is busy with us, so waiting for the receipts would deadlock
+        if self.client.receiver_hub.in_reactor_thread():
+            return
+        for measurement in self.measurements:
+            measurement.receipt_received.wait(max(0, deadline - time.monotonic()))
+        for measurement in self.missing:
+            with self.lock:
+                if measurement.receipt_received.is_set():
+                    continue
+                measurement.abandoned = True
+            logging.warning(f"No receipt received from {measurement.endpoint}")
+            measurement.receipt_receiver.stop()
+            measurement.stop()
+
+    @property
+    def acknowledged(self) -> list:
+        return [measurement.endpoint for measurement in self.measurements if measurement.receipt_received.is_set()]
+
+    @property
+    def missing(self) -> list:
+        return [measurement for measurement in self.measurements if not measurement.receipt_received.is_set()]
+
+    def on_results(self, endpoint: str, results: list):
+        # Runs on the receiver hub thread, or the spool consumer thread when spooling
+        self.result_queue.put((endpoint, results))
+        if self.result_callback:
+            self.result_callback(endpoint, results)
+
+    def measurement_finished(self, measurement: FanOutMeasurement):
+        with self.lock:
+            if measurement.finished:
+                return
+            measurement.finished = True
+            self.running -= 1
+            if self.running == 0:
+                self.result_queue.put(_END_OF_RESULTS)
+
+    def results(self, timeout: float = None):
+        """
+        Yields (endpoint, values) until every measurement has ended, or until no result
+        arrived for timeout seconds.
+        """
+        while True:
+            try:
+                item = self.result_queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if item is _END_OF_RESULTS:
+                return
+            yield item
+
+    def interrupt(self):
+        """
+        Interrupts every acknowledged measurement without waiting for the interruption receipts.
+        """
+        for measurement in self.measurements:
+            if measurement.receipt_received.is_set() and not measurement.finished:
+                self.client.dispatch_measurement(measurement.create_interruption())
+                measurement.stop()
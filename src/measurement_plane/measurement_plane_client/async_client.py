@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from measurement_plane.measurement_plane_client.MP_client import MeasurementPlaneClient, Measurement, RECEIPT_TIMEOUT
+
+_END_OF_RESULTS = object()
+
+class AsyncMeasurementPlaneClient(MeasurementPlaneClient):
+    """
+    asyncio front end of MeasurementPlaneClient. Receipts and results are handed from
+    the receiver hub thread to the event loop, so no coroutine ever blocks on them.
+    """
+    def create_measurement(self, capability: dict) -> 'AsyncMeasurement':
+        return AsyncMeasurement(capability, self)
+
+    async def send_measurement(self, measurement: 'AsyncMeasurement', timeout: float = RECEIPT_TIMEOUT) -> bool:
+        """
+        Sends the measurement and returns True once its receipt arrives, False on timeout.
+        """
+        if not measurement.valid:
+            logging.error("Measurement not valid for sending")
+            return False
+        measurement.bind(asyncio.get_running_loop())
+        self.dispatch_measurement(measurement)
+        try:
+            await asyncio.wait_for(asyncio.shield(measurement.receipt_future), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("No receipt received for measurement")
+            measurement.receipt_receiver.stop()
+            measurement.stop()
+            return False
+        logging.info("Measurement sent")
+        return True
+
+    async def interrupt_measurement(self, measurement: 'AsyncMeasurement'):
+        await measurement.interrupt()
+
+class AsyncMeasurement(Measurement):
+    def __init__(self, capability: dict, measurement_plane_client: AsyncMeasurementPlaneClient):
+        super().__init__(capability, measurement_plane_client)
+        del self.results  # the unused results list would shadow the results() iterator
+        self.loop = None
+        self.receipt_future = None
+        self.result_queue = None
+
+    def configure(self, schedule: dict, parameters: dict, result_callback = None, stream_results: bool = False, redirect_to_storage: bool = False, completion_callback = None) -> bool:
+        super().configure(schedule, parameters, self.on_results, stream_results, redirect_to_storage, completion_callback)
+        if self.valid:
+            self.config["user_result_callback"] = result_callback
+        return self.valid
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.receipt_future = loop.create_future()
+        if self.result_queue is None:
+            self.result_queue = asyncio.Queue()
+
+    def receipt_receiver_on_message_callback(self, event):
+        super().receipt_receiver_on_message_callback(event)
+        if self.receipt_received.is_set():
+            self.loop.call_soon_threadsafe(self._resolve_receipt)
+
+    def _resolve_receipt(self):
+        if not self.receipt_future.done():
+            self.receipt_future.set_result(True)
+
+    def on_results(self, results):
+        # Runs on the receiver hub thread, or the spool consumer thread when spooling
+        self.loop.call_soon_threadsafe(self.result_queue.put_nowait, results)
+        if self.config.get("user_result_callback"):
+            self.config["user_result_callback"](results)
+
+    async def results(self):
+        """
+        Yields each batch of result values until the measurement ends.
+        """
+        while True:
+            batch = await self.result_queue.get()
+            if batch is _END_OF_RESULTS:
+                return
+            yield batch
+
+    async def interrupt(self):
+        await self.measurement_plane_client.send_measurement(self.create_interruption())
+        self.stop()
+
+    def stop(self):
+        if self.results_receiver:
+            super().stop()
+        if self.loop and self.result_queue is not None:
+            self.loop.call_soon_threadsafe(self.result_queue.put_nowait, _END_OF_RESULTS)
@@ -1,83 +1,285 @@
 import time
+import heapq
+import itertools
 import threading
-import json
+from types import MappingProxyType
 from measurement_plane.messaging.message import Message
 import logging
 from measurement_plane.protocols.amqp.receive import ReceiverThread
 from measurement_plane.protocols.amqp.send import Sender
-from measurement_plane.messaging.message_format import Topics
+from measurement_plane.protocols.amqp.encoding import decode_control_message
+from measurement_plane.messaging.message_format import Topics, MessageFields
+from measurement_plane.utils import metrics
+from measurement_plane.utils.validation import ValidatorCache
 
 CAPABILITY_TIMEOUT = 60
-CLEANUP_INTERVAL = 10
+ADVERTISEMENT_REQUEST_INTERVAL = 5  # seconds before asking the same agent again
+
+ADVERTISEMENTS_RECEIVED = metrics.counter('mp_advertisements_total', 'Capability messages received by clients', kind='advertisement')
+HEARTBEATS_RECEIVED = metrics.counter('mp_advertisements_total', 'Capability messages received by clients', kind='heartbeat')
+LEGACY_CAPABILITIES_RECEIVED = metrics.counter('mp_advertisements_total', 'Capability messages received by clients', kind='capability')
+ADVERTISEMENTS_REQUESTED = metrics.counter('mp_advertisement_requests_total', 'Full advertisements requested after an unknown heartbeat')
+CAPABILITIES_EXPIRED = metrics.counter('mp_capabilities_expired_total', 'Capabilities removed after their timeout')
 
 # Configure logging
 #logging.basicConfig(level=logging.INFO)  # Set the desired logging level
 
+class CapabilitySnapshot:
+    """
+    Immutable view of the registry. Writers replace the whole snapshot, so readers
+    never take a lock.
+    """
+    def __init__(self, capabilities : dict, by_type : dict, by_endpoint : dict, by_name : dict):
+        self.capabilities = MappingProxyType(capabilities)
+        # Secondary indexes: key -> frozenset of capability ids
+        self.by_type = MappingProxyType(by_type)
+        self.by_endpoint = MappingProxyType(by_endpoint)
+        self.by_name = MappingProxyType(by_name)
+
+    @staticmethod
+    def index_keys(capability_msg) -> tuple:
+        return (capability_msg.get(MessageFields.CAPABILITY), capability_msg.get(MessageFields.ENDPOINT),
+                capability_msg.get(MessageFields.CAPABILITY_NAME))
+
+    def apply(self, added : dict, removed) -> 'CapabilitySnapshot':
+        """
+        Returns a new snapshot with added (id -> message) put in and removed ids taken out.
+        """
+        capabilities = dict(self.capabilities)
+        indexes = (dict(self.by_type), dict(self.by_endpoint), dict(self.by_name))
+        touched = {}  # (index position, key) -> mutable copy of that index entry
+
+        def entry(position, key):
+            if (position, key) not in touched:
+                touched[(position, key)] = set(indexes[position].get(key, ()))
+            return touched[(position, key)]
+
+        for capability_id in removed:
+            capability_msg = capabilities.pop(capability_id, None)
+            if capability_msg is not None:
+                for position, key in enumerate(self.index_keys(capability_msg)):
+                    entry(position, key).discard(capability_id)
+        for capability_id, capability_msg in added.items():
+            previous = capabilities.get(capability_id)
+            if previous is not None:
+                for position, key in enumerate(self.index_keys(previous)):
+                    entry(position, key).discard(capability_id)
+            capabilities[capability_id] = capability_msg
+            for position, key in enumerate(self.index_keys(capability_msg)):
+                entry(position, key).add(capability_id)
+
+        for (position, key), capability_ids in touched.items():
+            if capability_ids:
+                indexes[position][key] = frozenset(capability_ids)
+            else:
+                indexes[position].pop(key, None)
+        return CapabilitySnapshot(capabilities, *indexes)
+
+_manager_ids = itertools.count(1)
+
 class CapabilitiesManager:
-    def __init__(self, timeout, cleanup_interval):
-        self.capabilities = {}
-        self.last_update = {}
+    """
+    Registry of advertised capabilities indexed by type, endpoint and name. Capabilities
+    expire timeout seconds after their last advertisement or heartbeat; a deadline heap
+    wakes the cleanup thread only when the earliest one is due.
+    """
+    def __init__(self, timeout, *, validators : ValidatorCache = None, name : str = None):
+        self.validators = validators
+        self.snapshot = CapabilitySnapshot({}, {}, {}, {})
+        self.last_update = {}  # capability_id -> monotonic time of the last refresh
+        self.deadlines = []  # heap of (deadline, capability_id)
+        self.scheduled = set()  # ids with an entry in deadlines, so each has at most one
+        self.endpoint_hashes = {}  # endpoint -> hash of its last full advertisement
         self.timeout = timeout
-        self.cleanup_interval = cleanup_interval
         self.lock = threading.Lock()
-        
-        # Start the thread to periodically remove stale capabilities
+        self.condition = threading.Condition(self.lock)
+        self.closed = False
+        # Labelled per manager, weakly owned, and unregistered by close()
+        self.capabilities_gauge = metrics.gauge('mp_capabilities', 'Capabilities in the registry', lambda manager: len(manager.snapshot.capabilities),
+                                                owner=self, manager=name or str(next(_manager_ids)))
+
+        # Start the thread to remove capabilities whose deadline has passed
         self.cleanup_thread = threading.Thread(target=self._run_cleanup, daemon=True)
         self.cleanup_thread.start()
 
-    def add_capability(self, capability_id, capability_msg):        
+    @property
+    def capabilities(self):
+        return self.snapshot.capabilities
+
+    def _refresh(self, capability_ids, current_time):
+        # Called with the lock held. Refreshed ids keep their heap entry and are
+        # rescheduled lazily when it comes due.
+        was_idle = not self.deadlines
+        for capability_id in capability_ids:
+            if capability_id not in self.scheduled:
+                self.scheduled.add(capability_id)
+                heapq.heappush(self.deadlines, (current_time + self.timeout, capability_id))
+            self.last_update[capability_id] = current_time
+        # New deadlines are never earlier than existing ones, so only an idle thread needs waking
+        if was_idle:
+            self.condition.notify()
+
+    def _invalidate(self, capability_ids):
+        if self.validators is not None:
+            for capability_id in capability_ids:
+                self.validators.invalidate(capability_id)
+
+    def _forget_endpoints(self, snapshot : CapabilitySnapshot):
+        for endpoint in [endpoint for endpoint in self.endpoint_hashes if endpoint not in snapshot.by_endpoint]:
+            del self.endpoint_hashes[endpoint]
+
+    def add_capability(self, capability_id, capability_msg):
+        LEGACY_CAPABILITIES_RECEIVED.inc()
+        with self.lock:
+            self.snapshot = self.snapshot.apply({capability_id: capability_msg}, ())
+            self._refresh([capability_id], time.monotonic())
+
+    def add_advertisement(self, endpoint, capability_msgs, advertisement_hash):
+        """
+        Replaces everything known about endpoint with the capabilities of its advertisement.
+        """
+        ADVERTISEMENTS_RECEIVED.inc()
+        advertised = {Message.calculate_capability_id(message=capability_msg): capability_msg for capability_msg in capability_msgs}
         with self.lock:
-            if capability_id not in self.capabilities:
-                self.capabilities[capability_id] = {}
+            withdrawn = self.snapshot.by_endpoint.get(endpoint, frozenset()) - advertised.keys()
+            for capability_id in withdrawn:
+                self.last_update.pop(capability_id, None)
+            self._invalidate(withdrawn)
+            self.snapshot = self.snapshot.apply(advertised, withdrawn)
+            self._refresh(advertised, time.monotonic())
+            self.endpoint_hashes[endpoint] = advertisement_hash
 
-            # Add the capability to the dictionary using its ID
-            self.capabilities[capability_id] = capability_msg
-            
-            # Update the last update time
-            self.last_update[capability_id] = time.time()
+    def refresh_advertisement(self, endpoint, advertisement_hash) -> bool:
+        """
+        Refreshes the capabilities of endpoint from a heartbeat. Returns False when the hash
+        does not match the last full advertisement, which then has to be requested.
+        """
+        HEARTBEATS_RECEIVED.inc()
+        with self.lock:
+            if self.endpoint_hashes.get(endpoint) != advertisement_hash:
+                return False
+            self._refresh(self.snapshot.by_endpoint.get(endpoint, ()), time.monotonic())
+            return True
 
     def remove_stale_capabilities(self):
-        current_time = time.time()
+        """
+        Removes capabilities whose deadline has passed and returns the number of seconds
+        until the next deadline, or None when nothing is registered. Expects the lock held.
+        """
+        current_time = time.monotonic()
         ids_to_remove = []
-        
-        with self.lock:
-            for endpoint, last_time in self.last_update.items():
-                if current_time - last_time > self.timeout:
-                    ids_to_remove.append(endpoint)
-            
-            for endpoint in ids_to_remove:
-                del self.capabilities[endpoint]
-                del self.last_update[endpoint]
+        while self.deadlines and self.deadlines[0][0] <= current_time:
+            _, capability_id = heapq.heappop(self.deadlines)
+            last_time = self.last_update.get(capability_id)
+            if last_time is None:
+                self.scheduled.discard(capability_id)  # withdrawn by its agent since it was scheduled
+                continue
+            if current_time - last_time >= self.timeout:
+                del self.last_update[capability_id]
+                self.scheduled.discard(capability_id)
+                ids_to_remove.append(capability_id)
+            else:
+                heapq.heappush(self.deadlines, (last_time + self.timeout, capability_id))
+
+        if ids_to_remove:
+            CAPABILITIES_EXPIRED.inc(len(ids_to_remove))
+            self._invalidate(ids_to_remove)
+            self.snapshot = self.snapshot.apply({}, ids_to_remove)
+            self._forget_endpoints(self.snapshot)
+        return self.deadlines[0][0] - current_time if self.deadlines else None
 
     def _run_cleanup(self):
-        while True:
-            self.remove_stale_capabilities()
-            time.sleep(self.cleanup_interval)
+        with self.condition:
+            while not self.closed:
+                self.condition.wait(self.remove_stale_capabilities())
 
+    def close(self):
+        """
+        Stops the cleanup thread and unregisters the gauge.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        metrics.unregister(self.capabilities_gauge)
 
     def get_capability(self, capability_id):
-        return self.capabilities.get(capability_id)
+        return self.snapshot.capabilities.get(capability_id)
+
+    def get_capabilities(self, capability_types : list = None, endpoint = None, name = None) -> dict:
+        """
+        Returns a new dict of the capabilities matching every given filter.
+        """
+        snapshot = self.snapshot
+        candidates = [index.get(key, frozenset()) for index, key in ((snapshot.by_endpoint, endpoint), (snapshot.by_name, name)) if key is not None]
+        if capability_types is not None:
+            if candidates:
+                # Cheaper to check the type of the few endpoint/name matches than to union whole type sets
+                candidates.append({capability_id for capability_id in min(candidates, key=len)
+                                   if snapshot.capabilities[capability_id].get(MessageFields.CAPABILITY) in capability_types})
+            else:
+                candidates.append(frozenset().union(*(snapshot.by_type.get(capability_type, ()) for capability_type in capability_types)))
+        capability_ids = frozenset.intersection(*map(frozenset, candidates)) if candidates else None
+        if capability_ids is None:
+            return dict(snapshot.capabilities)
+        return {capability_id: snapshot.capabilities[capability_id] for capability_id in capability_ids}
 
 
 
 class Broker():
-    def __init__(self, broker_url):
+    def __init__(self, broker_url, receiver_hub = None, validators : ValidatorCache = None):
         self.broker_url = broker_url
-        self.capability_manager = CapabilitiesManager(CAPABILITY_TIMEOUT, CLEANUP_INTERVAL)
+        self.receiver_hub = receiver_hub
+        self.capability_manager = CapabilitiesManager(CAPABILITY_TIMEOUT, validators=validators)
         self.sender = Sender()
+        self.advertisement_requests = {}  # endpoint -> time of the last full advertisement request
+        self.receiver_capabilities = None
+
     def start(self):
-        self.receiver_capabilities = ReceiverThread(broker_url=self.broker_url, topic=Topics.CAPABILITIES_TOPIC, on_message_callback=self.receiver_capabilities_on_message_callback)
-        self.receiver_capabilities.start()
+        if self.receiver_hub:
+            self.receiver_capabilities = self.receiver_hub.attach(Topics.CAPABILITIES_TOPIC, on_message_callback=self.receiver_capabilities_on_message_callback)
+        else:
+            self.receiver_capabilities = ReceiverThread(broker_url=self.broker_url, topic=Topics.CAPABILITIES_TOPIC, on_message_callback=self.receiver_capabilities_on_message_callback)
+            self.receiver_capabilities.start()
+
+    def stop(self):
+        if self.receiver_capabilities is not None:
+            self.receiver_capabilities.stop()
+            self.receiver_capabilities = None
+        self.capability_manager.close()
 
     def receiver_capabilities_on_message_callback(self, event):
         try:
-            message =json.loads(event.message.body)
-            capability_id = Message.calculate_capability_id(message=message)
-            capability = message
-            logging.info(f"recived capability: {capability}")
-            self.capability_manager.add_capability(capability_id, capability)
+            message = decode_control_message(event.message)
+            if MessageFields.ADVERTISEMENT in message:
+                self.capability_manager.add_advertisement(message[MessageFields.ENDPOINT], message[MessageFields.ADVERTISEMENT],
+                                                          message[MessageFields.ADVERTISEMENT_HASH])
+            elif MessageFields.HEARTBEAT in message:
+                endpoint = message[MessageFields.ENDPOINT]
+                if not self.capability_manager.refresh_advertisement(endpoint, message[MessageFields.HEARTBEAT]):
+                    self.request_advertisement(endpoint)
+            else:
+                # Single capability, as advertised by older agents
+                capability_id = Message.calculate_capability_id(message=message)
+                capability = message
+                logging.info(f"recived capability: {capability}")
+                self.capability_manager.add_capability(capability_id, capability)
         except Exception as e:
             logging.error(f"Error processing message: {e}")
-    
 
+    def request_advertisement(self, endpoint):
+        current_time = time.time()
+        if current_time - self.advertisement_requests.get(endpoint, 0) < ADVERTISEMENT_REQUEST_INTERVAL:
+            return
+        self.advertisement_requests[endpoint] = current_time
+        ADVERTISEMENTS_REQUESTED.inc()
+        logging.info(f"Unknown advertisement hash, requesting capabilities of {endpoint}")
+        topic = Topics.get_specifications_topic(endpoint)
+        message = {MessageFields.ENDPOINT: endpoint, MessageFields.ADVERTISEMENT_REQUEST: True}
+
+        def log_send_error(future):
+            if future.exception():
+                logging.error(f"Error requesting advertisement: {future.exception()}")
 
+        # Called on the receiver thread, so the send must not block it
+        future = self.sender.send_async(self.broker_url, topic, message)
+        future.add_done_callback(log_send_error)
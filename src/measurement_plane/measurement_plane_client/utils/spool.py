@@ -0,0 +1,349 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+import pickle
+import bisect
+import shutil
+import logging
+import threading
+from measurement_plane.messaging.message_format import MessageFields
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+RETENTION_BYTES = 1024 * 1024 * 1024  # per measurement log and across the spool, oldest data is deleted first
+SEGMENT_SUFFIX = '.log'
+CONSUMER_SUFFIX = '.offset'
+DEFAULT_CONSUMER = 'client'
+CONSUMER_POLL_INTERVAL = 0.5
+
+RECORD_HEADER = struct.Struct('>II')  # payload length, crc32 of the payload
+OFFSET_FORMAT = struct.Struct('>Q')
+
+class SpoolSegment:
+    """
+    Memory-mapped, preallocated file of records starting at base_offset. A record's
+    header is written after its payload, so a torn write reads back as the end of
+    the segment. A file shorter than size, trimmed by close(), is extended again.
+    """
+    def __init__(self, path : str, base_offset : int, size : int):
+        self.path = path
+        self.base_offset = base_offset
+        new = not os.path.exists(path)
+        self.file = open(path, 'w+b' if new else 'r+b')
+        if os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.positions = []  # start of each record within the segment
+        self.end = 0
+        self.recover()
+
+    def recover(self):
+        while self.end + RECORD_HEADER.size <= self.size:
+            length, crc = RECORD_HEADER.unpack_from(self.map, self.end)
+            start = self.end + RECORD_HEADER.size
+            if length == 0 or start + length > self.size or zlib.crc32(self.map[start:start + length]) != crc:
+                break
+            self.positions.append(self.end)
+            self.end = start + length
+
+    @property
+    def next_offset(self) -> int:
+        return self.base_offset + len(self.positions)
+
+    def append(self, payload : bytes) -> bool:
+        start = self.end + RECORD_HEADER.size
+        if start + len(payload) > self.size:
+            return False
+        self.map[start:start + len(payload)] = payload
+        RECORD_HEADER.pack_into(self.map, self.end, len(payload), zlib.crc32(payload))
+        self.positions.append(self.end)
+        self.end = start + len(payload)
+        return True
+
+    def read(self, offset : int) -> bytes:
+        position = self.positions[offset - self.base_offset]
+        length, _ = RECORD_HEADER.unpack_from(self.map, position)
+        start = position + RECORD_HEADER.size
+        return self.map[start:start + length]
+
+    def close(self, trim : bool = False):
+        """
+        Closes the segment; with trim, the unwritten preallocated space is given back.
+        """
+        self.map.flush()
+        self.map.close()
+        if trim:
+            written = os.stat(self.path)
+            self.file.truncate(self.end)
+            os.utime(self.path, ns=(written.st_atime_ns, written.st_mtime_ns))  # still dated for retention_seconds
+        self.file.close()
+
+class SpoolLog:
+    """
+    Append-only log of the result batches of one measurement, split into segments
+    named after the offset of their first record.
+    """
+    def __init__(self, directory : str, segment_size : int = SEGMENT_SIZE, retention_bytes : int = RETENTION_BYTES, retention_seconds : float = None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.condition = threading.Condition()
+        self.consumer_offsets = {}  # consumer name -> (file, mmap) holding its committed offset
+        os.makedirs(directory, exist_ok=True)
+        base_offsets = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+        # Only the last segment is written to, and extended again if it was trimmed
+        self.segments = [SpoolSegment(self.segment_path(base_offset), base_offset, self.segment_size if base_offset == base_offsets[-1] else 0)
+                         for base_offset in base_offsets]
+        if not self.segments:
+            self.segments.append(SpoolSegment(self.segment_path(0), 0, self.segment_size))
+
+    def segment_path(self, base_offset : int) -> str:
+        return os.path.join(self.directory, f"{base_offset:020d}{SEGMENT_SUFFIX}")
+
+    @property
+    def first_offset(self) -> int:
+        return self.segments[0].base_offset
+
+    @property
+    def next_offset(self) -> int:
+        return self.segments[-1].next_offset
+
+    def append(self, values) -> int:
+        """
+        Appends one batch of result values and returns its offset.
+        """
+        payload = pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.condition:
+            offset = self.next_offset
+            if not self.segments[-1].append(payload):
+                self.segments[-1].map.flush()  # also dates the segment for retention_seconds
+                segment = SpoolSegment(self.segment_path(offset), offset, max(self.segment_size, RECORD_HEADER.size + len(payload)))
+                self.segments.append(segment)
+                segment.append(payload)
+                self.apply_retention()
+            self.condition.notify_all()
+        return offset
+
+    def apply_retention(self):
+        # Called with the lock held, never deletes the segment being written
+        now = time.time()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            total = sum(segment.end for segment in self.segments)  # bytes written, segments are preallocated
+            expired = self.retention_seconds is not None and now - os.path.getmtime(oldest.path) > self.retention_seconds
+            if total <= self.retention_bytes and not expired:
+                break
+            self.segments.pop(0)
+            oldest.close()
+            os.remove(oldest.path)
+
+    def read(self, offset : int):
+        with self.condition:
+            if offset < self.first_offset or offset >= self.next_offset:
+                raise IndexError(f"Offset {offset} is not in the spool")
+            index = bisect.bisect_right([segment.base_offset for segment in self.segments], offset) - 1
+            payload = bytes(self.segments[index].read(offset))
+        return pickle.loads(payload)
+
+    def records(self, start : int = 0, end : int = None):
+        """
+        Yields (offset, values) from start up to end (exclusive), or up to the last
+        record appended so far. Offsets already removed by retention are skipped.
+        """
+        offset = max(start, self.first_offset)
+        while end is None or offset < end:
+            if offset < self.first_offset:
+                offset = self.first_offset
+            if offset >= self.next_offset:
+                return
+            yield offset, self.read(offset)
+            offset += 1
+
+    def wait(self, offset : int, timeout : float = None) -> bool:
+        """
+        Waits until the record at offset has been appended.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.next_offset > offset, timeout)
+
+    def committed(self, consumer : str) -> int:
+        with self.condition:
+            return OFFSET_FORMAT.unpack_from(self.consumer_map(consumer), 0)[0]
+
+    def commit(self, consumer : str, offset : int):
+        with self.condition:
+            OFFSET_FORMAT.pack_into(self.consumer_map(consumer), 0, offset)
+
+    def consumer_map(self, consumer : str) -> mmap.mmap:
+        if consumer not in self.consumer_offsets:
+            path = os.path.join(self.directory, f"{consumer}{CONSUMER_SUFFIX}")
+            new = not os.path.exists(path)
+            offset_file = open(path, 'w+b' if new else 'r+b')
+            if new:
+                offset_file.truncate(OFFSET_FORMAT.size)
+            self.consumer_offsets[consumer] = (offset_file, mmap.mmap(offset_file.fileno(), OFFSET_FORMAT.size))
+        return self.consumer_offsets[consumer][1]
+
+    @property
+    def size(self) -> int:
+        """
+        Bytes written to the segments.
+        """
+        with self.condition:
+            return sum(segment.end for segment in self.segments)
+
+    def close(self):
+        # Trimmed, so a closed log takes on disk only what was written to it
+        with self.condition:
+            for segment in self.segments:
+                segment.close(trim=True)
+            for offset_file, offset_map in self.consumer_offsets.values():
+                offset_map.close()
+                offset_file.close()
+            self.consumer_offsets = {}
+
+def is_eof(values) -> bool:
+    return isinstance(values, list) and any(isinstance(value, str) and value == MessageFields.EOF_RESULTS for value in values)
+
+class SpoolConsumer:
+    """
+    Thread handing the records of a log to callback, starting after the offset the
+    named consumer last committed, so a restarted client resumes where it stopped.
+    It stops by itself after the batch carrying the EOF marker, with finished set.
+    on_stopped is called from the thread once it has stopped reading the log.
+    """
+    def __init__(self, log : SpoolLog, callback, name : str = DEFAULT_CONSUMER, on_stopped = None):
+        self.log = log
+        self.callback = callback
+        self.name = name
+        self.on_stopped = on_stopped
+        self.running = False
+        self.finished = False  # the EOF marker has been handed over and committed
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        try:
+            self.consume()
+        finally:
+            if self.on_stopped:
+                self.on_stopped()
+
+    def consume(self):
+        offset = self.log.committed(self.name)
+        while self.running:
+            if not self.log.wait(offset, CONSUMER_POLL_INTERVAL):
+                continue
+            if offset < self.log.first_offset:
+                logging.warning(f"Spool records before offset {self.log.first_offset} were removed by retention")
+            for offset, values in self.log.records(offset):
+                try:
+                    self.callback(values)
+                except Exception as e:
+                    logging.exception(f"Spool consumer callback failed: {e}")
+                self.log.commit(self.name, offset + 1)
+                if is_eof(values):
+                    self.finished = True
+                    self.running = False
+                if not self.running:
+                    break
+            offset = self.log.committed(self.name)
+
+class ResultSpool:
+    """
+    Local spool of received results, one SpoolLog per measurement_id under directory.
+    The receiver only appends; consumers read at their own pace and can replay ranges.
+    A log stays open until its consumer stops, and is deleted once its consumer has
+    committed the EOF marker. retention_bytes bounds each log and the whole spool,
+    where the least recently written closed logs are deleted first.
+    """
+    def __init__(self, directory : str, segment_size : int = SEGMENT_SIZE, retention_bytes : int = RETENTION_BYTES, retention_seconds : float = None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.logs = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def log(self, measurement_id : str) -> SpoolLog:
+        with self.lock:
+            return self.open_log(measurement_id)
+
+    def open_log(self, measurement_id : str) -> SpoolLog:
+        # Called with the lock held
+        log = self.logs.get(measurement_id)
+        if log is None:
+            log = SpoolLog(os.path.join(self.directory, measurement_id), self.segment_size, self.retention_bytes, self.retention_seconds)
+            self.logs[measurement_id] = log
+            self.apply_retention()
+        return log
+
+    def release(self, measurement_id : str, log : SpoolLog = None, delete : bool = False):
+        """
+        Closes the log of measurement_id and forgets it; with delete its files are
+        removed too, otherwise they stay on disk. With log, only that instance is released.
+        """
+        with self.lock:
+            if log is not None and self.logs.get(measurement_id) is not log:
+                return
+            log = self.logs.pop(measurement_id, None)
+            if log is not None:
+                log.close()
+            if delete:
+                shutil.rmtree(os.path.join(self.directory, measurement_id), ignore_errors=True)
+            self.apply_retention()
+
+    def apply_retention(self):
+        # Called with the lock held; open logs are bounded by their own retention
+        total = 0
+        closed = {}  # measurement_id -> (last write, size) of the logs that are not open
+        for measurement_id in self.measurement_ids():
+            log = self.logs.get(measurement_id)
+            if log is not None:
+                total += log.size
+                continue
+            segments = [entry.stat() for entry in os.scandir(os.path.join(self.directory, measurement_id)) if entry.name.endswith(SEGMENT_SUFFIX)]
+            closed[measurement_id] = (max((segment.st_mtime for segment in segments), default=0), sum(segment.st_size for segment in segments))
+            total += closed[measurement_id][1]
+        for measurement_id in sorted(closed, key=lambda measurement_id: closed[measurement_id][0]):
+            if total <= self.retention_bytes:
+                break
+            logging.warning(f"Spool over {self.retention_bytes} bytes, deleting the log of measurement {measurement_id}")
+            shutil.rmtree(os.path.join(self.directory, measurement_id), ignore_errors=True)
+            total -= closed[measurement_id][1]
+
+    def measurement_ids(self) -> list:
+        """
+        Measurements with a log in the spool, including those left by a previous run.
+        """
+        return sorted(name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name)))
+
+    def append(self, measurement_id : str, values) -> int:
+        # Under the lock, so a log is never released in the middle of an append
+        with self.lock:
+            return self.open_log(measurement_id).append(values)
+
+    def replay(self, measurement_id : str, start : int = 0, end : int = None):
+        return self.log(measurement_id).records(start, end)
+
+    def consume(self, measurement_id : str, callback, name : str = DEFAULT_CONSUMER) -> SpoolConsumer:
+        log = self.log(measurement_id)
+        consumer = SpoolConsumer(log, callback, name, on_stopped=lambda: self.release(measurement_id, log, delete=consumer.finished))
+        consumer.start()
+        return consumer
+
+    def close(self):
+        with self.lock:
+            for log in self.logs.values():
+                log.close()
+            self.logs = {}
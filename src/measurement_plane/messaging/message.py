@@ -1,6 +1,7 @@
-from measurement_plane.messaging.message_format import MessageFields
+from measurement_plane.messaging.message_format import MessageFields, Ids, Topics
 from datetime import datetime
-import hashlib
+import json
+import time
 
 class Message:
     def __init__(self) -> None:
@@ -19,46 +20,18 @@ class Message:
             MessageFields.METADATA: None
         }
     
+    # Kept for existing callers; the ids follow the digest configured on Ids
     @staticmethod
     def calculate_capability_id(message):
-        try:
-            endpoint = message["endpoint"]
-            capability_name = message["capabilityName"]
-            combined_string = Message.combine_to_string([endpoint, capability_name])
-            capability_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return capability_id
-        except KeyError as e:
-            raise KeyError(f"Missing required field: {e}")
-        except Exception as e:
-            raise Exception(f"An error occurred while calculating capability ID: {e}")
+        return Ids.calculate_capability_id(message)
 
     @staticmethod
     def calculate_measurement_id(message):
-        try:
-            capability_id = Message.calculate_capability_id(message)
-            parameters = message["parameters"]
-            schedule = message["schedule"]
-            combined_string = Message.combine_to_string([capability_id, parameters, schedule])
-            measurement_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return measurement_id
-        except KeyError as e:
-            raise KeyError(f"Missing required field: {e}")
-        except Exception as e:
-            raise Exception(f"An error occurred while calculating measurement ID: {e}")
+        return Ids.calculate_measurement_id(message)
 
     @staticmethod
     def calculate_operation_id(message):
-        try:
-            measurement_id = Message.calculate_measurement_id(message)
-            nonce = message["nonce"]
-            timestamp = message["timestamp"]
-            combined_string = Message.combine_to_string([measurement_id, nonce, timestamp])
-            operation_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return operation_id
-        except KeyError as e:
-            raise KeyError(f"Missing required field: {e}")
-        except Exception as e:
-            raise Exception(f"An error occurred while calculating operation ID: {e}")
+        return Ids.calculate_operation_id(message)
 
     @staticmethod
     def combine_to_string(attributes: list) -> str:
@@ -84,3 +57,49 @@ class CapabilityMessage(Message):
         self.message[MessageFields.METADATA] = metadata
         self.message[MessageFields.CAPABILITY] = type
 
+class ResultEnvelope:
+    """
+    Result message of one measurement. The fields copied from the specification are
+    JSON-encoded once, so each result only encodes its timestamp and values.
+    """
+    def __init__(self, specification_msg: dict, measurement_id: str):
+        fields = dict(specification_msg)
+        fields[MessageFields.RESULT] = fields.pop(MessageFields.SPECIFICATION)
+        fields.pop(MessageFields.TIMESTAMP, None)
+        fields.pop(MessageFields.RESULT_VALUES, None)
+        fields.pop(MessageFields.TRACE, None)  # results carry the agent's trace stages instead, per message
+        self.fields = fields
+        self.topic = Topics.get_results_topic(str(measurement_id))
+        static = json.dumps(fields)
+        self.prefix = static[:-1] + (', ' if fields else '') + f'"{MessageFields.TIMESTAMP}": "'
+        self.separator = f'", "{MessageFields.RESULT_VALUES}": '
+        # Cleared once values fail to encode as JSON (ndarrays, bytes), as they likely will again
+        self.json_values = True
+        self.clock = (None, None)  # (second, its formatted text), replaced as one tuple so threads never see half of it
+
+    def timestamp(self) -> str:
+        # Same format as datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4], formatted once per second
+        now = time.time()
+        second = int(now)
+        clock_second, text = self.clock
+        if clock_second != second:
+            text = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            self.clock = (second, text)
+        return f"{text}.{int((now - second) * 100):02d}"
+
+    def message(self, result_values: list, trace: dict = None) -> dict:
+        result_msg = dict(self.fields)
+        result_msg[MessageFields.TIMESTAMP] = self.timestamp()
+        result_msg[MessageFields.RESULT_VALUES] = result_values
+        if trace is not None:
+            result_msg[MessageFields.TRACE] = trace
+        return result_msg
+
+    def encode(self, result_values: list, trace: dict = None) -> str:
+        """
+        Returns the JSON result message, raising TypeError when the values are not JSON serializable.
+        """
+        body = self.prefix + self.timestamp() + self.separator + json.dumps(result_values)
+        if trace is not None:
+            body += f', "{MessageFields.TRACE}": ' + json.dumps(trace)
+        return body + '}'
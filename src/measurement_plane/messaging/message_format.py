@@ -1,4 +1,5 @@
 import hashlib
+import json
 
 class Topics:
     CAPABILITIES_TOPIC = 'topic:///capabilities'
@@ -11,6 +12,10 @@ class Topics:
     def get_results_topic(measurement_id: str) -> str:
         return f'topic://{measurement_id}/results'
 
+    @staticmethod
+    def get_profiles_topic(endpoint: str) -> str:
+        return f'topic://{endpoint}/profiles'
+
 class MessageFields:
     LABEL = 'label'
     ENDPOINT = 'endpoint'
@@ -29,6 +34,14 @@ class MessageFields:
     RESULT_VALUES = 'resultValues'
     RECEIPT = 'receipt'
     EOF_RESULTS = 'EOF_results'
+    ADVERTISEMENT = 'advertisement'
+    ADVERTISEMENT_HASH = 'advertisementHash'
+    HEARTBEAT = 'heartbeat'
+    ADVERTISEMENT_REQUEST = 'advertisementRequest'
+    TRACE = 'trace'
+    PROFILE = 'profile'
+    PROFILE_REPORT = 'profileReport'
+    REPLY_TO = 'replyTo'
 
 from datetime import datetime, timedelta
 import re
@@ -82,47 +95,107 @@ class TaskSchedule:
     
 
 
+LEGACY_DIGEST = 'legacy'  # sha256 of the fields' str() with whitespace removed, as all existing peers compute it
+SHA256_DIGEST = 'sha256'
+BLAKE2B_DIGEST = 'blake2b'
+ID_DIGESTS = (LEGACY_DIGEST, SHA256_DIGEST, BLAKE2B_DIGEST)
+
+class MessageIds:
+    """
+    Capability, measurement and operation ids of a message. Each is computed on first
+    use and reused, and the outer ids build on the cached inner ones.
+    """
+    def __init__(self, message: dict, digest: str = None):
+        self.message = message
+        self.digest = digest or Ids.digest
+        self._capability_id = None
+        self._measurement_id = None
+        self._operation_id = None
+
+    @property
+    def capability_id(self) -> str:
+        if self._capability_id is None:
+            try:
+                self._capability_id = Ids.hash_fields([self.message[MessageFields.ENDPOINT], self.message[MessageFields.CAPABILITY_NAME]], self.digest)
+            except KeyError as e:
+                raise KeyError(f"Missing required field: {e}")
+        return self._capability_id
+
+    @property
+    def measurement_id(self) -> str:
+        if self._measurement_id is None:
+            try:
+                self._measurement_id = Ids.hash_fields([self.capability_id, self.message[MessageFields.PARAMETERS], self.message[MessageFields.SCHEDULE]], self.digest)
+            except KeyError as e:
+                raise KeyError(f"Missing required field: {e}")
+        return self._measurement_id
+
+    @property
+    def operation_id(self) -> str:
+        if self._operation_id is None:
+            try:
+                self._operation_id = Ids.hash_fields([self.measurement_id, self.message[MessageFields.NONCE], self.message[MessageFields.TIMESTAMP]], self.digest)
+            except KeyError as e:
+                raise KeyError(f"Missing required field: {e}")
+        return self._operation_id
+
+class IdentifiedMessage(dict):
+    """
+    Message dict carrying its MessageIds, so the ids travel with it instead of being
+    recomputed. It must not be modified once ids has been used.
+    """
+    @property
+    def ids(self) -> MessageIds:
+        if '_ids' not in self.__dict__:
+            self._ids = MessageIds(self)
+        return self._ids
+
 class Ids:
+    # Process-wide. Agents and clients sharing a broker must use the same digest.
+    digest = LEGACY_DIGEST
+    # Set once a capability has computed its id; agents index capabilities by it
+    capabilities_registered = False
+
+    @staticmethod
+    def set_digest(digest: str):
+        if digest not in ID_DIGESTS:
+            raise ValueError(f"Unknown id digest: {digest}")
+        if digest != Ids.digest and Ids.capabilities_registered:
+            raise ValueError("The id digest cannot change once capabilities are registered, set it before starting agents")
+        Ids.digest = digest
+
+    @staticmethod
+    def hash_fields(fields: list, digest: str = None) -> str:
+        digest = digest or Ids.digest
+        if digest == LEGACY_DIGEST:
+            return hashlib.sha256(Ids.combine_to_string(fields).encode()).hexdigest()
+        # Canonical form: key order and whitespace never change the id
+        canonical = json.dumps(fields, sort_keys=True, separators=(',', ':'), default=str).encode()
+        if digest == BLAKE2B_DIGEST:
+            return hashlib.blake2b(canonical, digest_size=32).hexdigest()
+        return hashlib.sha256(canonical).hexdigest()
+
+    @staticmethod
+    def of(message) -> MessageIds:
+        return message.ids if isinstance(message, IdentifiedMessage) else MessageIds(message)
+
     @staticmethod
     def calculate_capability_id(message):
-        try:
-            endpoint = message[MessageFields.ENDPOINT]
-            capability_name = message[MessageFields.CAPABILITY_NAME]
-            combined_string = Ids.combine_to_string([endpoint, capability_name])
-            capability_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return capability_id
-        except KeyError as e:
-            raise KeyError(f"Missing required field: {e}")
-        except Exception as e:
-            raise Exception(f"An error occurred while calculating capability ID: {e}")
+        return MessageIds(message).capability_id
 
     @staticmethod
     def calculate_measurement_id(message):
-        try:
-            capability_id = Ids.calculate_capability_id(message)
-            parameters = message[MessageFields.PARAMETERS]
-            schedule = message[MessageFields.SCHEDULE]
-            combined_string = Ids.combine_to_string([capability_id, parameters, schedule])
-            measurement_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return measurement_id
-        except KeyError as e:
-            raise KeyError(f"Missing required field: {e}")
-        except Exception as e:
-            raise Exception(f"An error occurred while calculating measurement ID: {e}")
+        return MessageIds(message).measurement_id
 
     @staticmethod
     def calculate_operation_id(message):
-        try:
-            measurement_id = Ids.calculate_measurement_id(message)
-            nonce = message[MessageFields.NONCE]
-            timestamp = message[MessageFields.TIMESTAMP]
-            combined_string = Ids.combine_to_string([measurement_id, nonce, timestamp])
-            operation_id = hashlib.sha256(combined_string.encode()).hexdigest()
-            return operation_id
-        except KeyError as e:
-            raise KeyError(f"Missing required field: {e}")
-        except Exception as e:
-            raise Exception(f"An error occurred while calculating operation ID: {e}")
+        return MessageIds(message).operation_id
+
+    @staticmethod
+    def calculate_advertisement_hash(capability_msgs: list) -> str:
+        # The timestamp changes on every construct_capability call, so it is left out of the hash
+        contents = [{key: value for key, value in msg.items() if key != MessageFields.TIMESTAMP} for msg in capability_msgs]
+        return hashlib.sha256(json.dumps(contents, sort_keys=True, default=str).encode()).hexdigest()
 
     @staticmethod
     def combine_to_string(attributes: list) -> str:
@@ -0,0 +1,85 @@
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_CODEC = 'zlib'
+LZ4_CODEC = 'lz4'
+ZSTD_CODEC = 'zstd'
+DEFAULT_CODEC = ZLIB_CODEC
+COMPRESSION_THRESHOLD = 16 * 1024  # bodies smaller than this are sent as they are
+ZLIB_LEVEL = 1  # result payloads are large, speed matters more than the last few percent
+
+class Codec:
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+# Codec name, as carried in the AMQP content_encoding -> Codec
+CODECS = {}
+
+def register_codec(name, compress, decompress):
+    CODECS[name] = Codec(name, compress, decompress)
+
+register_codec(ZLIB_CODEC, lambda data: zlib.compress(data, ZLIB_LEVEL), zlib.decompress)
+if lz4 is not None:
+    register_codec(LZ4_CODEC, lz4.frame.compress, lz4.frame.decompress)
+if zstandard is not None:
+    register_codec(ZSTD_CODEC, zstandard.compress, zstandard.decompress)
+
+def get_codec(name) -> Codec:
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"Compression codec {name} is not available")
+    return codec
+
+def get_content_encoding(message):
+    # proton 0.39 reports a missing content-encoding as symbol('None')
+    encoding = message.content_encoding
+    if encoding is None or encoding in ('', 'None'):
+        return None
+    return str(encoding)
+
+def compress_message(msg, codec_name, threshold = None):
+    """
+    Compresses the body of msg in place when it is at least threshold bytes (default
+    COMPRESSION_THRESHOLD) and compression actually shrinks it, recording the codec
+    in content_encoding.
+    """
+    if codec_name is None or get_content_encoding(msg):
+        return msg
+    if threshold is None:
+        threshold = COMPRESSION_THRESHOLD
+    body = msg.body
+    if isinstance(body, str):
+        body = body.encode()
+    if not isinstance(body, (bytes, bytearray, memoryview)) or len(body) < threshold:
+        return msg
+    compressed = get_codec(codec_name).compress(body)
+    if len(compressed) < len(body):
+        msg.body = compressed
+        msg.content_encoding = codec_name
+    return msg
+
+def decompress_body(message):
+    """
+    Returns the body of message, decompressed according to its content_encoding.
+    """
+    body = message.body
+    encoding = get_content_encoding(message)
+    if encoding is None:
+        return body
+    codec = CODECS.get(encoding)
+    if codec is None:
+        raise ValueError(f"Unsupported content encoding: {encoding}")
+    if isinstance(body, memoryview):
+        body = body.tobytes()
+    return codec.decompress(body)
@@ -0,0 +1,44 @@
+import random
+from proton import Handler
+
+RECONNECT_INITIAL_DELAY = 0.1
+RECONNECT_MAX_DELAY = 10
+RECONNECT_JITTER = 0.2  # fraction of each delay added or removed at random
+
+class ReconnectBackoff:
+    """
+    Reconnect delays for container.connect(reconnect=...): 0, then initial_delay doubling
+    up to max_delay. Every iteration starts a fresh sequence, so a connection that came
+    back retries quickly again the next time it drops. Jitter keeps the agents of a
+    restarted broker from redialling in lockstep.
+    """
+    def __init__(self, initial_delay : float = RECONNECT_INITIAL_DELAY, max_delay : float = RECONNECT_MAX_DELAY, jitter : float = RECONNECT_JITTER):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt : int) -> float:
+        """
+        Delay before the given attempt, counting from 0.
+        """
+        if attempt <= 0:
+            return 0.0
+        delay = min(self.initial_delay * 2 ** min(attempt - 1, 32), self.max_delay)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def __iter__(self):
+        attempt = 0
+        while True:
+            yield self.delay(attempt)
+            attempt += 1
+
+class Redial(Handler):
+    """
+    Timer task for container.schedule() that calls callback on the reactor thread.
+    """
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+
+    def on_timer_task(self, event):
+        self.callback()
@@ -0,0 +1,149 @@
+import json
+import pickle
+import struct
+import numpy as np
+from measurement_plane.protocols.amqp.compression import decompress_body
+
+JSON_CONTENT_TYPE = 'application/json'
+PICKLE_CONTENT_TYPE = 'application/x-python-pickle'
+FRAME_CONTENT_TYPE = 'application/x-measurement-plane-frame'
+
+FRAME_MAGIC = b'MPF1'
+FRAME_PREFIX = struct.Struct('>4sI')  # magic, header length
+FRAME_ALIGNMENT = 64  # buffer offsets within the frame, keeps np.frombuffer views aligned
+
+NDARRAY_KEY = '__ndarray__'
+BYTES_KEY = '__bytes__'
+
+def _align(offset: int) -> int:
+    return (offset + FRAME_ALIGNMENT - 1) // FRAME_ALIGNMENT * FRAME_ALIGNMENT
+
+def _extract_buffers(data, buffers: list):
+    """
+    Recursively replaces ndarrays and bytes with placeholders indexing into buffers.
+    """
+    if isinstance(data, dict):
+        return {(key.item() if isinstance(key, np.generic) else key): _extract_buffers(value, buffers) for key, value in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return [_extract_buffers(item, buffers) for item in data]
+    elif isinstance(data, np.ndarray):
+        if data.dtype.hasobject:
+            return _extract_buffers(data.tolist(), buffers)
+        buffers.append(data)
+        return {NDARRAY_KEY: len(buffers) - 1}
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        buffers.append(data)
+        return {BYTES_KEY: len(buffers) - 1}
+    elif isinstance(data, np.generic):
+        return data.item()
+    return data
+
+def encode_frame(data) -> bytearray:
+    """
+    Encodes data as a JSON header followed by the raw ndarray and bytes buffers it contains.
+    """
+    buffers = []
+    payload = _extract_buffers(data, buffers)
+    arrays = []
+    descriptors = []
+    offset = 0
+    for buffer in buffers:
+        if isinstance(buffer, np.ndarray):
+            array = np.ascontiguousarray(buffer)
+            raw = memoryview(array.reshape(-1).view(np.uint8))
+            # ascontiguousarray promotes 0-d arrays to 1-d, the shape is taken from the original
+            descriptors.append({"dtype": array.dtype.str, "shape": list(buffer.shape), "offset": offset, "nbytes": raw.nbytes})
+        else:
+            raw = memoryview(buffer).cast('B')
+            descriptors.append({"offset": offset, "nbytes": raw.nbytes})
+        arrays.append(raw)
+        offset = _align(offset + raw.nbytes)
+    header = json.dumps({"payload": payload, "buffers": descriptors}).encode()
+    data_start = _align(FRAME_PREFIX.size + len(header))
+    frame = bytearray(data_start + offset)
+    FRAME_PREFIX.pack_into(frame, 0, FRAME_MAGIC, len(header))
+    frame[FRAME_PREFIX.size:FRAME_PREFIX.size + len(header)] = header
+    with memoryview(frame) as view:
+        for raw, descriptor in zip(arrays, descriptors):
+            start = data_start + descriptor["offset"]
+            view[start:start + descriptor["nbytes"]] = raw
+    return frame
+
+def _restore_buffers(data, buffers: list):
+    if isinstance(data, dict):
+        if len(data) == 1:
+            if NDARRAY_KEY in data:
+                return buffers[data[NDARRAY_KEY]]
+            if BYTES_KEY in data:
+                return buffers[data[BYTES_KEY]]
+        return {key: _restore_buffers(value, buffers) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [_restore_buffers(item, buffers) for item in data]
+    return data
+
+def decode_frame(body):
+    """
+    Decodes a frame built by encode_frame. Arrays are read-only np.frombuffer views
+    on the message body, so no array data is copied.
+    """
+    view = memoryview(body)
+    magic, header_length = FRAME_PREFIX.unpack_from(view, 0)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Not a measurement plane frame")
+    header_end = FRAME_PREFIX.size + header_length
+    header = json.loads(bytes(view[FRAME_PREFIX.size:header_end]))
+    data_start = _align(header_end)
+    buffers = []
+    for descriptor in header["buffers"]:
+        start = data_start + descriptor["offset"]
+        if "dtype" in descriptor:
+            dtype = np.dtype(descriptor["dtype"])
+            count = descriptor["nbytes"] // dtype.itemsize if dtype.itemsize else 0
+            array = np.frombuffer(view, dtype=dtype, count=count, offset=start)
+            buffers.append(array.reshape(tuple(descriptor["shape"])))
+        else:
+            buffers.append(bytes(view[start:start + descriptor["nbytes"]]))
+    return _restore_buffers(header["payload"], buffers)
+
+def decode_control_message(message):
+    """
+    Decodes a specification, receipt, advertisement or other control message, after
+    undoing any content encoding. Only JSON and frames are accepted: these topics are
+    open to any publisher, and unpickling their bodies would run arbitrary code.
+    """
+    body = decompress_body(message)
+    content_type = message.content_type
+    if content_type == FRAME_CONTENT_TYPE:
+        return decode_frame(body)
+    if content_type == PICKLE_CONTENT_TYPE:
+        raise ValueError("Pickled control messages are not accepted")
+    if isinstance(body, memoryview):
+        body = body.tobytes()
+    return json.loads(body)
+
+def decode_message(message):
+    """
+    Decodes an AMQP message body according to its content type, after undoing any
+    content encoding. Messages without a content type fall back to the legacy rule:
+    bytes are pickled, text is JSON. Unpickling runs code chosen by the sender, so
+    this is only for results; control messages go through decode_control_message.
+    """
+    body = decompress_body(message)
+    content_type = message.content_type
+    if content_type == FRAME_CONTENT_TYPE:
+        return decode_frame(body)
+    if isinstance(body, memoryview):
+        body = body.tobytes()
+    if content_type == PICKLE_CONTENT_TYPE or (content_type != JSON_CONTENT_TYPE and isinstance(body, bytes)):
+        return pickle.loads(body)
+    return json.loads(body)
+
+def body_size(body) -> int:
+    """
+    Size in bytes of an AMQP message body as sent on the wire, 0 for non-binary bodies.
+    """
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode())
+    return 0
@@ -0,0 +1,153 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+import collections
+from proton import Message
+from measurement_plane.utils import metrics
+
+OUTBOX_SIZE = 10000  # messages held in memory
+OUTBOX_SPILL_SIZE = 100000  # messages written to the spill directory once memory is full
+
+OUTBOX_REFUSED = metrics.counter('mp_outbox_refused_total', 'Messages refused because the outbox was full')
+
+class Outbox:
+    """
+    Messages waiting for a sender link, in order per (server, topic) key: while the link
+    has no credit, and while its broker is unreachable. At most max_messages are held
+    in memory; with a spill_directory up to max_spilled more are written there and read
+    back in turn. put() refuses messages beyond that. put, requeue and pop are called
+    from the sender's reactor thread; the lock guards the readers of depth and age,
+    and spill files are written and read outside of it.
+    """
+    def __init__(self, max_messages : int = OUTBOX_SIZE, spill_directory : str = None, max_spilled : int = OUTBOX_SPILL_SIZE, name : str = ''):
+        self.max_messages = max_messages
+        self.spill_directory = spill_directory
+        self.max_spilled = max_spilled if spill_directory else 0
+        self.queues = {}  # key -> deque of (message, or path of the spilled message, future, time.monotonic() of the send)
+        self.in_memory = 0
+        self.spilled = 0
+        self.lock = threading.Lock()
+        if spill_directory:
+            os.makedirs(spill_directory, exist_ok=True)
+        # Labelled by sender name, weakly owned, and unregistered by close()
+        self.gauges = [
+            metrics.gauge('mp_outbox_messages', 'Messages waiting in the sender outbox', lambda outbox: outbox.in_memory, owner=self, sender=name, location='memory'),
+            metrics.gauge('mp_outbox_messages', 'Messages waiting in the sender outbox', lambda outbox: outbox.spilled, owner=self, sender=name, location='disk'),
+            metrics.gauge('mp_outbox_oldest_age_seconds', 'Age of the oldest message waiting in the sender outbox', Outbox.oldest_age, owner=self, sender=name),
+        ]
+
+    def put(self, key, message : Message, future) -> bool:
+        """
+        Appends message for key, False when the outbox is full.
+        """
+        sent_at = time.monotonic()
+        with self.lock:
+            if self.in_memory < self.max_messages:
+                self.in_memory += 1
+                spill = False
+            elif self.spilled < self.max_spilled:
+                self.spilled += 1  # the slot is taken before the file is written
+                spill = True
+            else:
+                OUTBOX_REFUSED.inc()
+                return False
+        if spill:
+            try:
+                message = self.spill(message)
+            except OSError as e:
+                logging.error(f"Error spilling message to {self.spill_directory}: {e}")
+                with self.lock:
+                    self.spilled -= 1
+                OUTBOX_REFUSED.inc()
+                return False
+        with self.lock:
+            self.queues.setdefault(key, collections.deque()).append((message, future, sent_at))
+        return True
+
+    def requeue(self, key, entries : list):
+        """
+        Puts entries taken by pop() back at the front of key, in their order. They
+        were admitted before, so they are held in memory even beyond max_messages.
+        """
+        if not entries:
+            return
+        with self.lock:
+            self.queues.setdefault(key, collections.deque()).extendleft(reversed(entries))
+            self.in_memory += len(entries)
+
+    def pop(self, key):
+        """
+        Removes and returns the first (message, future, sent at) of key, None when empty.
+        """
+        with self.lock:
+            queue = self.queues.get(key)
+            if not queue:
+                return None
+            message, future, sent_at = queue.popleft()
+            if not queue:
+                del self.queues[key]
+            if isinstance(message, Message):
+                self.in_memory -= 1
+                return message, future, sent_at
+            self.spilled -= 1
+        try:
+            return self.load(message), future, sent_at
+        except Exception as e:
+            logging.error(f"Error reading spilled message {message}: {e}")
+            future.set_exception(e)
+            return self.pop(key)
+
+    def spill(self, message : Message) -> str:
+        descriptor, path = tempfile.mkstemp(suffix='.amqp', dir=self.spill_directory)
+        with os.fdopen(descriptor, 'wb') as spill_file:
+            spill_file.write(message.encode())
+        return path
+
+    @staticmethod
+    def load(path : str) -> Message:
+        with open(path, 'rb') as spill_file:
+            data = spill_file.read()
+        os.remove(path)
+        message = Message()
+        message.decode(data)
+        if isinstance(message.body, memoryview):
+            message.body = bytes(message.body)
+        return message
+
+    def fail(self, key, error : Exception):
+        """
+        Drops every message of key, failing its future with error.
+        """
+        with self.lock:
+            queue = self.queues.pop(key, ())
+            spilled = [message for message, _, _ in queue if not isinstance(message, Message)]
+            self.spilled -= len(spilled)
+            self.in_memory -= len(queue) - len(spilled)
+        for path in spilled:
+            os.remove(path)
+        for _, future, _ in queue:
+            future.set_exception(error)
+
+    def close(self):
+        for gauge in self.gauges:
+            metrics.unregister(gauge)
+
+    def keys(self) -> list:
+        with self.lock:
+            return list(self.queues)
+
+    def depth(self, key = None) -> int:
+        with self.lock:
+            if key is None:
+                return self.in_memory + self.spilled
+            return len(self.queues.get(key, ()))
+
+    def oldest_age(self) -> float:
+        """
+        Seconds the oldest waiting message has been in the outbox, 0 when it is empty.
+        """
+        with self.lock:
+            oldest = min((queue[0][2] for queue in self.queues.values()), default=None)
+        return time.monotonic() - oldest if oldest is not None else 0.0
@@ -1,9 +1,37 @@
 #standards imports
-import traceback, logging, threading
+import traceback, logging, threading, collections, time
 
 #imports to use AMQP 1.0 communication protocol
 from proton.handlers import MessagingHandler
-from proton.reactor import Container
+from proton.reactor import Container, EventInjector, ApplicationEvent
+from measurement_plane.protocols.amqp.encoding import body_size
+from measurement_plane.protocols.amqp.connection import ReconnectBackoff, Redial
+from measurement_plane.utils import metrics
+
+RECEIVER_CREDIT = 10  # messages the broker may push ahead of the callback on each link
+
+MESSAGES_RECEIVED = metrics.counter('mp_messages_received_total', 'Messages delivered to a receiver')
+BYTES_RECEIVED = metrics.counter('mp_received_bytes_total', 'Message body bytes delivered to a receiver')
+CALLBACK_SECONDS = metrics.histogram('mp_receive_callback_seconds', 'Time spent in on_message callbacks')
+RECEIVER_DISCONNECTS = metrics.counter('mp_disconnects_total', 'Connections dropped by the broker', component='receiver')
+RECEIVER_RECONNECTS = metrics.counter('mp_reconnects_total', 'Connections opened again after a disconnect', component='receiver')
+
+def dispatch(callback, event):
+    """
+    Calls callback with event, counting the message and timing the call when metrics are enabled.
+    """
+    if not metrics.metrics_enabled():
+        if callback:
+            callback(event)
+        return
+    MESSAGES_RECEIVED.inc()
+    BYTES_RECEIVED.inc(body_size(event.message.body))
+    if callback:
+        started = time.perf_counter()
+        try:
+            callback(event)
+        finally:
+            CALLBACK_SECONDS.observe(time.perf_counter() - started)
 
 """class Receiver():
     def __init__(self, on_message_callback=None):
@@ -56,8 +84,8 @@ from proton.reactor import Container
 """
 
 class ReceiverThread:
-    def __init__(self, broker_url, topic, on_message_callback=None):
-        self.receiver = PersistentReceiver(broker_url, topic, on_message_callback)
+    def __init__(self, broker_url, topic, on_message_callback=None, prefetch=RECEIVER_CREDIT):
+        self.receiver = PersistentReceiver(broker_url, topic, on_message_callback, prefetch)
         self.container = Container(self.receiver)
         self.thread = threading.Thread(target=self.container.run)
         self.thread.daemon = True  # Ensure thread doesn't prevent program exit
@@ -69,16 +97,73 @@ class ReceiverThread:
         self.receiver.stop()
         
 class PersistentReceiver(MessagingHandler):
-    def __init__(self, broker_url, topic, on_message_callback=None):
-        super().__init__()
+    """
+    Receives on one topic. A dropped transport is redialled by the container with
+    backoff, re-attaching the link; a connection or link the broker closes is opened
+    again after a backoff delay.
+    """
+    def __init__(self, broker_url, topic, on_message_callback=None, prefetch=RECEIVER_CREDIT):
+        super().__init__(prefetch=prefetch)
         self.broker_url = broker_url
         self.topic = topic
         self.on_message_callback = on_message_callback
+        self.container = None
         self.connection = None
+        self.link = None
+        self.connected = None  # None until first connected, False while disconnected
+        self.stopping = False
+        self.backoff = ReconnectBackoff()
+        self.redials = 0  # connections or links in a row the broker closed
 
     def on_start(self, event):
-        self.connection = event.container.connect(self.broker_url)
-        event.container.create_receiver(self.connection, self.topic)
+        self.container = event.container
+        self.connect()
+
+    def connect(self):
+        if self.stopping:
+            return
+        self.connection = self.container.connect(self.broker_url, reconnect=self.backoff)
+        self.link = self.container.create_receiver(self.connection, self.topic)
+
+    def relink(self, link):
+        if not self.stopping and self.link == link and self.connection is not None:
+            self.link = self.container.create_receiver(self.connection, self.topic)
+
+    def schedule_redial(self, callback):
+        self.redials += 1
+        self.container.schedule(self.backoff.delay(self.redials), Redial(callback))
+
+    def on_connection_opened(self, event):
+        if event.connection == self.connection:
+            if self.connected is False:
+                RECEIVER_RECONNECTS.inc()
+                logging.info(f"Reconnected to server: {self.broker_url}")
+            self.connected = True
+
+    def on_link_opened(self, event):
+        if event.link == self.link:
+            self.redials = 0
+
+    def on_connection_closing(self, event):
+        self.connection_closed(event)
+
+    def on_connection_error(self, event):
+        self.connection_closed(event)
+
+    def connection_closed(self, event):
+        # The container does not redial a connection the broker closed, e.g. while shutting down
+        if event.connection == self.connection and not self.stopping:
+            self.on_disconnected(event)
+            self.connection = None
+            self.schedule_redial(self.connect)
+
+    def on_link_closing(self, event):
+        if event.link == self.link and not self.stopping:
+            logging.warning(f"Receiver link to topic {self.topic} closed by server: {self.broker_url}")
+            self.schedule_redial(lambda: self.relink(event.link))
+
+    def on_link_error(self, event):
+        self.on_link_closing(event)
 
     def on_message(self, event):
         try:
@@ -86,15 +171,228 @@ class PersistentReceiver(MessagingHandler):
             event.delivery.update(event.delivery.ACCEPTED)
             event.delivery.settle()
             # Call the custom on_message callback if provided
-            if self.on_message_callback:
-                self.on_message_callback(event)
+            dispatch(self.on_message_callback, event)
 
         except Exception:
             traceback.print_exc()
     
     def on_disconnected(self, event):
-        logging.warning("Disconnected from server: {}".format(self.broker_url))
+        # Called for each failed attempt while the container redials
+        if self.connected:
+            RECEIVER_DISCONNECTS.inc()
+            logging.warning("Disconnected from server: {}".format(self.broker_url))
+        self.connected = False
+
+    def stop(self):
+        self.stopping = True
+        if self.connection is not None:
+            self.connection.close()
+
+
+class ReceiverHub:
+    """
+    Receives on any number of topics over one broker connection and one reactor thread.
+    Each attached topic gets its own receiver link and callback. A lost connection is
+    reopened with backoff and the links of the attached topics are re-created.
+    """
+    def __init__(self, broker_url, credit=RECEIVER_CREDIT):
+        self.broker_url = broker_url
+        self.credit = credit
+        self.injector = EventInjector()
+        self.handler = ReceiverHubHandler(broker_url, self.injector)
+        self.container = Container(self.handler)
+        self.container.selectable(self.injector)
+        self.thread = threading.Thread(target=self.container.run)
+        self.thread.daemon = True  # Ensure thread doesn't prevent program exit
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if not self.started:
+                self.thread.start()
+                self.started = True
+
+    def attach(self, topic, on_message_callback=None, on_attached_callback=None, credit=None) -> 'HubSubscription':
+        """
+        Opens a receiver link on topic. on_attached_callback(subscription) runs on the
+        reactor thread once the broker has opened the link. Credit is granted back one
+        message at a time as callbacks return, so a slow callback holds the broker back.
+        """
+        self.start()
+        subscription = HubSubscription(self, topic, on_message_callback, on_attached_callback, credit or self.credit)
+        self.handler.requests.append(("attach", subscription))
+        self.injector.trigger(ApplicationEvent("hub_requested"))
+        return subscription
+
+    def detach(self, subscription: 'HubSubscription'):
+        self.handler.requests.append(("detach", subscription))
+        self.injector.trigger(ApplicationEvent("hub_requested"))
+
+    def in_reactor_thread(self) -> bool:
+        """
+        True when called from a message callback, where blocking on the hub would deadlock.
+        """
+        return threading.current_thread() is self.thread
+
+    def stop(self):
+        if self.started:
+            self.injector.trigger(ApplicationEvent("hub_stop_requested"))
+            if not self.in_reactor_thread():
+                self.thread.join(timeout=5)
+
+class HubSubscription:
+    def __init__(self, hub: ReceiverHub, topic, on_message_callback=None, on_attached_callback=None, credit=RECEIVER_CREDIT):
+        self.hub = hub
+        self.topic = topic
+        self.credit = credit
+        self.on_message_callback = on_message_callback
+        self.on_attached_callback = on_attached_callback
+        self.link = None
+        self.attached = threading.Event()  # set once the broker has opened the link
+        self.relinks = 0  # times in a row the broker closed the link
+        self.detached = False
 
     def stop(self):
-        self.connection.close()
+        if not self.detached:
+            self.detached = True
+            self.hub.detach(self)
+
+class ReceiverHubHandler(MessagingHandler):
+    def __init__(self, broker_url, injector):
+        # Credit is managed per link instead of by the handler-wide prefetch
+        super().__init__(prefetch=0)
+        self.broker_url = broker_url
+        self.injector = injector
+        self.requests = collections.deque()
+        self.container = None
+        self.connection = None
+        self.subscriptions = {}  # receiver link -> subscription
+        self.unlinked = []  # subscriptions attached while the connection was closed
+        self.connected = None  # None until first connected, False while disconnected
+        self.stopping = False
+        self.backoff = ReconnectBackoff()
+        self.redials = 0  # connections in a row the broker closed
+
+    def on_start(self, event):
+        self.container = event.container
+        self.connect()
+
+    def connect(self):
+        # Dropped transports are redialled by the container, which also re-attaches the links
+        self.connection = self.container.connect(self.broker_url, reconnect=self.backoff)
+
+    def open_link(self, subscription):
+        subscription.link = self.container.create_receiver(self.connection, subscription.topic)
+        subscription.link.flow(subscription.credit)
+        self.subscriptions[subscription.link] = subscription
+
+    def on_hub_requested(self, event):
+        while self.requests:
+            request, subscription = self.requests.popleft()
+            if request == "attach":
+                if subscription.detached:
+                    continue
+                if self.connection is None:
+                    self.unlinked.append(subscription)  # linked by reconnect()
+                    continue
+                self.open_link(subscription)
+            elif subscription.link is not None and subscription.link in self.subscriptions:
+                del self.subscriptions[subscription.link]
+                subscription.link.close()
+
+    def on_connection_opened(self, event):
+        if event.connection == self.connection:
+            self.redials = 0
+            if self.connected is False:
+                RECEIVER_RECONNECTS.inc()
+                logging.info(f"Reconnected to server: {self.broker_url}")
+            self.connected = True
+
+    def on_connection_closing(self, event):
+        self.connection_closed(event)
+
+    def on_connection_error(self, event):
+        self.connection_closed(event)
+
+    def connection_closed(self, event):
+        """
+        The broker closed the connection, e.g. while shutting down. The container does not
+        redial closed connections, so a new one with new links is opened after a backoff delay.
+        """
+        if event.connection != self.connection or self.stopping:
+            return
+        self.on_disconnected(event)
+        self.connection = None
+        self.redials += 1
+        self.container.schedule(self.backoff.delay(self.redials), Redial(self.reconnect))
+
+    def reconnect(self):
+        if self.stopping:
+            return
+        subscriptions = [subscription for subscription in list(self.subscriptions.values()) + self.unlinked if not subscription.detached]
+        self.subscriptions = {}
+        self.unlinked = []
+        self.connect()
+        for subscription in subscriptions:
+            self.open_link(subscription)
 
+    def on_link_closing(self, event):
+        # The broker detached one link, it is re-created on the same connection
+        subscription = self.subscriptions.get(event.link)
+        if subscription and not self.stopping:
+            logging.warning(f"Receiver link to topic {subscription.topic} closed by server: {self.broker_url}")
+            subscription.relinks += 1
+            self.container.schedule(self.backoff.delay(subscription.relinks), Redial(lambda: self.relink(subscription, event.link)))
+
+    def on_link_error(self, event):
+        self.on_link_closing(event)
+
+    def relink(self, subscription, link):
+        if subscription.link == link and link in self.subscriptions and self.connection is not None:
+            del self.subscriptions[link]
+            if not subscription.detached:
+                self.open_link(subscription)
+
+    def on_link_opened(self, event):
+        subscription = self.subscriptions.get(event.link)
+        if subscription is None:
+            return
+        subscription.relinks = 0
+        if not subscription.attached.is_set():  # re-attached links do not call back again
+            subscription.attached.set()
+            if subscription.on_attached_callback:
+                try:
+                    subscription.on_attached_callback(subscription)
+                except Exception:
+                    traceback.print_exc()
+
+    def on_message(self, event):
+        subscription = self.subscriptions.get(event.receiver)
+        try:
+            # Acknowledge the message
+            event.delivery.update(event.delivery.ACCEPTED)
+            event.delivery.settle()
+            # Dispatch to the callback of the topic the message arrived on
+            dispatch(subscription.on_message_callback if subscription else None, event)
+
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if subscription and not subscription.detached:
+                event.receiver.flow(1)
+
+    def on_disconnected(self, event):
+        # Called for each failed attempt while the container redials
+        if self.connected:
+            RECEIVER_DISCONNECTS.inc()
+            logging.warning("Disconnected from server: {}".format(self.broker_url))
+        self.connected = False
+
+    def on_hub_stop_requested(self, event):
+        self.stopping = True
+        self.subscriptions = {}
+        if self.connection is not None:
+            self.connection.close()
+        self.injector.close()
+        self.container.stop()
@@ -1,10 +1,32 @@
 import json
 import pickle
 import logging
+import threading
+import time
+import itertools
+import collections
+from concurrent.futures import Future, wait
 from proton import Message
 from proton.handlers import MessagingHandler
-from proton.reactor import Container
+from proton.reactor import Container, EventInjector, ApplicationEvent
 import numpy as np
+from measurement_plane.protocols.amqp.encoding import encode_frame, body_size, JSON_CONTENT_TYPE, PICKLE_CONTENT_TYPE, FRAME_CONTENT_TYPE
+from measurement_plane.protocols.amqp.compression import compress_message
+from measurement_plane.protocols.amqp.connection import ReconnectBackoff, Redial
+from measurement_plane.protocols.amqp.outbox import Outbox, OUTBOX_SIZE
+from measurement_plane.utils import metrics
+
+SEND_TIMEOUT = 10
+UNREACHABLE_CHECK_INTERVAL = 0.1  # seconds between checks of a blocking send for a dropped connection
+LINK_IDLE_TIMEOUT = 60
+IDLE_CHECK_INTERVAL = 5
+
+MESSAGES_SENT = metrics.counter('mp_messages_sent_total', 'Messages accepted by the broker')
+BYTES_SENT = metrics.counter('mp_sent_bytes_total', 'Encoded message body bytes queued for sending')
+SEND_FAILURES = metrics.counter('mp_send_failures_total', 'Messages that failed to encode, were refused or lost with their link')
+ENCODE_SECONDS = metrics.histogram('mp_encode_seconds', 'Time spent encoding a message')
+SENDER_DISCONNECTS = metrics.counter('mp_disconnects_total', 'Connections dropped by the broker', component='sender')
+SENDER_RECONNECTS = metrics.counter('mp_reconnects_total', 'Connections opened again after a disconnect', component='sender')
 
 def convert_numpy_key(key):
     """
@@ -41,13 +63,353 @@ def contains_bytes(data):
         return any(contains_bytes(item) for item in data)
     return False
 
+def encode_message(messages, reply_to = None, binary = False, compression = None) -> Message:
+    """
+    Serializes messages into an AMQP message. With binary, ndarrays and bytes travel
+    as raw buffers in a frame; otherwise payloads that carry bytes are pickled and
+    the rest is sent as JSON. Large bodies are compressed with the compression codec.
+    """
+    if isinstance(messages, Message):
+        msg = messages  # already encoded by the caller
+    elif binary:
+        msg = Message(body=encode_frame(messages), content_type=FRAME_CONTENT_TYPE)
+    elif contains_bytes(messages):
+        serialized_message = pickle.dumps(messages)
+        msg = Message(body=serialized_message, ttl=5000, content_type=PICKLE_CONTENT_TYPE)
+    else:
+        messages_serializable = convert_ndarray_to_list(messages)
+
+        # Serialize the dictionary to JSON
+        msg = Message(body=json.dumps(messages_serializable), content_type=JSON_CONTENT_TYPE)
+    if reply_to is not None:
+        msg.reply_to = reply_to
+    return compress_message(msg, compression)
+
+class SendError(Exception):
+    pass
+
+def log_send_error(topic, future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Error sending messages to topic {topic}: {future.exception()}")
+
 class Sender:
-    def __init__(self):
-        pass
+    """
+    Blocking sender kept for compatibility, backed by a shared PersistentSender.
+    """
+    def __init__(self, persistent_sender = None):
+        self.persistent_sender = persistent_sender
+
+    def send(self, server, topic, messages, reply_to = None, binary = False, compression = None):
+        if self.persistent_sender is None:
+            self.persistent_sender = get_persistent_sender()
+        future = self.persistent_sender.send(server, topic, messages, reply_to, binary, compression)
+        # Waits for the broker while its connection is open or being opened, so a slow broker
+        # holds producers back; once it is unreachable the outbox keeps the messages instead
+        deadline = time.monotonic() + SEND_TIMEOUT
+        while not future.done():
+            if self.persistent_sender.unreachable(server):
+                future.add_done_callback(lambda future: log_send_error(topic, future))
+                return
+            if time.monotonic() >= deadline:
+                logging.error(f"Error sending messages to topic {topic}: no response from the broker in {SEND_TIMEOUT} seconds")
+                return
+            wait([future], timeout=UNREACHABLE_CHECK_INTERVAL)
+        log_send_error(topic, future)
+
+    def send_async(self, server, topic, messages, reply_to = None, binary = False, compression = None) -> Future:
+        if self.persistent_sender is None:
+            self.persistent_sender = get_persistent_sender()
+        return self.persistent_sender.send(server, topic, messages, reply_to, binary, compression)
+
+_sender_ids = itertools.count(1)
+
+class PersistentSender:
+    """
+    Long-lived sender running one reactor thread. Connections are cached per broker
+    and sender links per topic; links left idle for idle_timeout seconds are closed.
+    Lost connections are reopened with backoff, and messages sent meanwhile wait in a
+    bounded outbox of outbox_size messages, spilled to spill_directory beyond that.
+    The outbox metrics are labelled with name.
+    """
+    def __init__(self, idle_timeout = LINK_IDLE_TIMEOUT, outbox_size = OUTBOX_SIZE, spill_directory = None, name = None):
+        self.injector = EventInjector()
+        self.outbox = Outbox(outbox_size, spill_directory, name=name or f"sender-{next(_sender_ids)}")
+        self.handler = PersistentSendHandler(self.injector, idle_timeout, self.outbox)
+        self.container = Container(self.handler)
+        self.container.selectable(self.injector)
+        self.thread = threading.Thread(target=self.container.run)
+        self.thread.daemon = True  # Ensure thread doesn't prevent program exit
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if not self.started:
+                self.thread.start()
+                self.started = True
+
+    def send(self, server, topic, messages, reply_to = None, binary = False, compression = None) -> Future:
+        """
+        Queues messages for sending and returns a future settled once the broker
+        accepts (result True) or refuses (SendError) the delivery.
+        """
+        self.start()
+        future = Future()
+        timed = metrics.metrics_enabled()
+        started = time.perf_counter() if timed else 0
+        try:
+            msg = encode_message(messages, reply_to, binary, compression)
+        except Exception as e:
+            logging.error(f"Error sending messages: {e}")
+            SEND_FAILURES.inc()
+            future.set_exception(e)
+            return future
+        if timed:
+            ENCODE_SECONDS.observe(time.perf_counter() - started)
+            BYTES_SENT.inc(body_size(msg.body))
+        self.handler.requests.append((server, topic, msg, future))
+        self.injector.trigger(ApplicationEvent("send_requested"))
+        return future
+
+    def unreachable(self, server) -> bool:
+        """
+        True while the connection to server is down and being redialled.
+        """
+        return server in self.handler.unreachable
+
+    def stop(self):
+        if self.started:
+            self.injector.trigger(ApplicationEvent("stop_requested"))
+            self.thread.join(timeout=SEND_TIMEOUT)
+        self.outbox.close()
+
+_persistent_sender = None
+_persistent_sender_lock = threading.Lock()
+
+def get_persistent_sender() -> PersistentSender:
+    """
+    Returns the process-wide PersistentSender, creating it on first use.
+    """
+    global _persistent_sender
+    with _persistent_sender_lock:
+        if _persistent_sender is None:
+            _persistent_sender = PersistentSender(name='default')
+        return _persistent_sender
+
+class PersistentSendHandler(MessagingHandler):
+    def __init__(self, injector, idle_timeout = LINK_IDLE_TIMEOUT, outbox = None):
+        super(PersistentSendHandler, self).__init__()
+        self.injector = injector
+        self.idle_timeout = idle_timeout
+        self.requests = collections.deque()
+        self.container = None
+        self.connections = {}   # server -> connection
+        self.servers = {}       # connection -> server
+        self.links = {}         # (server, topic) -> sender link
+        self.link_keys = {}     # sender link -> (server, topic)
+        self.outbox = outbox or Outbox()  # messages waiting for credit or for the broker, per (server, topic)
+        self.deliveries = {}    # delivery -> outbox entry, in sending order
+        self.last_used = {}     # sender link -> time.monotonic() of last send
+        self.unreachable = set()  # servers whose connection is down and being redialled
+        self.backoff = ReconnectBackoff()
+        self.redials = {}       # server -> connections in a row the broker closed
+        self.stopping = False
+
+    def on_start(self, event):
+        self.container = event.container
+        self.container.schedule(IDLE_CHECK_INTERVAL, self)
+
+    def on_send_requested(self, event):
+        while self.requests:
+            server, topic, msg, future = self.requests.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            if not self.outbox.put((server, topic), msg, future):
+                SEND_FAILURES.inc()
+                future.set_exception(SendError("outbox full"))
+                continue
+            self.flush(self.get_link(server, topic))
+
+    def get_link(self, server, topic):
+        link = self.links.get((server, topic))
+        if link is None:
+            conn = self.connections.get(server)
+            if conn is None:
+                # Dropped transports are redialled by the container, which also re-attaches the links
+                conn = self.container.connect(server, reconnect=self.backoff)
+                self.connections[server] = conn
+                self.servers[conn] = server
+            link = self.container.create_sender(conn, topic)
+            self.links[(server, topic)] = link
+            self.link_keys[link] = (server, topic)
+            self.last_used[link] = time.monotonic()
+        return link
+
+    def flush(self, link):
+        key = self.link_keys.get(link)
+        if key is None or key[0] in self.unreachable:
+            return  # credit granted before a disconnect is not usable
+        while link.credit > 0:
+            entry = self.outbox.pop(key)
+            if entry is None:
+                break
+            msg, future, _ = entry
+            try:
+                delivery = link.send(msg)
+            except Exception as e:
+                logging.error(f"Error sending messages: {e}")
+                SEND_FAILURES.inc()
+                future.set_exception(e)
+                continue
+            self.deliveries[delivery] = entry
+            self.last_used[link] = time.monotonic()
+
+    def on_sendable(self, event):
+        self.flush(event.sender)
+
+    def on_accepted(self, event):
+        entry = self.deliveries.pop(event.delivery, None)
+        if entry:
+            MESSAGES_SENT.inc()
+            entry[1].set_result(True)
+
+    def on_rejected(self, event):
+        logging.error(f"Message rejected for topic {event.link.target.address}")
+        entry = self.deliveries.pop(event.delivery, None)
+        if entry:
+            SEND_FAILURES.inc()
+            entry[1].set_exception(SendError("message rejected"))
+
+    def on_released(self, event):
+        entry = self.deliveries.pop(event.delivery, None)
+        if entry:
+            SEND_FAILURES.inc()
+            entry[1].set_exception(SendError("message released"))
+
+    def on_connection_opened(self, event):
+        server = self.servers.get(event.connection)
+        if server is None:
+            return
+        self.redials.pop(server, None)
+        if server in self.unreachable:
+            self.unreachable.discard(server)
+            SENDER_RECONNECTS.inc()
+            logging.info(f"Reconnected to server: {server}, {self.outbox.depth()} messages in the outbox")
+            for link in [link for link in self.link_keys if link.connection == event.connection]:
+                self.flush(link)
+
+    def on_disconnected(self, event):
+        # Called for each failed attempt while the container redials
+        server = self.servers.get(event.connection)
+        if server is None:
+            return
+        self.disconnected(server, event.connection)
+
+    def on_connection_closing(self, event):
+        self.connection_closed(event)
+
+    def on_connection_error(self, event):
+        self.connection_closed(event)
+
+    def connection_closed(self, event):
+        """
+        The broker closed the connection, e.g. while shutting down. The container does not
+        redial closed connections, so a new one is opened after a backoff delay.
+        """
+        server = self.servers.get(event.connection)
+        if server is None or self.stopping:
+            return
+        self.disconnected(server, event.connection)
+        self.drop_connection(event.connection)
+        attempt = self.redials.get(server, 0) + 1
+        self.redials[server] = attempt
+        self.container.schedule(self.backoff.delay(attempt), Redial(lambda: self.redial(server)))
+
+    def disconnected(self, server, connection):
+        if server not in self.unreachable:
+            self.unreachable.add(server)
+            SENDER_DISCONNECTS.inc()
+            logging.error(f"Disconnected from server: {server}, holding messages in the outbox until it is back")
+        for link in [link for link in self.link_keys if link.connection == connection]:
+            self.requeue(link)
+
+    def redial(self, server):
+        if self.stopping or server in self.connections:
+            return
+        for key in self.outbox.keys():
+            if key[0] == server:
+                self.flush(self.get_link(*key))
+
+    def requeue(self, link):
+        """
+        Puts the unsettled deliveries of link back at the front of the outbox, to be sent
+        again once it is re-attached. Deliveries the broker got before it went away are
+        sent twice.
+        """
+        unsettled = [delivery for delivery in self.deliveries if delivery.link == link]
+        for delivery in unsettled:
+            delivery.settle()
+        self.outbox.requeue(self.link_keys[link], [self.deliveries.pop(delivery) for delivery in unsettled])
+
+    def on_link_closing(self, event):
+        # The broker detached the link: its messages wait in the outbox for the next send to re-create it
+        if event.link in self.link_keys and not self.stopping:
+            self.requeue(event.link)
+            self.forget_link(event.link)
+
+    def on_link_error(self, event):
+        if event.link in self.link_keys and not self.stopping:
+            key = self.link_keys[event.link]
+            condition = event.link.remote_condition
+            logging.error(f"Sender link to topic {key[1]} closed by server: {condition.description or condition.name}")
+            self.forget_link(event.link, SendError(f"sender link closed: {condition.name}"))
+            self.outbox.fail(key, SendError(f"sender link closed: {condition.name}"))
+
+    def drop_connection(self, connection, error = None):
+        server = self.servers.pop(connection)
+        del self.connections[server]
+        for link in [link for link in self.link_keys if link.connection == connection]:
+            self.forget_link(link, error)
+
+    def forget_link(self, link, error = None):
+        """
+        Forgets link, failing its unsettled deliveries with error. Without an error they
+        are expected to have been requeued.
+        """
+        key = self.link_keys.pop(link)
+        del self.links[key]
+        del self.last_used[link]
+        for delivery in [d for d in self.deliveries if d.link == link]:
+            SEND_FAILURES.inc()
+            self.deliveries.pop(delivery)[1].set_exception(error or SendError("sender link closed"))
+
+    def on_timer_task(self, event):
+        now = time.monotonic()
+        for link, key in list(self.link_keys.items()):
+            if not self.outbox.depth(key) and link.unsettled == 0 and now - self.last_used[link] > self.idle_timeout:
+                self.forget_link(link)
+                link.close()
+        in_use = set(link.connection for link in self.link_keys)
+        for server, conn in list(self.connections.items()):
+            if conn not in in_use:
+                del self.connections[server]
+                del self.servers[conn]
+                self.unreachable.discard(server)
+                conn.close()
+        self.container.schedule(IDLE_CHECK_INTERVAL, self)
 
-    def send(self, server, topic, messages, reply_to = None):
-        container = Container(SendHandler(server, topic, messages, reply_to))
-        container.run()
+    def on_stop_requested(self, event):
+        self.stopping = True
+        for link in list(self.link_keys):
+            self.forget_link(link, SendError("sender stopped"))
+        for key in self.outbox.keys():
+            self.outbox.fail(key, SendError("sender stopped"))
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+        self.servers = {}
+        self.injector.close()
+        self.container.stop()
 
 class SendHandler(MessagingHandler):
     def __init__(self, server, topic, messages, reply_to = None):
@@ -77,30 +439,26 @@ class SendHandler(MessagingHandler):
         if not self.message_sent:  # Ensure the message is sent only once
             try:
                 logging.info(f"Agent sending messages to topic {self.topic}")
-                if contains_bytes(self.messages):
-                    serialized_message = pickle.dumps(self.messages)
-                    msg = Message(body=serialized_message, ttl=5000)
-                else:
-                    messages_serializable = convert_ndarray_to_list(self.messages)
-                    
-                    # Serialize the dictionary to JSON
-                    msg = Message(body=json.dumps(messages_serializable))
-                msg.reply_to = self.reply_to    
+                msg = encode_message(self.messages, self.reply_to)
+                BYTES_SENT.inc(body_size(msg.body))
                 event.sender.send(msg)
                 self.message_sent = True 
 
             except Exception as e:
                 logging.error(f"Error sending messages: {e}")
+                SEND_FAILURES.inc()
 
     
 
     def on_rejected(self, event):
         logging.error(f"Message rejected for topic {self.topic}")
+        SEND_FAILURES.inc()
         event.sender.close()  # Clean up the sender in case of rejection
         event.connection.close()  # Close the connection if no more messages
         
     def on_accepted(self, event):
         logging.info("msg accepted in topic {}".format(self.topic))
+        MESSAGES_SENT.inc()
         self.confirmed += 1
         if self.confirmed == self.total:
             event.sender.close()
@@ -108,4 +466,6 @@ class SendHandler(MessagingHandler):
 
     def on_disconnected(self, event):
         logging.error("disconnected error while sending msg to server: {} for topic: {}".format(self.server, self.topic))
-        self.sent = self.confirmed
+        SENDER_DISCONNECTS.inc()
+        if self.confirmed < self.total:
+            self.message_sent = False  # sent again once the container has redialled and re-attached the link
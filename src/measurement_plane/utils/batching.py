@@ -0,0 +1,47 @@
+import threading
+from measurement_plane.utils.scheduler import Scheduler
+
+class ResultBatcher:
+    """
+    Collects result values and hands them to publish_callback as a list once
+    max_batch_size values are pending or the oldest one has waited max_linger seconds.
+    The linger deadline is a task of scheduler, so batches never start timer threads.
+    """
+    def __init__(self, publish_callback, max_batch_size : int, max_linger : float, scheduler : Scheduler):
+        self.publish_callback = publish_callback
+        self.max_batch_size = max_batch_size
+        self.max_linger = max_linger
+        self.scheduler = scheduler
+        self.batch = []
+        self.timer = None
+        # Publishing happens under the lock so batches leave in the order they were filled
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.batch.append(value)
+            if len(self.batch) >= self.max_batch_size:
+                self._publish()
+            elif self.timer is None:
+                self.timer = self.scheduler.schedule(self.max_linger, self.flush)
+
+    def extend(self, values):
+        with self.lock:
+            for value in values:
+                self.batch.append(value)
+                if len(self.batch) >= self.max_batch_size:
+                    self._publish()
+            if self.batch and self.timer is None:
+                self.timer = self.scheduler.schedule(self.max_linger, self.flush)
+
+    def flush(self):
+        with self.lock:
+            self._publish()
+
+    def _publish(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.batch:
+            batch, self.batch = self.batch, []
+            self.publish_callback(batch)
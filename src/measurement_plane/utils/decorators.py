@@ -1,9 +1,19 @@
 registered_capabilities = []
 
-def capability(cls):
+def capability(cls=None, *, process=False, cache_ttl=None):
     """
     Decorator to register capabilities.
+    Use @capability(process=True) to run the capability's execute_task in the agent's process pool.
+    Use @capability(cache_ttl=seconds) to reuse results of identical parameters for that long.
     """
-    print(f"Registering capability: {cls.__name__}")
-    registered_capabilities.append(cls)
-    return cls
\ No newline at end of file
+    def register(cls):
+        if process:
+            cls.run_in_process = True
+        if cache_ttl is not None:
+            cls.result_cache_ttl = cache_ttl
+        print(f"Registering capability: {cls.__name__}")
+        registered_capabilities.append(cls)
+        return cls
+    if cls is None:
+        return register
+    return register(cls)
@@ -0,0 +1,220 @@
+import bisect
+import weakref
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, sized for encode and dispatch times of a message
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name : str, help : str, labels : dict):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+
+    def label_text(self, extra : dict = None) -> str:
+        labels = dict(self.labels, **(extra or {}))
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labels):
+        super().__init__(registry, name, help, labels)
+        self.value = 0
+
+    def inc(self, amount = 1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def samples(self) -> list:
+        return [(self.name, self.label_text(), self.value)]
+
+class Gauge(Metric):
+    """
+    Value set by the instrumented code, or read from function when scraped. With an
+    owner, function is called with it and only a weak reference is kept, so the gauge
+    does not keep the owner alive; once it is collected the gauge has no samples.
+    """
+    kind = 'gauge'
+
+    def __init__(self, registry, name, help, labels, function = None, owner = None):
+        super().__init__(registry, name, help, labels)
+        self.value = 0
+        self.function = None
+        self.owner = None
+        self.read_from(function, owner)
+
+    def read_from(self, function, owner = None):
+        self.function = function
+        self.owner = weakref.ref(owner) if owner is not None else None
+
+    def set(self, value):
+        if self.registry.enabled:
+            self.value = value
+
+    def inc(self, amount = 1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount = 1):
+        self.inc(-amount)
+
+    def samples(self) -> list:
+        if self.owner is not None:
+            owner = self.owner()
+            if owner is None:
+                return []
+            value = self.function(owner)
+        else:
+            value = self.function() if self.function else self.value
+        return [(self.name, self.label_text(), value)]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels, buckets = DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self) -> list:
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket', self.label_text({'le': '+Inf' if bound == float('inf') else repr(bound)}), cumulative))
+        samples.append((f'{self.name}_sum', self.label_text(), total))
+        samples.append((f'{self.name}_count', self.label_text(), cumulative))
+        return samples
+
+class MetricsRegistry:
+    """
+    Counters, gauges and fixed-bucket histograms. While disabled, updates return after
+    a single attribute check, so instrumentation can stay in hot paths.
+    """
+    def __init__(self, enabled : bool = False):
+        self.enabled = enabled
+        self.metrics = {}  # (name, sorted labels) -> Metric
+        self.lock = threading.Lock()
+
+    def get(self, metric_cls, name, help, labels, **kwargs) -> Metric:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = metric_cls(self, name, help, labels, **kwargs)
+                self.metrics[key] = metric
+            return metric
+
+    def counter(self, name : str, help : str = '', **labels) -> Counter:
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name : str, help : str = '', function = None, owner = None, **labels) -> Gauge:
+        gauge = self.get(Gauge, name, help, labels)
+        if function is not None:
+            gauge.read_from(function, owner)
+        return gauge
+
+    def unregister(self, metric : Metric):
+        key = (metric.name, tuple(sorted(metric.labels.items())))
+        with self.lock:
+            if self.metrics.get(key) is metric:
+                del self.metrics[key]
+
+    def histogram(self, name : str, help : str = '', buckets = DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self.get(Histogram, name, help, labels, buckets=buckets)
+
+    def snapshot(self) -> dict:
+        """
+        Current value of every sample, keyed by sample name plus labels.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {name + labels: value for metric in metrics for name, labels, value in metric.samples()}
+
+    def render_prometheus(self) -> str:
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        described = set()
+        for metric in metrics:
+            samples = metric.samples()
+            if not samples:
+                continue  # gauge of a collected owner
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in samples:
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, port : int, host : str = '') -> ThreadingHTTPServer:
+        """
+        Serves the Prometheus text exposition on http://host:port/metrics from a daemon thread.
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+# Process-wide registry used by the instrumented modules, disabled until enable_metrics()
+REGISTRY = MetricsRegistry()
+
+def enable_metrics(enabled : bool = True):
+    REGISTRY.enabled = enabled
+
+def metrics_enabled() -> bool:
+    return REGISTRY.enabled
+
+def counter(name : str, help : str = '', **labels) -> Counter:
+    return REGISTRY.counter(name, help, **labels)
+
+def gauge(name : str, help : str = '', function = None, owner = None, **labels) -> Gauge:
+    return REGISTRY.gauge(name, help, function, owner, **labels)
+
+def unregister(metric : Metric):
+    REGISTRY.unregister(metric)
+
+def histogram(name : str, help : str = '', buckets = DEFAULT_BUCKETS, **labels) -> Histogram:
+    return REGISTRY.histogram(name, help, buckets, **labels)
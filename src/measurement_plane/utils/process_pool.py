@@ -0,0 +1,142 @@
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+SHARED_MEMORY_THRESHOLD = 64 * 1024  # smaller arrays are cheaper to pickle
+
+class SharedArray:
+    """
+    Picklable handle to an ndarray left in a shared memory block by a worker process.
+    """
+    def __init__(self, name : str, dtype : str, shape : tuple):
+        self.name = name
+        self.dtype = dtype
+        self.shape = shape
+
+def export_shared_arrays(data):
+    """
+    Recursively moves large ndarrays into shared memory blocks, replacing them with SharedArray handles.
+    """
+    if isinstance(data, dict):
+        return {key: export_shared_arrays(value) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [export_shared_arrays(item) for item in data]
+    elif isinstance(data, np.ndarray) and data.nbytes >= SHARED_MEMORY_THRESHOLD and not data.dtype.hasobject:
+        block = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+        handle = SharedArray(block.name, data.dtype.str, data.shape)
+        block.close()
+        return handle
+    return data
+
+def import_shared_arrays(data):
+    """
+    Replaces SharedArray handles with ndarrays and releases their shared memory blocks.
+    """
+    if isinstance(data, dict):
+        return {key: import_shared_arrays(value) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [import_shared_arrays(item) for item in data]
+    elif isinstance(data, SharedArray):
+        block = shared_memory.SharedMemory(name=data.name)
+        try:
+            return np.ndarray(data.shape, dtype=np.dtype(data.dtype), buffer=block.buf).copy()
+        finally:
+            block.close()
+            block.unlink()
+    return data
+
+def _execute_task(capability, parameters):
+    # Runs in the worker process on an unpickled copy of the capability
+    return export_shared_arrays(capability.execute_task(parameters=parameters))
+
+class CapabilityProcessPool:
+    """
+    Process pool for capabilities that opt in with run_in_process, created on first use.
+    """
+    def __init__(self, max_workers : int = None, start_method : str = "spawn"):
+        self.max_workers = max_workers
+        self.start_method = start_method
+        self.executor = None
+
+    def submit(self, capability, parameters):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(self.start_method))
+        return self.executor.submit(_execute_task, capability, parameters)
+
+    def result(self, future):
+        return import_shared_arrays(future.result())
+
+    def run(self, capability, parameters) -> Future:
+        """
+        Submits a task and returns a Future of its result with the shared arrays imported.
+        Cancelling that Future discards the task.
+        """
+        task = self.submit(capability, parameters)
+        result = Future()
+        result.add_done_callback(lambda result: self.discard(task) if result.cancelled() else None)
+        task.add_done_callback(lambda task: self._resolve(task, result))
+        return result
+
+    def _resolve(self, task, result : Future):
+        # A cancelled result has discarded the task, which then releases the shared memory
+        if not result.set_running_or_notify_cancel():
+            return
+        try:
+            result.set_result(self.result(task))
+        except BaseException as e:
+            result.set_exception(e)
+
+    def discard(self, future):
+        """
+        Drops a task whose result is no longer wanted, releasing its shared memory once it completes.
+        """
+        if not future.cancel():
+            future.add_done_callback(self._release)
+
+    def _release(self, future):
+        try:
+            import_shared_arrays(future.result())
+        except Exception as e:
+            logging.warning(f"Discarded process task failed: {e}")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+class ProcessTask:
+    """
+    A run waiting on a Future of the process pool, cancellable like a ScheduledTask:
+    cancel() and completion race for the run and only the winner handles it, so
+    callback(future) is not called once cancel() has returned True. With discard,
+    cancel() also cancels the Future; a Future shared with other runs is left alone.
+    """
+    def __init__(self, future : Future, callback, discard : bool = True):
+        self.future = future
+        self.callback = callback
+        self.discard = discard
+        self.settled = False
+        self.lock = threading.Lock()
+        future.add_done_callback(self._done)
+
+    def _settle(self) -> bool:
+        with self.lock:
+            if self.settled:
+                return False
+            self.settled = True
+            return True
+
+    def cancel(self) -> bool:
+        if not self._settle():
+            return False
+        if self.discard:
+            self.future.cancel()
+        return True
+
+    def _done(self, future : Future):
+        if self._settle():
+            self.callback(future)
@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import cProfile
+import pstats
+import threading
+import collections
+
+SAMPLE_MODE = 'sample'
+CPROFILE_MODE = 'cprofile'
+PROFILE_MODES = (SAMPLE_MODE, CPROFILE_MODE)
+SAMPLE_INTERVAL = 0.005
+PROFILE_DURATION = 10
+MAX_PROFILE_DURATION = 300  # a forgotten window never keeps profiling for long
+MIN_SAMPLE_INTERVAL = 0.001  # a tiny interval would have the sampler spin on the GIL
+REPORT_TOP = 30
+
+# (file name, function) of leaf frames where a thread is only waiting; such samples are counted as idle
+IDLE_LEAVES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),  # ThreadPoolExecutor worker blocked on its work queue
+    ('selectors.py', 'select'),
+    ('_io.py', 'select'),
+    ('_reactor.py', 'process'),
+    ('socketserver.py', 'serve_forever'),
+}
+
+def function_name(code) -> str:
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+class ProfileSession:
+    """
+    One bounded profiling window. In sample mode a thread records the Python stacks of
+    the other threads every interval; in cprofile mode the runs handed to call() are
+    executed under cProfile. When the window closes, a report of the hottest functions
+    is passed to on_report. With a capability, only its work is profiled: stacks that
+    pass through a frame of that capability, or runs of it.
+    """
+    def __init__(self, mode : str = SAMPLE_MODE, duration : float = PROFILE_DURATION, interval : float = SAMPLE_INTERVAL,
+                 capability = None, top : int = REPORT_TOP, on_report = None):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.duration = min(max(duration, 0), MAX_PROFILE_DURATION)
+        self.interval = max(interval, MIN_SAMPLE_INTERVAL)
+        self.capability = capability
+        self.top = top
+        self.on_report = on_report
+        self.started = None
+        self.samples = 0
+        self.idle_samples = 0
+        self.self_counts = collections.Counter()
+        self.total_counts = collections.Counter()
+        self.stats = None  # pstats.Stats of every profiled run
+        self.runs = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    @property
+    def active(self) -> bool:
+        return self.started is not None and not self.stopped.is_set()
+
+    def start(self) -> 'ProfileSession':
+        self.started = time.time()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Closes the window early; the report is still produced.
+        """
+        self.stopped.set()
+
+    def run(self):
+        deadline = time.monotonic() + self.duration
+        if self.mode == SAMPLE_MODE:
+            while not self.stopped.wait(self.interval) and time.monotonic() < deadline:
+                self.sample()
+        else:
+            self.stopped.wait(self.duration)
+        self.stopped.set()
+        if self.on_report:
+            self.on_report(self.report())
+
+    def sample(self):
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            leaf = frame.f_code
+            codes = []
+            matched = self.capability is None
+            while frame is not None:
+                codes.append(frame.f_code)
+                if not matched:
+                    frame_locals = frame.f_locals
+                    matched = frame_locals.get('self') is self.capability or frame_locals.get('capability') is self.capability
+                frame = frame.f_back
+            if not matched:
+                continue
+            if (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_LEAVES:
+                self.idle_samples += 1
+                continue
+            self.samples += 1
+            self.self_counts[function_name(leaf)] += 1
+            for code in set(codes):  # recursion counts a function once per sample
+                self.total_counts[function_name(code)] += 1
+
+    def profiles_calls(self, capability) -> bool:
+        return self.mode == CPROFILE_MODE and self.active and (self.capability is None or capability is self.capability)
+
+    def call(self, function):
+        """
+        Runs function under cProfile and merges its statistics into the session.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return function()  # from Python 3.12 only one profiler can be active at a time
+        try:
+            return function()
+        finally:
+            profile.disable()
+            with self.lock:
+                self.runs += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def report(self) -> dict:
+        report = {
+            "mode": self.mode,
+            "capabilityName": getattr(self.capability, 'name', None),
+            "started": self.started,
+            "duration": time.time() - self.started,
+        }
+        if self.mode == SAMPLE_MODE:
+            report.update({
+                "interval": self.interval,
+                "samples": self.samples,
+                "idleSamples": self.idle_samples,
+                "functions": [{"function": function, "self": count, "total": self.total_counts[function],
+                               "selfFraction": count / self.samples}
+                              for function, count in self.self_counts.most_common(self.top)],
+            })
+        else:
+            with self.lock:
+                entries = self.stats.stats.items() if self.stats is not None else ()
+                hottest = sorted(entries, key=lambda entry: entry[1][2], reverse=True)[:self.top]
+                report.update({
+                    "runs": self.runs,
+                    "functions": [{"function": f"{filename}:{line}({name})", "calls": calls, "selfSeconds": self_time, "totalSeconds": total_time}
+                                  for (filename, line, name), (_, calls, self_time, total_time, _) in hottest],
+                })
+        return report
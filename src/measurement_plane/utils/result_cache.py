@@ -0,0 +1,168 @@
+import json
+import time
+import threading
+import collections
+from concurrent.futures import Future, wait
+from measurement_plane.utils import metrics
+
+RESULT_CACHE_SIZE = 128
+WAIT_POLL_INTERVAL = 0.1  # seconds between interrupt checks of a coalesced request
+
+def cache_key(parameters) -> str:
+    # Canonical form, so key order never splits the entries of equal parameters
+    return json.dumps(parameters, sort_keys=True, separators=(',', ':'), default=str)
+
+def outcome(future : Future) -> tuple:
+    """
+    (result, error) of a done future; a cancelled one counts as a None result.
+    """
+    if future.cancelled():
+        return None, None
+    error = future.exception()
+    return (None, error) if error is not None else (future.result(), None)
+
+def copy_outcome(source : Future, target : Future):
+    def copy(source : Future):
+        result, error = outcome(source)
+        if error is not None:
+            target.set_exception(error)
+        else:
+            target.set_result(result)
+    source.add_done_callback(copy)
+
+class ResultCache:
+    """
+    Results of one capability by parameters, kept for ttl seconds and evicted least
+    recently used beyond max_entries. Identical requests arriving while one is being
+    computed wait for that computation instead of starting their own. None results
+    (interrupted or discarded runs) are never cached nor shared: waiters then compute
+    their own.
+    """
+    def __init__(self, ttl : float, max_entries : int = RESULT_CACHE_SIZE, name : str = ''):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # key -> (monotonic expiry, result), oldest use first
+        self.in_flight = {}  # key -> Future of the running computation
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+        self.hit_counter = metrics.counter('mp_result_cache_requests_total', 'Result cache lookups', capability=name, result='hit')
+        self.miss_counter = metrics.counter('mp_result_cache_requests_total', 'Result cache lookups', capability=name, result='miss')
+        self.coalesced_counter = metrics.counter('mp_result_cache_requests_total', 'Result cache lookups', capability=name, result='coalesced')
+
+    def get_or_compute(self, parameters, compute, interrupt_event : threading.Event = None):
+        """
+        Returns the cached result for parameters, or the one compute() returns. While
+        waiting for an identical request, returns None once interrupt_event is set.
+        """
+        key = cache_key(parameters)
+        while True:
+            hit, value = self.lookup(key)
+            if hit:
+                return value
+            if value is None:
+                return self.compute(key, compute)
+            result = self.wait_for(value, interrupt_event)
+            if result is None and not (interrupt_event and interrupt_event.is_set()):
+                continue  # the shared run was interrupted or discarded, not this one
+            return result
+
+    def get_or_submit(self, parameters, submit) -> Future:
+        """
+        get_or_compute without blocking: submit() starts the computation and returns a
+        Future of its result, and a Future of the result is returned in turn.
+        """
+        key = cache_key(parameters)
+        hit, value = self.lookup(key)
+        if hit:
+            future = Future()
+            future.set_result(value)
+            return future
+        if value is None:
+            with self.lock:
+                shared = self.in_flight[key]
+            try:
+                computation = submit()
+            except BaseException as e:
+                self.store(key, shared, error=e)
+                raise
+            computation.add_done_callback(lambda computation: self.store(key, shared, *outcome(computation)))
+            return shared
+        # A None result of the shared run is not this run's, it then submits its own
+        future = Future()
+        def shared_done(shared : Future):
+            if not shared.cancelled() and shared.exception() is None and shared.result() is None:
+                copy_outcome(self.get_or_submit(parameters, submit), future)
+            else:
+                copy_outcome(shared, future)
+        value.add_done_callback(shared_done)
+        return future
+
+    def lookup(self, key : str) -> tuple:
+        """
+        (True, cached result), (False, Future of the identical request in flight), or
+        (False, None) when the caller is to compute the result itself.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    self.hit_counter.inc()
+                    return True, entry[1]
+                del self.entries[key]
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                self.coalesced_counter.inc()
+                return False, future
+            self.misses += 1
+            self.miss_counter.inc()
+            self.in_flight[key] = Future()
+            return False, None
+
+    @staticmethod
+    def wait_for(future : Future, interrupt_event : threading.Event = None):
+        while not wait([future], timeout=WAIT_POLL_INTERVAL).done:
+            if interrupt_event is not None and interrupt_event.is_set():
+                return None
+        return future.result()
+
+    def compute(self, key : str, compute):
+        with self.lock:
+            future = self.in_flight[key]
+        try:
+            result = compute()
+        except BaseException as e:
+            self.store(key, future, error=e)
+            raise
+        self.store(key, future, result)
+        return result
+
+    def store(self, key : str, future : Future, result = None, error : BaseException = None):
+        """
+        Ends the computation in flight for key, caching a result that is not None, and
+        hands the outcome to the requests waiting on future.
+        """
+        with self.lock:
+            del self.in_flight[key]
+            if error is None and result is not None:
+                self.entries[key] = (time.monotonic() + self.ttl, result)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
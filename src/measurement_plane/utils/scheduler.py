@@ -0,0 +1,98 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEDULER_WORKERS = 32
+
+class ScheduledTask:
+    PENDING, DISPATCHED, CANCELLED = range(3)
+
+    def __init__(self, scheduler, fire_at : float, callback):
+        self.scheduler = scheduler
+        self.fire_at = fire_at
+        self.callback = callback
+        self.state = ScheduledTask.PENDING
+
+    def cancel(self) -> bool:
+        """
+        Cancels the task if it has not been dispatched yet. Returns True only to the
+        caller that cancelled it, so exactly one caller handles the cancellation; a
+        task already cancelled or dispatched returns False.
+        """
+        return self.scheduler.cancel(self)
+
+    def run(self):
+        try:
+            self.callback()
+        except Exception as e:
+            logging.exception(f"Scheduled task failed: {e}")
+
+class Scheduler:
+    """
+    Single timer thread keeping a heap of fire times, handing due tasks to a bounded
+    worker pool.
+    """
+    def __init__(self, max_workers : int = SCHEDULER_WORKERS):
+        self.heap = []
+        self.counter = itertools.count()  # tie-breaker so equal fire times never compare tasks
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="measurement")
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.running = False
+
+    def start(self):
+        with self.condition:
+            if not self.running:
+                self.running = True
+                self.thread.start()
+
+    def schedule(self, delay : float, callback) -> ScheduledTask:
+        task = ScheduledTask(self, time.monotonic() + max(delay, 0), callback)
+        with self.condition:
+            heapq.heappush(self.heap, (task.fire_at, next(self.counter), task))
+            # Wake the timer thread only if this task is now the earliest one
+            if self.heap[0][2] is task:
+                self.condition.notify()
+        return task
+
+    def schedule_at(self, when : datetime, callback) -> ScheduledTask:
+        return self.schedule((when - datetime.now()).total_seconds(), callback)
+
+    def cancel(self, task : ScheduledTask) -> bool:
+        with self.condition:
+            if task.state != ScheduledTask.PENDING:
+                return False
+            task.state = ScheduledTask.CANCELLED
+            self.condition.notify()
+            return True
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            for _, _, task in self.heap:
+                task.state = ScheduledTask.CANCELLED
+            self.heap = []
+            self.condition.notify()
+        self.executor.shutdown(wait=False)
+
+    def _run(self):
+        with self.condition:
+            while self.running:
+                # Cancelled tasks are dropped lazily when they reach the top of the heap
+                while self.heap and self.heap[0][2].state == ScheduledTask.CANCELLED:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                _, _, task = heapq.heappop(self.heap)
+                task.state = ScheduledTask.DISPATCHED
+                self.executor.submit(task.run)
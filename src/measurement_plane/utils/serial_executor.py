@@ -0,0 +1,50 @@
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+DISPATCH_WORKERS = 8
+
+class KeyedSerialExecutor:
+    """
+    Runs callables on a worker pool, one at a time and in submission order for each
+    key, while callables of different keys run in parallel. A key holds at most one
+    worker at a time and gives it back after each callable, so a busy key cannot
+    starve the others.
+    """
+    def __init__(self, max_workers : int = DISPATCH_WORKERS, thread_name_prefix : str = "dispatch"):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.waiting = {}  # key with a callable running -> deque of the callables queued behind it
+        self.lock = threading.Lock()
+
+    def submit(self, key, callback):
+        with self.lock:
+            waiting = self.waiting.get(key)
+            if waiting is not None:
+                waiting.append(callback)
+                return
+            self.waiting[key] = collections.deque()
+        self.executor.submit(self._run, key, callback)
+
+    def _run(self, key, callback):
+        try:
+            callback()
+        except Exception as e:
+            logging.exception(f"Dispatched task failed: {e}")
+        with self.lock:
+            waiting = self.waiting[key]
+            if not waiting:
+                del self.waiting[key]
+                return
+            callback = waiting.popleft()
+        self.executor.submit(self._run, key, callback)
+
+    def pending(self) -> int:
+        """
+        Number of callables queued behind a running one.
+        """
+        with self.lock:
+            return sum(len(waiting) for waiting in self.waiting.values())
+
+    def shutdown(self, wait : bool = False):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,51 @@
+import queue
+from measurement_plane.messaging.message_format import MessageFields
+
+STREAM_BUFFER_SIZE = 1000
+
+class OverflowPolicy:
+    BLOCK = 'block'              # producer waits for room
+    DROP_OLDEST = 'drop_oldest'  # oldest buffered item is discarded
+    DROP_NEWEST = 'drop_newest'  # incoming item is discarded
+    MERGE = 'merge'              # incoming item is merged into the newest buffered one
+
+class StreamBuffer(queue.Queue):
+    """
+    Bounded queue for stream results with a selectable overflow policy.
+    The EOF_results marker is never dropped or merged.
+    """
+    def __init__(self, maxsize : int = STREAM_BUFFER_SIZE, policy : str = OverflowPolicy.BLOCK, merge_callback = None):
+        if policy == OverflowPolicy.MERGE and merge_callback is None:
+            raise ValueError("The merge overflow policy requires a merge_callback(buffered, incoming)")
+        super().__init__(maxsize)
+        self.policy = policy
+        self.merge_callback = merge_callback
+        self.dropped = 0
+        self.merged = 0
+
+    def put(self, item, block=True, timeout=None):
+        eof = isinstance(item, str) and item == MessageFields.EOF_RESULTS
+        if self.policy == OverflowPolicy.BLOCK:
+            return super().put(item, block, timeout)
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize() and not eof:
+                if self.policy == OverflowPolicy.DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                if self.policy == OverflowPolicy.DROP_OLDEST:
+                    self._get()
+                    self.dropped += 1
+                elif self.policy == OverflowPolicy.MERGE:
+                    self.queue[-1] = self.merge_callback(self.queue[-1], item)
+                    self.merged += 1
+                    return
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    @property
+    def depth(self) -> int:
+        return self.qsize()
+
+    def stats(self) -> dict:
+        return {"depth": self.qsize(), "capacity": self.maxsize, "dropped": self.dropped, "merged": self.merged}
@@ -0,0 +1,162 @@
+import json
+import time
+import uuid
+import threading
+
+TRACE_ID = 'traceId'
+TRACE_STAGES = 'stages'
+
+# Client stages
+CONFIGURED = 'configured'
+DISPATCHED = 'dispatched'  # send_measurement called, the receipt link is being attached
+SPECIFICATION_SENT = 'specificationSent'
+RECEIPT_RECEIVED = 'receiptReceived'
+RESULT_RECEIVED = 'resultReceived'
+RESULT_DECODED = 'resultDecoded'
+RESULT_DELIVERED = 'resultDelivered'  # the result callback returned, or the batch was spooled
+EOF_RECEIVED = 'eofReceived'
+# Agent stages, the run stages are overwritten by every run
+AGENT_RECEIVED = 'agentReceived'
+SCHEDULED = 'scheduled'
+RUN_DUE = 'runDue'
+RUN_STARTED = 'runStarted'
+EXECUTED = 'executed'
+PUBLISHED = 'published'
+
+# Latency name -> (from stage, to stage)
+MEASUREMENT_LATENCIES = {
+    'dispatch': (DISPATCHED, SPECIFICATION_SENT),
+    'specification_transit': (SPECIFICATION_SENT, AGENT_RECEIVED),
+    'receipt': (AGENT_RECEIVED, RECEIPT_RECEIVED),
+    'round_trip': (DISPATCHED, RECEIPT_RECEIVED),
+    'total': (CONFIGURED, EOF_RECEIVED),
+}
+RESULT_LATENCIES = {
+    'start_delay': (RUN_DUE, RUN_STARTED),
+    'execute': (RUN_STARTED, EXECUTED),
+    'publish': (EXECUTED, PUBLISHED),
+    'result_transit': (PUBLISHED, RESULT_RECEIVED),
+    'decode': (RESULT_RECEIVED, RESULT_DECODED),
+    'callback': (RESULT_DECODED, RESULT_DELIVERED),
+}
+
+def latencies(stages : dict, spans : dict) -> dict:
+    return {name: stages[end] - stages[start] for name, (start, end) in spans.items() if start in stages and end in stages}
+
+class TraceContext:
+    """
+    Trace id and stage timestamps (time.time(), so they compare across processes on
+    hosts with synchronized clocks) carried in the trace field of a message.
+    """
+    def __init__(self, trace_id : str = None, stages : dict = None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.stages = dict(stages or {})
+
+    def mark(self, stage : str, at : float = None):
+        self.stages[stage] = time.time() if at is None else at
+
+    def to_message(self) -> dict:
+        return {TRACE_ID: self.trace_id, TRACE_STAGES: dict(self.stages)}
+
+    @staticmethod
+    def from_message(trace_msg) -> 'TraceContext':
+        if not isinstance(trace_msg, dict) or TRACE_ID not in trace_msg:
+            return None
+        return TraceContext(trace_msg[TRACE_ID], trace_msg.get(TRACE_STAGES))
+
+class MeasurementTrace:
+    """
+    Lifecycle of one measurement as seen by the client: its own stages, the agent
+    stages returned in the receipt, the first result in full, and running sums of
+    the per-result latencies so long streams stay bounded.
+    """
+    def __init__(self, context : TraceContext = None):
+        self.context = context or TraceContext()
+        self.measurement_id = None
+        self.capability_name = None
+        self.endpoint = None
+        self.first_result = None
+        self.result_count = 0
+        self.result_totals = {}
+        self.result_maxima = {}
+        self.lock = threading.Lock()
+
+    @property
+    def trace_id(self) -> str:
+        return self.context.trace_id
+
+    def mark(self, stage : str, at : float = None):
+        self.context.mark(stage, at)
+
+    def merge(self, trace_msg):
+        """
+        Adds the stages the agent recorded, as returned in a receipt.
+        """
+        remote = TraceContext.from_message(trace_msg)
+        if remote is not None and remote.trace_id == self.trace_id:
+            with self.lock:
+                for stage, at in remote.stages.items():
+                    self.context.stages.setdefault(stage, at)
+
+    def add_result(self, trace_msg, received : float, decoded : float, delivered : float):
+        remote = TraceContext.from_message(trace_msg)
+        stages = dict(remote.stages) if remote is not None else {}
+        stages.update({RESULT_RECEIVED: received, RESULT_DECODED: decoded, RESULT_DELIVERED: delivered})
+        result_latencies = latencies(stages, RESULT_LATENCIES)
+        with self.lock:
+            if self.first_result is None:
+                self.first_result = {'stages': stages, 'latencies': result_latencies}
+            self.result_count += 1
+            for name, value in result_latencies.items():
+                self.result_totals[name] = self.result_totals.get(name, 0.0) + value
+                self.result_maxima[name] = max(self.result_maxima.get(name, value), value)
+
+    def record(self) -> dict:
+        """
+        Structured latency breakdown, in seconds, of the measurement so far.
+        """
+        with self.lock:
+            stages = dict(self.context.stages)
+            return {
+                'trace_id': self.trace_id,
+                'measurement_id': self.measurement_id,
+                'capability_name': self.capability_name,
+                'endpoint': self.endpoint,
+                'stages': stages,
+                'latencies': latencies(stages, MEASUREMENT_LATENCIES),
+                'first_result': self.first_result,
+                'results': self.result_count,
+                'result_latencies_mean': {name: total / self.result_count for name, total in self.result_totals.items()},
+                'result_latencies_max': dict(self.result_maxima),
+            }
+
+class TraceRecorder:
+    """
+    Keeps the records of the last max_records finished measurements and hands each
+    one to the optional sink callable, e.g. to ship it to a log pipeline.
+    """
+    def __init__(self, max_records : int = 1000, sink = None):
+        self.max_records = max_records
+        self.sink = sink
+        self.finished = []
+        self.lock = threading.Lock()
+
+    def add(self, trace : MeasurementTrace):
+        record = trace.record()
+        with self.lock:
+            self.finished.append(record)
+            del self.finished[:-self.max_records]
+        if self.sink:
+            self.sink(record)
+
+    def records(self) -> list:
+        with self.lock:
+            return list(self.finished)
+
+    def export(self, path : str):
+        """
+        Appends the finished records to path as JSON lines.
+        """
+        with open(path, 'a') as output:
+            for record in self.records():
+                output.write(json.dumps(record) + '\n')
@@ -0,0 +1,54 @@
+import threading
+import numpy as np
+from jsonschema import validators, exceptions as jsonschema_exceptions
+
+def _numpy_aware(validator_cls):
+    """
+    Extends validator_cls so ndarrays count as arrays and NumPy scalars as numbers,
+    letting capability output be checked before it is converted for sending.
+    """
+    type_checker = validator_cls.TYPE_CHECKER.redefine_many({
+        'array': lambda checker, instance: isinstance(instance, (list, tuple, np.ndarray)),
+        'number': lambda checker, instance: validator_cls.TYPE_CHECKER.is_type(instance, 'number') or isinstance(instance, (np.integer, np.floating)),
+        'integer': lambda checker, instance: validator_cls.TYPE_CHECKER.is_type(instance, 'integer') or isinstance(instance, np.integer),
+    })
+    return validators.extend(validator_cls, type_checker=type_checker)
+
+class ValidatorCache:
+    """
+    Compiled jsonschema validators per capability_id. A cached validator is reused while
+    the schema it was built from is the same object or compares equal to the one given,
+    so a re-advertised capability with a changed schema gets a new validator.
+    """
+    def __init__(self, numpy_types : bool = False):
+        self.numpy_types = numpy_types
+        self.validators = {}  # capability_id -> (schema, validator)
+        self.lock = threading.Lock()
+
+    def get(self, capability_id : str, schema : dict):
+        cached = self.validators.get(capability_id)
+        if cached is not None and (cached[0] is schema or cached[0] == schema):
+            return cached[1]
+        validator_cls = validators.validator_for(schema)
+        validator_cls.check_schema(schema)  # raises SchemaError, as jsonschema.validate does
+        if self.numpy_types:
+            validator_cls = _numpy_aware(validator_cls)
+        validator = validator_cls(schema)
+        with self.lock:
+            self.validators[capability_id] = (schema, validator)
+        return validator
+
+    def validate(self, capability_id : str, schema : dict, instance):
+        """
+        Same as jsonschema.validate(instance, schema): raises the best matching ValidationError.
+        """
+        error = jsonschema_exceptions.best_match(self.get(capability_id, schema).iter_errors(instance))
+        if error is not None:
+            raise error
+
+    def invalidate(self, capability_id : str = None):
+        with self.lock:
+            if capability_id is None:
+                self.validators = {}
+            else:
+                self.validators.pop(capability_id, None)
@@ -0,0 +1,40 @@
+import threading
+import pytest
+from measurement_plane.utils.batching import ResultBatcher
+from measurement_plane.utils.scheduler import Scheduler
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler(max_workers=2)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+def test_publishes_full_batches_in_order(scheduler):
+    published = []
+    batcher = ResultBatcher(published.append, 3, 60, scheduler)
+    batcher.extend(range(7))
+    assert published == [[0, 1, 2], [3, 4, 5]]
+    batcher.flush()
+    assert published == [[0, 1, 2], [3, 4, 5], [6]]
+
+def test_linger_flushes_without_timer_threads(scheduler):
+    published = threading.Event()
+    batches = []
+    batcher = ResultBatcher(lambda batch: (batches.append(batch), published.set()), 100, 0.05, scheduler)
+    threads = threading.active_count()
+    for value in range(3):
+        batcher.add(value)
+    assert threading.active_count() == threads
+    assert published.wait(timeout=2)
+    assert batches == [[0, 1, 2]]
+
+def test_full_batch_cancels_the_linger(scheduler):
+    batches = []
+    batcher = ResultBatcher(batches.append, 2, 0.05, scheduler)
+    batcher.add(1)
+    timer = batcher.timer
+    batcher.add(2)
+    assert batcher.timer is None
+    assert not timer.cancel()  # already cancelled by the full batch
+    assert batches == [[1, 2]]
@@ -0,0 +1,102 @@
+import time
+import pytest
+from measurement_plane.messaging.message import Message
+from measurement_plane.messaging.message_format import MessageFields
+from measurement_plane.measurement_plane_client.utils.broker import CapabilitiesManager, CapabilitySnapshot
+
+def capability(endpoint, name, capability_type="measure"):
+    return {MessageFields.ENDPOINT: endpoint, MessageFields.CAPABILITY_NAME: name, MessageFields.CAPABILITY: capability_type}
+
+def capability_id(capability_msg):
+    return Message.calculate_capability_id(message=capability_msg)
+
+@pytest.fixture
+def manager():
+    manager = CapabilitiesManager(60)
+    yield manager
+    manager.close()
+
+def test_options_are_keyword_only():
+    with pytest.raises(TypeError):
+        CapabilitiesManager(60, 5)
+
+def test_snapshots_are_copied_on_write():
+    echo = capability("/a", "echo")
+    empty = CapabilitySnapshot({}, {}, {}, {})
+    snapshot = empty.apply({capability_id(echo): echo}, ())
+    assert dict(empty.capabilities) == {} and dict(empty.by_endpoint) == {}
+    assert snapshot.by_endpoint["/a"] == frozenset([capability_id(echo)])
+    removed = snapshot.apply({}, [capability_id(echo)])
+    assert capability_id(echo) in snapshot.capabilities
+    assert dict(removed.capabilities) == {} and dict(removed.by_name) == {} and dict(removed.by_type) == {}
+    with pytest.raises(TypeError):
+        snapshot.capabilities["other"] = echo
+
+def test_replacing_a_capability_moves_it_between_index_entries():
+    old = capability("/a", "echo", "measure")
+    new = capability("/a", "echo", "analyze")
+    snapshot = CapabilitySnapshot({}, {}, {}, {}).apply({capability_id(old): old}, ()).apply({capability_id(new): new}, ())
+    assert "measure" not in snapshot.by_type
+    assert snapshot.by_type["analyze"] == frozenset([capability_id(new)])
+
+def test_get_capabilities_filters_by_index(manager):
+    echo_a, echo_b, ping_a = capability("/a", "echo"), capability("/b", "echo"), capability("/a", "ping", "analyze")
+    manager.add_advertisement("/a", [echo_a, ping_a], "hash-a")
+    manager.add_advertisement("/b", [echo_b], "hash-b")
+    ids = lambda capabilities: set(capabilities)
+    assert ids(manager.get_capabilities()) == {capability_id(echo_a), capability_id(echo_b), capability_id(ping_a)}
+    assert ids(manager.get_capabilities(endpoint="/a")) == {capability_id(echo_a), capability_id(ping_a)}
+    assert ids(manager.get_capabilities(name="echo")) == {capability_id(echo_a), capability_id(echo_b)}
+    assert ids(manager.get_capabilities(capability_types=["analyze"])) == {capability_id(ping_a)}
+    assert ids(manager.get_capabilities(["measure"], endpoint="/a")) == {capability_id(echo_a)}
+    assert manager.get_capabilities(endpoint="/c") == {}
+
+def test_advertisement_withdraws_missing_capabilities(manager):
+    echo, ping = capability("/a", "echo"), capability("/a", "ping")
+    manager.add_advertisement("/a", [echo, ping], "first")
+    manager.add_advertisement("/a", [echo], "second")
+    assert set(manager.capabilities) == {capability_id(echo)}
+    assert manager.get_capabilities(name="ping") == {}
+
+def test_heartbeat_needs_the_hash_of_the_last_advertisement(manager):
+    manager.add_advertisement("/a", [capability("/a", "echo")], "hash")
+    assert manager.refresh_advertisement("/a", "hash")
+    assert not manager.refresh_advertisement("/a", "other")
+    assert not manager.refresh_advertisement("/b", "hash")
+
+def test_capabilities_expire_after_the_timeout():
+    manager = CapabilitiesManager(0.3)
+    try:
+        manager.add_advertisement("/a", [capability("/a", "echo")], "hash")
+        time.sleep(0.15)
+        manager.add_advertisement("/b", [capability("/b", "echo")], "hash")
+        time.sleep(0.25)
+        assert manager.get_capabilities(endpoint="/a") == {}
+        assert len(manager.get_capabilities(endpoint="/b")) == 1
+        # An expired endpoint is forgotten, so its heartbeat asks for a new advertisement
+        assert not manager.refresh_advertisement("/a", "hash")
+    finally:
+        manager.close()
+
+def test_refresh_pushes_the_deadline_back():
+    manager = CapabilitiesManager(0.2)
+    try:
+        echo = capability("/a", "echo")
+        manager.add_advertisement("/a", [echo], "hash")
+        for _ in range(4):
+            time.sleep(0.1)
+            assert manager.refresh_advertisement("/a", "hash")
+        assert capability_id(echo) in manager.capabilities
+        assert len(manager.deadlines) == 1  # refreshed ids keep a single heap entry
+        time.sleep(0.35)
+        assert manager.capabilities == {}
+    finally:
+        manager.close()
+
+def test_remove_stale_capabilities_returns_the_next_deadline(manager):
+    with manager.lock:
+        assert manager.remove_stale_capabilities() is None
+    manager.add_capability("id", capability("/a", "echo"))
+    with manager.lock:
+        delay = manager.remove_stale_capabilities()
+    assert 59 < delay <= 60
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from proton import Message
+from measurement_plane.protocols.amqp.encoding import encode_frame, decode_frame, decode_message, FRAME_CONTENT_TYPE, FRAME_ALIGNMENT
+
+def test_plain_values_round_trip():
+    data = {"name": "echo", "values": [1, 2.5, None, True, "text"], "nested": {"a": [{"b": 1}]}}
+    assert decode_frame(encode_frame(data)) == data
+
+def test_ndarrays_round_trip():
+    data = {
+        "float": np.linspace(0, 1, 1000),
+        "int": np.arange(24, dtype=np.int16).reshape(2, 3, 4),
+        "complex": np.array([1 + 2j, 3 - 4j], dtype=np.complex64),
+        "big_endian": np.arange(5, dtype='>u4'),
+        "scalar": np.array(7.0),
+        "empty": np.zeros((0, 3)),
+    }
+    decoded = decode_frame(encode_frame(data))
+    for key, array in data.items():
+        assert decoded[key].dtype == array.dtype
+        assert decoded[key].shape == array.shape
+        np.testing.assert_array_equal(decoded[key], array)
+
+def test_non_contiguous_array_round_trips():
+    array = np.arange(100, dtype=np.float64).reshape(10, 10)[::2, 1::3]
+    np.testing.assert_array_equal(decode_frame(encode_frame([array]))[0], array)
+
+def test_bytes_and_numpy_scalars_round_trip():
+    data = {"raw": b"\x00\x01\xff", "view": memoryview(b"abc"), "count": np.int64(3), "mean": np.float32(0.5)}
+    decoded = decode_frame(encode_frame(data))
+    assert decoded == {"raw": b"\x00\x01\xff", "view": b"abc", "count": 3, "mean": 0.5}
+
+def test_object_arrays_become_lists():
+    assert decode_frame(encode_frame({"labels": np.array(["a", 1], dtype=object)})) == {"labels": ["a", 1]}
+
+def test_decoded_arrays_are_aligned_read_only_views():
+    body = bytes(encode_frame({"a": np.arange(3, dtype=np.uint8), "b": np.arange(10, dtype=np.float64)}))
+    start = np.frombuffer(body, dtype=np.uint8).__array_interface__['data'][0]
+    for array in decode_frame(body).values():
+        assert not array.flags.writeable
+        assert (array.__array_interface__['data'][0] - start) % FRAME_ALIGNMENT == 0
+
+def test_frame_message_round_trips_through_amqp_encoding():
+    sent = Message(body=bytes(encode_frame({"values": np.arange(4)})), content_type=FRAME_CONTENT_TYPE)
+    received = Message()
+    received.decode(sent.encode())
+    np.testing.assert_array_equal(decode_message(received)["values"], np.arange(4))
+
+def test_rejects_other_bodies():
+    with pytest.raises(ValueError):
+        decode_frame(b"JSON{}\x00\x00\x00\x00")
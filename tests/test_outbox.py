@@ -0,0 +1,90 @@
+import os
+from concurrent.futures import Future
+import pytest
+from proton import Message
+from measurement_plane.protocols.amqp.outbox import Outbox
+
+KEY = ("amqp://localhost:5672", "topic://results")
+
+def put(outbox, body, key=KEY):
+    future = Future()
+    return outbox.put(key, Message(body=body), future), future
+
+def drain(outbox, key=KEY):
+    bodies = []
+    entry = outbox.pop(key)
+    while entry is not None:
+        bodies.append(entry[0].body)
+        entry = outbox.pop(key)
+    return bodies
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = Outbox(max_messages=3, spill_directory=str(tmp_path / "spill"), max_spilled=4, name="test")
+    yield outbox
+    outbox.close()
+
+def test_keeps_order_across_memory_and_spill(outbox, tmp_path):
+    for index in range(7):
+        assert put(outbox, f"m{index}")[0]
+    assert (outbox.in_memory, outbox.spilled) == (3, 4)
+    assert len(os.listdir(tmp_path / "spill")) == 4
+    assert drain(outbox) == [f"m{index}" for index in range(7)]
+    assert outbox.depth() == 0
+    assert os.listdir(tmp_path / "spill") == []
+
+def test_refuses_beyond_memory_and_spill(outbox):
+    for index in range(7):
+        put(outbox, f"m{index}")
+    accepted, _ = put(outbox, "refused")
+    assert not accepted
+    assert outbox.depth() == 7
+
+def test_without_spill_directory_refuses_beyond_memory():
+    outbox = Outbox(max_messages=2)
+    try:
+        assert put(outbox, "a")[0] and put(outbox, "b")[0]
+        assert not put(outbox, "c")[0]
+    finally:
+        outbox.close()
+
+def test_requeue_puts_entries_back_in_front(outbox):
+    for index in range(5):
+        put(outbox, f"m{index}")
+    taken = [outbox.pop(KEY) for _ in range(2)]
+    put(outbox, "m5")
+    outbox.requeue(KEY, taken)
+    assert drain(outbox) == ["m0", "m1", "m2", "m3", "m4", "m5"]
+
+def test_requeued_spilled_entries_keep_their_order(outbox):
+    for index in range(7):
+        put(outbox, f"m{index}")
+    taken = [outbox.pop(KEY) for _ in range(5)]  # three from memory, two read back from disk
+    outbox.requeue(KEY, taken)
+    assert outbox.depth() == 7
+    assert drain(outbox) == [f"m{index}" for index in range(7)]
+
+def test_keys_are_independent(outbox):
+    other = ("amqp://localhost:5672", "topic://other")
+    put(outbox, "a1")
+    put(outbox, "b1", other)
+    put(outbox, "a2")
+    assert sorted(outbox.keys()) == sorted([KEY, other])
+    assert outbox.depth(KEY) == 2 and outbox.depth(other) == 1
+    assert drain(outbox, other) == ["b1"]
+    assert drain(outbox) == ["a1", "a2"]
+
+def test_fail_drops_messages_and_fails_their_futures(outbox, tmp_path):
+    futures = [put(outbox, f"m{index}")[1] for index in range(5)]
+    error = ConnectionError("link closed")
+    outbox.fail(KEY, error)
+    assert outbox.depth() == 0 and (outbox.in_memory, outbox.spilled) == (0, 0)
+    assert os.listdir(tmp_path / "spill") == []
+    assert all(future.exception() is error for future in futures)
+
+def test_oldest_age(outbox):
+    assert outbox.oldest_age() == 0.0
+    put(outbox, "m0")
+    assert outbox.oldest_age() >= 0.0
+    outbox.pop(KEY)
+    assert outbox.oldest_age() == 0.0
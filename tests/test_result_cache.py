@@ -0,0 +1,133 @@
+import threading
+import time
+from concurrent.futures import Future
+import pytest
+from measurement_plane.utils.result_cache import ResultCache, cache_key
+
+class Counter:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        self.started = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        time.sleep(self.delay)
+        return f"result {self.calls}"
+
+def in_thread(target):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(target()))
+    thread.start()
+    return thread, results
+
+def test_cache_key_ignores_key_order():
+    assert cache_key({"a": 1, "b": [1, 2]}) == cache_key({"b": [1, 2], "a": 1})
+
+def test_hits_within_ttl():
+    cache = ResultCache(ttl=60)
+    compute = Counter()
+    assert cache.get_or_compute({"n": 1}, compute) == "result 1"
+    assert cache.get_or_compute({"n": 1}, compute) == "result 1"
+    assert compute.calls == 1
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1, "coalesced": 0}
+
+def test_recomputes_after_ttl():
+    cache = ResultCache(ttl=0.05)
+    compute = Counter()
+    cache.get_or_compute({"n": 1}, compute)
+    time.sleep(0.1)
+    assert cache.get_or_compute({"n": 1}, compute) == "result 2"
+
+def test_evicts_least_recently_used():
+    cache = ResultCache(ttl=60, max_entries=2)
+    cache.get_or_compute({"n": 1}, lambda: "one")
+    cache.get_or_compute({"n": 2}, lambda: "two")
+    cache.get_or_compute({"n": 1}, lambda: "recomputed")  # a hit, 2 is now the oldest use
+    cache.get_or_compute({"n": 3}, lambda: "three")
+    assert cache.get_or_compute({"n": 1}, lambda: "recomputed") == "one"
+    assert cache.get_or_compute({"n": 2}, lambda: "recomputed") == "recomputed"
+
+def test_none_is_not_cached():
+    cache = ResultCache(ttl=60)
+    cache.get_or_compute({"n": 1}, lambda: None)
+    assert cache.get_or_compute({"n": 1}, lambda: "computed") == "computed"
+
+def test_errors_are_raised_and_not_cached():
+    cache = ResultCache(ttl=60)
+    def fail():
+        raise RuntimeError("failed")
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute({"n": 1}, fail)
+    assert cache.get_or_compute({"n": 1}, lambda: "computed") == "computed"
+
+def test_identical_requests_coalesce():
+    cache = ResultCache(ttl=60)
+    compute = Counter(delay=0.3)
+    owner, owner_results = in_thread(lambda: cache.get_or_compute({"n": 1}, compute))
+    compute.started.wait()
+    waiter, waiter_results = in_thread(lambda: cache.get_or_compute({"n": 1}, compute))
+    owner.join()
+    waiter.join()
+    assert owner_results == waiter_results == ["result 1"]
+    assert compute.calls == 1
+    assert cache.stats()["coalesced"] == 1
+
+def test_waiter_returns_on_its_own_interrupt():
+    cache = ResultCache(ttl=60)
+    compute = Counter(delay=1.0)
+    owner, _ = in_thread(lambda: cache.get_or_compute({"n": 1}, compute))
+    compute.started.wait()
+    interrupt = threading.Event()
+    waiter, waiter_results = in_thread(lambda: cache.get_or_compute({"n": 1}, compute, interrupt))
+    interrupt.set()
+    waiter.join(timeout=0.5)
+    assert not waiter.is_alive()
+    assert waiter_results == [None]
+    owner.join()
+
+def test_waiter_recomputes_when_the_shared_run_returns_none():
+    cache = ResultCache(ttl=60)
+    started = threading.Event()
+    def interrupted_run():
+        started.set()
+        time.sleep(0.3)
+        return None
+    owner, owner_results = in_thread(lambda: cache.get_or_compute({"n": 1}, interrupted_run))
+    started.wait()
+    waiter, waiter_results = in_thread(lambda: cache.get_or_compute({"n": 1}, lambda: "own result"))
+    owner.join()
+    waiter.join()
+    assert owner_results == [None]
+    assert waiter_results == ["own result"]
+
+def test_submitted_requests_coalesce_without_blocking():
+    cache = ResultCache(ttl=60)
+    pending = []
+    def submit():
+        future = Future()
+        pending.append(future)
+        return future
+    first = cache.get_or_submit({"n": 1}, submit)
+    second = cache.get_or_submit({"n": 1}, submit)
+    assert len(pending) == 1 and not first.done() and not second.done()
+    pending[0].set_result("result")
+    assert first.result(timeout=1) == second.result(timeout=1) == "result"
+    assert cache.get_or_submit({"n": 1}, submit).result(timeout=1) == "result"
+    assert len(pending) == 1
+
+def test_submitted_waiter_resubmits_after_a_none_result():
+    cache = ResultCache(ttl=60)
+    pending = []
+    def submit():
+        future = Future()
+        pending.append(future)
+        return future
+    first = cache.get_or_submit({"n": 1}, submit)
+    second = cache.get_or_submit({"n": 1}, submit)
+    pending[0].set_result(None)
+    assert first.result(timeout=1) is None
+    assert len(pending) == 2 and not second.done()
+    pending[1].set_result("own result")
+    assert second.result(timeout=1) == "own result"
@@ -0,0 +1,77 @@
+import threading
+import time
+from datetime import datetime, timedelta
+import pytest
+from measurement_plane.utils.scheduler import Scheduler, ScheduledTask
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler(max_workers=4)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+def test_fires_in_order_of_fire_time(scheduler):
+    fired = []
+    done = threading.Event()
+    for delay in (0.15, 0.05, 0.1):
+        scheduler.schedule(delay, lambda delay=delay: fired.append(delay))
+    scheduler.schedule(0.2, done.set)
+    assert done.wait(timeout=2)
+    assert fired == [0.05, 0.1, 0.15]
+
+def test_cancel_returns_true_to_one_caller_only(scheduler):
+    fired = threading.Event()
+    task = scheduler.schedule(0.2, fired.set)
+    results = []
+    callers = [threading.Thread(target=lambda: results.append(task.cancel())) for _ in range(8)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    assert results.count(True) == 1
+    assert task.state == ScheduledTask.CANCELLED
+    assert not fired.wait(timeout=0.4)
+
+def test_cancel_after_dispatch_returns_false(scheduler):
+    started = threading.Event()
+    release = threading.Event()
+    task = scheduler.schedule(0, lambda: (started.set(), release.wait()))
+    assert started.wait(timeout=2)
+    assert not task.cancel()
+    release.set()
+
+def test_cancelled_earliest_task_does_not_hold_back_the_next(scheduler):
+    fired = threading.Event()
+    scheduler.schedule(0.05, lambda: None).cancel()
+    scheduler.schedule(0.1, fired.set)
+    assert fired.wait(timeout=2)
+
+def test_rearm_anchored_to_start_does_not_drift(scheduler):
+    # Re-armed from its own callback like Agent.schedule_run: each run takes a while,
+    # but fire times are anchored to the start, so the delay never accumulates
+    start = datetime.now() + timedelta(seconds=0.05)
+    period = timedelta(seconds=0.05)
+    fired_at = []
+    done = threading.Event()
+    def run(index):
+        fired_at.append(datetime.now())
+        time.sleep(0.02)
+        if index == 9:
+            return done.set()
+        scheduler.schedule_at(start + (index + 1) * period, lambda: run(index + 1))
+    scheduler.schedule_at(start, lambda: run(0))
+    assert done.wait(timeout=5)
+    assert len(fired_at) == 10
+    lateness = [(fired - (start + index * period)).total_seconds() for index, fired in enumerate(fired_at)]
+    assert min(lateness) >= -0.005
+    assert max(lateness) < 0.1  # unanchored re-arms would be 0.18 late by the last run
+
+def test_stop_cancels_pending_tasks():
+    scheduler = Scheduler(max_workers=1)
+    scheduler.start()
+    fired = threading.Event()
+    task = scheduler.schedule(0.1, fired.set)
+    scheduler.stop()
+    assert not fired.wait(timeout=0.3)
+    assert not task.cancel()
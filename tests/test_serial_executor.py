@@ -0,0 +1,79 @@
+import random
+import threading
+import time
+from measurement_plane.utils.serial_executor import KeyedSerialExecutor
+
+def wait_idle(executor, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with executor.lock:
+            if not executor.waiting:
+                return True
+        time.sleep(0.01)
+    return False
+
+def test_runs_each_key_in_submission_order():
+    executor = KeyedSerialExecutor(max_workers=4)
+    seen = {key: [] for key in range(5)}
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+    def task(key, index):
+        with lock:
+            if key in running:
+                overlaps.append(key)
+            running.add(key)
+        time.sleep(random.uniform(0, 0.002))
+        with lock:
+            running.discard(key)
+            seen[key].append(index)
+    try:
+        for index in range(50):
+            for key in seen:
+                executor.submit(key, lambda key=key, index=index: task(key, index))
+        assert wait_idle(executor)
+    finally:
+        executor.shutdown(wait=True)
+    assert overlaps == []
+    assert all(indexes == list(range(50)) for indexes in seen.values())
+
+def test_keys_run_in_parallel():
+    executor = KeyedSerialExecutor(max_workers=2)
+    release = threading.Event()
+    started = threading.Event()
+    try:
+        executor.submit("blocked", release.wait)
+        executor.submit("other", started.set)
+        assert started.wait(timeout=2)
+        assert executor.pending() == 0
+        executor.submit("blocked", lambda: None)
+        assert executor.pending() == 1
+    finally:
+        release.set()
+        executor.shutdown(wait=True)
+
+def test_busy_key_does_not_starve_others():
+    executor = KeyedSerialExecutor(max_workers=1)
+    order = []
+    release = threading.Event()
+    try:
+        executor.submit("busy", lambda: (release.wait(), order.append(("busy", 0))))
+        for index in range(1, 3):
+            executor.submit("busy", lambda index=index: order.append(("busy", index)))
+        executor.submit("quiet", lambda: order.append(("quiet", 0)))
+        release.set()
+        assert wait_idle(executor)
+    finally:
+        executor.shutdown(wait=True)
+    # The single worker is handed back after each callable, so quiet runs before busy is done
+    assert order == [("busy", 0), ("quiet", 0), ("busy", 1), ("busy", 2)]
+
+def test_failing_callable_does_not_stop_its_key():
+    executor = KeyedSerialExecutor(max_workers=2)
+    done = threading.Event()
+    try:
+        executor.submit("key", lambda: 1 / 0)
+        executor.submit("key", done.set)
+        assert done.wait(timeout=2)
+    finally:
+        executor.shutdown(wait=True)
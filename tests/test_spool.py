@@ -0,0 +1,131 @@
+import os
+import threading
+from measurement_plane.messaging.message_format import MessageFields
+from measurement_plane.measurement_plane_client.utils.spool import SpoolLog, ResultSpool, RECORD_HEADER, SEGMENT_SUFFIX
+
+SEGMENT = 1024
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+def test_records_survive_reopening(tmp_path):
+    log = SpoolLog(str(tmp_path), segment_size=SEGMENT)
+    batches = [{"index": index, "values": list(range(20))} for index in range(30)]
+    for index, batch in enumerate(batches):
+        assert log.append(batch) == index
+    log.close()
+    assert len(segment_files(tmp_path)) > 1
+
+    log = SpoolLog(str(tmp_path), segment_size=SEGMENT)
+    try:
+        assert log.next_offset == 30
+        assert [values for _, values in log.records()] == batches
+        assert log.append("next") == 30
+    finally:
+        log.close()
+
+def test_torn_record_reads_back_as_the_end(tmp_path):
+    log = SpoolLog(str(tmp_path), segment_size=SEGMENT)
+    for index in range(3):
+        log.append(index)
+    position = log.segments[-1].positions[-1]
+    log.close()
+    path = os.path.join(tmp_path, segment_files(tmp_path)[-1])
+    with open(path, 'r+b') as segment_file:
+        segment_file.seek(position + RECORD_HEADER.size)
+        segment_file.write(b'\xff')  # the payload no longer matches its crc
+
+    log = SpoolLog(str(tmp_path), segment_size=SEGMENT)
+    try:
+        assert [values for _, values in log.records()] == [0, 1]
+        assert log.append("rewritten") == 2
+        assert log.read(2) == "rewritten"
+    finally:
+        log.close()
+
+def test_consumer_offsets_survive_reopening(tmp_path):
+    log = SpoolLog(str(tmp_path), segment_size=SEGMENT)
+    for index in range(5):
+        log.append(index)
+    log.commit("client", 3)
+    log.close()
+
+    log = SpoolLog(str(tmp_path), segment_size=SEGMENT)
+    try:
+        assert log.committed("client") == 3
+        assert log.committed("other") == 0
+    finally:
+        log.close()
+
+def test_retention_counts_bytes_written(tmp_path):
+    # Segments are preallocated to 64 KiB but each holds a single 40 KiB record
+    log = SpoolLog(str(tmp_path), segment_size=64 * 1024, retention_bytes=128 * 1024)
+    try:
+        for index in range(3):
+            log.append(b"x" * (40 * 1024))
+        assert log.first_offset == 0
+        assert len(segment_files(tmp_path)) == 3
+        log.append(b"x" * (40 * 1024))
+        assert log.first_offset == 1
+        assert len(segment_files(tmp_path)) == 3
+        assert [offset for offset, _ in log.records()] == [1, 2, 3]
+    finally:
+        log.close()
+
+def test_consumer_resumes_and_releases_its_log(tmp_path):
+    spool = ResultSpool(str(tmp_path), segment_size=SEGMENT)
+    received = []
+    stopped = threading.Event()
+    consumer = None
+    def callback(values):
+        received.append(values)
+        if values == ["stop"]:
+            consumer.stop()  # from the consumer thread, as Measurement.stop does
+            stopped.set()
+    for index in range(5):
+        spool.append("m1", [index])
+    spool.log("m1").commit("client", 2)
+    consumer = spool.consume("m1", callback)
+    spool.append("m1", ["stop"])
+    assert stopped.wait(timeout=5)
+    consumer.thread.join(timeout=5)
+    assert received == [[2], [3], [4], ["stop"]]
+    assert "m1" not in spool.logs
+    assert [values for _, values in spool.replay("m1")] == [[0], [1], [2], [3], [4], ["stop"]]
+    spool.close()
+
+def test_log_is_deleted_once_its_eof_is_consumed(tmp_path):
+    spool = ResultSpool(str(tmp_path), segment_size=SEGMENT)
+    received = []
+    consumer = spool.consume("m1", received.append)
+    spool.append("m1", [1, 2])
+    spool.append("m1", [3, MessageFields.EOF_RESULTS])
+    consumer.thread.join(timeout=5)
+    assert not consumer.thread.is_alive() and consumer.finished
+    assert received == [[1, 2], [3, MessageFields.EOF_RESULTS]]
+    assert spool.measurement_ids() == []
+    spool.close()
+
+def test_closed_logs_are_trimmed(tmp_path):
+    log = SpoolLog(str(tmp_path), segment_size=64 * 1024)
+    log.append([1])
+    written = log.size
+    log.close()
+    assert sum(os.path.getsize(os.path.join(tmp_path, name)) for name in segment_files(tmp_path)) == written
+    log = SpoolLog(str(tmp_path), segment_size=64 * 1024)
+    try:
+        assert log.append([2]) == 1
+        assert [values for _, values in log.records()] == [[1], [2]]
+    finally:
+        log.close()
+
+def test_retention_applies_across_the_spool(tmp_path):
+    spool = ResultSpool(str(tmp_path), segment_size=SEGMENT, retention_bytes=3 * 1024)
+    for index in range(5):
+        measurement_id = f"m{index}"
+        spool.append(measurement_id, b"x" * 900)
+        spool.release(measurement_id)
+        os.utime(os.path.join(tmp_path, measurement_id, segment_files(os.path.join(tmp_path, measurement_id))[0]), (index, index))
+    spool.release("m4")  # applies retention again now that every log is dated
+    assert spool.measurement_ids() == ["m2", "m3", "m4"]
+    spool.close()
@@ -0,0 +1,67 @@
+import queue
+import threading
+import pytest
+from measurement_plane.messaging.message_format import MessageFields
+from measurement_plane.utils.stream_buffer import StreamBuffer, OverflowPolicy
+
+def contents(buffer):
+    items = []
+    while True:
+        try:
+            items.append(buffer.get_nowait())
+        except queue.Empty:
+            return items
+
+def test_block_waits_for_room():
+    buffer = StreamBuffer(maxsize=2, policy=OverflowPolicy.BLOCK)
+    buffer.put(1)
+    buffer.put(2)
+    with pytest.raises(queue.Full):
+        buffer.put(3, timeout=0.05)
+    producer = threading.Thread(target=buffer.put, args=(3,))
+    producer.start()
+    assert buffer.get() == 1
+    producer.join(timeout=2)
+    assert contents(buffer) == [2, 3]
+
+def test_drop_oldest_keeps_newest_items():
+    buffer = StreamBuffer(maxsize=3, policy=OverflowPolicy.DROP_OLDEST)
+    for item in range(5):
+        buffer.put(item)
+    assert contents(buffer) == [2, 3, 4]
+    assert buffer.stats() == {"depth": 0, "capacity": 3, "dropped": 2, "merged": 0}
+
+def test_drop_newest_keeps_oldest_items():
+    buffer = StreamBuffer(maxsize=3, policy=OverflowPolicy.DROP_NEWEST)
+    for item in range(5):
+        buffer.put(item)
+    assert buffer.depth == 3
+    assert contents(buffer) == [0, 1, 2]
+    assert buffer.dropped == 2
+
+def test_merge_folds_incoming_into_newest():
+    buffer = StreamBuffer(maxsize=2, policy=OverflowPolicy.MERGE, merge_callback=lambda buffered, incoming: buffered + incoming)
+    for item in ([1], [2], [3], [4]):
+        buffer.put(item)
+    assert contents(buffer) == [[1], [2, 3, 4]]
+    assert buffer.merged == 2
+
+def test_merge_requires_a_callback():
+    with pytest.raises(ValueError):
+        StreamBuffer(policy=OverflowPolicy.MERGE)
+
+@pytest.mark.parametrize("policy", [OverflowPolicy.DROP_OLDEST, OverflowPolicy.DROP_NEWEST, OverflowPolicy.MERGE])
+def test_eof_is_never_dropped_or_merged(policy):
+    buffer = StreamBuffer(maxsize=2, policy=policy, merge_callback=lambda buffered, incoming: buffered + incoming)
+    buffer.put([1])
+    buffer.put([2])
+    buffer.put(MessageFields.EOF_RESULTS)
+    items = contents(buffer)
+    assert items[-1] == MessageFields.EOF_RESULTS
+    assert len(items) == 3
+
+def test_unbounded_buffer_never_drops():
+    buffer = StreamBuffer(maxsize=0, policy=OverflowPolicy.DROP_NEWEST)
+    for item in range(100):
+        buffer.put(item)
+    assert buffer.depth == 100 and buffer.dropped == 0